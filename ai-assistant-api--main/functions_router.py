@@ -3,6 +3,7 @@ from typing import Dict, Any, List, Optional
 from bson import ObjectId
 from datetime import datetime
 import logging
+from services.tool_registry import compile_entity_schema
 
 logger = logging.getLogger(__name__)
 
@@ -61,13 +62,10 @@ def create_functions_router(db):
                 raise HTTPException(status_code=404, detail="Google Sheets integration not found in system")
             
             # Validate schema structure
-            for entity_name, entity_config in schema.items():
-                if "type" not in entity_config:
-                    raise HTTPException(status_code=400, detail=f"Entity '{entity_name}' missing 'type' field")
-                if entity_config["type"] not in ["string", "bool", "int", "dict", "float"]:
-                    raise HTTPException(status_code=400, detail=f"Invalid type for entity '{entity_name}': {entity_config['type']}")
-                if "description" not in entity_config:
-                    raise HTTPException(status_code=400, detail=f"Entity '{entity_name}' missing 'description' field")
+            try:
+                parameters = compile_entity_schema(schema)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             
             # Check if function already exists
             existing_function = await db.save_user_data_function.find_one({"assistant_id": ObjectId(assistant_id)})
@@ -84,43 +82,9 @@ def create_functions_router(db):
                 "created_at": datetime.now(),
                 "active": True,
                 "integration_id": str(integration["_id"]),  # Store the integration ID
-                "parameters": {
-                    "type": "object",
-                    "properties": {},
-                    "required": []
-                }
+                "parameters": parameters
             }
             
-            # Build OpenAI function parameters based on schema
-            for entity_name, entity_config in schema.items():
-                entity_type = entity_config["type"]
-                
-                if entity_type == "string":
-                    function_def["parameters"]["properties"][entity_name] = {
-                        "type": "string",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "bool":
-                    function_def["parameters"]["properties"][entity_name] = {
-                        "type": "boolean",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "int":
-                    function_def["parameters"]["properties"][entity_name] = {
-                        "type": "integer",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "float":
-                    function_def["parameters"]["properties"][entity_name] = {
-                        "type": "number",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "dict":
-                    function_def["parameters"]["properties"][entity_name] = {
-                        "type": "object",
-                        "description": entity_config["description"]
-                    }
-            
             result = await db.save_user_data_function.insert_one(function_def)
             
             # Also register as a regular function for assistant
@@ -166,49 +130,10 @@ def create_functions_router(db):
                 raise HTTPException(status_code=404, detail="save_user_data function not activated for this assistant")
             
             # Validate updated schema
-            for entity_name, entity_config in schema.items():
-                if "type" not in entity_config:
-                    raise HTTPException(status_code=400, detail=f"Entity '{entity_name}' missing 'type' field")
-                if entity_config["type"] not in ["string", "bool", "int", "dict", "float"]:
-                    raise HTTPException(status_code=400, detail=f"Invalid type for entity '{entity_name}': {entity_config['type']}")
-                if "description" not in entity_config:
-                    raise HTTPException(status_code=400, detail=f"Entity '{entity_name}' missing 'description' field")
-            
-            # Update schema and rebuild parameters
-            updated_parameters = {
-                "type": "object",
-                "properties": {},
-                "required": []
-            }
-            
-            for entity_name, entity_config in schema.items():
-                entity_type = entity_config["type"]
-                
-                if entity_type == "string":
-                    updated_parameters["properties"][entity_name] = {
-                        "type": "string",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "bool":
-                    updated_parameters["properties"][entity_name] = {
-                        "type": "boolean",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "int":
-                    updated_parameters["properties"][entity_name] = {
-                        "type": "integer",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "float":
-                    updated_parameters["properties"][entity_name] = {
-                        "type": "number",
-                        "description": entity_config["description"]
-                    }
-                elif entity_type == "dict":
-                    updated_parameters["properties"][entity_name] = {
-                        "type": "object",
-                        "description": entity_config["description"]
-                    }
+            try:
+                parameters = compile_entity_schema(schema)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             
             # Update save_user_data_function
             await db.save_user_data_function.update_one(
@@ -216,7 +141,7 @@ def create_functions_router(db):
                 {
                     "$set": {
                         "schema": schema,
-                        "parameters": updated_parameters,
+                        "parameters": parameters,
                         "updated_at": datetime.now()
                     }
                 }
@@ -227,7 +152,7 @@ def create_functions_router(db):
                 {"assistant_id": ObjectId(assistant_id), "name": "save_user_data"},
                 {
                     "$set": {
-                        "parameters": updated_parameters,
+                        "parameters": parameters,
                         "updated_at": datetime.now()
                     }
                 }
@@ -271,9 +196,7 @@ def create_functions_router(db):
             updated_schema.pop(entity_name)
             
             # Rebuild parameters without the deleted entity
-            updated_parameters = existing_function["parameters"].copy()
-            if entity_name in updated_parameters["properties"]:
-                updated_parameters["properties"].pop(entity_name)
+            updated_parameters = compile_entity_schema(updated_schema)
             
             # Update save_user_data_function
             await db.save_user_data_function.update_one(
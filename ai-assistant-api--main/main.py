@@ -11,6 +11,8 @@ import os
 import logging
 from datetime import datetime
 from functions_router import create_functions_router
+from utils.metrics import metrics
+from services.vector_sync_worker import requeue_assistant_payloads
 from bson import ObjectId
 
 logging.basicConfig(level=logging.INFO)
@@ -59,6 +61,22 @@ async def shutdown_db_client():
         mongodb_client.close()
         logger.info("Disconnected from MongoDB")
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+async def get_metadata_fields(assistant_id: str) -> Optional[Dict[str, str]]:
+    assistant = await db.assistants.find_one({"_id": ObjectId(assistant_id)}, {"metadata_fields": 1})
+    if assistant is None:
+        return None
+    return assistant.get("metadata_fields") or {}
+
+async def resync_if_metadata_fields_changed(assistant_id: str, previous: Optional[Dict[str, str]], fields: Optional[Dict[str, str]]):
+    if previous is None or previous == (fields or {}):
+        return
+    count = await requeue_assistant_payloads(db, assistant_id)
+    logger.info(f"metadata_fields of assistant {assistant_id} changed, re-syncing payloads of {count} documents")
+
 async def get_assistant(assistant_id: str):
     assistant = await db.assistants.find_one({"_id": ObjectId(assistant_id)})
     if assistant is None:
@@ -94,6 +112,7 @@ async def get_assistant_config(assistant: dict = Depends(get_assistant)):
 async def update_assistant_full(assistant_id: str, assistant: AIAssistantModel = Body(...)):
     assistant_dict = assistant.model_dump(exclude={"assistant_id", "created_at"})
     assistant_dict["updated_at"] = datetime.now()
+    previous_fields = await get_metadata_fields(assistant_id)
     
     await db.assistants.update_one(
         {"_id": ObjectId(assistant_id)},
@@ -104,6 +123,8 @@ async def update_assistant_full(assistant_id: str, assistant: AIAssistantModel =
     if updated_assistant is None:
         raise HTTPException(status_code=404, detail="Assistant not found")
     
+    await resync_if_metadata_fields_changed(assistant_id, previous_fields, assistant_dict["metadata_fields"])
+    
     updated_assistant["_id"] = str(updated_assistant["_id"])
     
     return updated_assistant
@@ -116,6 +137,8 @@ async def update_assistant_partial(assistant_id: str, update_data: AIAssistantUp
     if not update_dict:
         raise HTTPException(status_code=400, detail="No valid fields to update")
     
+    previous_fields = await get_metadata_fields(assistant_id) if "metadata_fields" in update_dict else None
+    
     result = await db.assistants.update_one(
         {"_id": ObjectId(assistant_id)},
         {"$set": update_dict}
@@ -124,6 +147,8 @@ async def update_assistant_partial(assistant_id: str, update_data: AIAssistantUp
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Assistant not found")
     
+    await resync_if_metadata_fields_changed(assistant_id, previous_fields, update_dict.get("metadata_fields"))
+    
     updated_assistant = await db.assistants.find_one({"_id": ObjectId(assistant_id)})
     return updated_assistant
 
@@ -135,14 +160,17 @@ async def update_assistant_field(
 ):
     valid_fields = [
         "openai_id", "name", "model", "instructions", "temperature", 
-        "functions_on", "message_buffer", "hello_message", "error_message",
-        "max_tokens", "search_count", "truncation_strategy", "min_relatedness"
+        "functions_on", "message_buffer", "message_buffer_window", "hello_message", "error_message",
+        "max_tokens", "search_count", "truncation_strategy", "min_relatedness",
+        "metadata_fields", "context_compression", "retrieval_gate",
+        "model_router", "scheduling"
     ]
     
     if field not in valid_fields:
         raise HTTPException(status_code=400, detail=f"Invalid field: {field}")
     
     update_dict = {field: value, "updated_at": datetime.now()}
+    previous_fields = await get_metadata_fields(assistant_id) if field == "metadata_fields" else None
     
     result = await db.assistants.update_one(
         {"_id": ObjectId(assistant_id)},
@@ -152,6 +180,9 @@ async def update_assistant_field(
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Assistant not found")
     
+    if field == "metadata_fields":
+        await resync_if_metadata_fields_changed(assistant_id, previous_fields, value)
+    
     updated_assistant = await db.assistants.find_one({"_id": ObjectId(assistant_id)})
     return updated_assistant
 
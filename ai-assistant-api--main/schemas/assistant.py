@@ -1,8 +1,9 @@
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Literal
 from pydantic import BaseModel, Field
 from bson import ObjectId
 
+MetadataFieldType = Literal["keyword", "integer", "datetime"]
 
 
 class FunctionModel(BaseModel):
@@ -10,6 +11,9 @@ class FunctionModel(BaseModel):
     name: str
     description: str
     parameters: Dict[str, Any] = {}
+    endpoint: Optional[str] = None
+    timeout: Optional[float] = None
+    cache_ttl: Optional[float] = None
     assistant_id: Optional[str]
     
     class Config:
@@ -33,6 +37,7 @@ class AIAssistantModel(BaseModel):
     temperature: float = 0.7
     functions_on: bool = False
     message_buffer: int = 1
+    message_buffer_window: float = 2.0
     created_at: datetime = datetime.now()
     updated_at: Optional[datetime] = None
     hello_message: str = "Я готов консультировать!"
@@ -44,11 +49,31 @@ class AIAssistantModel(BaseModel):
         "last_messages": 10
     }
     min_relatedness: float = 0.3
+    metadata_fields: Dict[str, MetadataFieldType] = {}
+    context_compression: Dict[str, Any] = {
+        "enabled": False,
+        "token_budget": 800
+    }
+    retrieval_gate: Dict[str, Any] = {
+        "enabled": False,
+        "max_short_words": 2,
+        "max_reuse_turns": 3
+    }
+    model_router: Dict[str, Any] = {
+        "enabled": False,
+        "fast_model": "gpt-4o-mini",
+        "max_simple_words": 12,
+        "min_kb_score": 0.8
+    }
+    scheduling: Dict[str, Any] = {
+        "weight": 1.0
+    }
     
     class Config:
         populate_by_name = True
         arbitrary_types_allowed = True
         json_encoders = {ObjectId: str}
+        protected_namespaces = ()
 
 class AIAssistantUpdateModel(BaseModel):
     openai_id: Optional[str] = None
@@ -58,13 +83,20 @@ class AIAssistantUpdateModel(BaseModel):
     temperature: Optional[float] = None
     functions_on: Optional[bool] = None
     message_buffer: Optional[int] = None
+    message_buffer_window: Optional[float] = None
     hello_message: Optional[str] = None
     error_message: Optional[str] = None
     max_tokens: Optional[int] = None
     search_count: Optional[int] = None
     truncation_strategy: Optional[Dict[str, Any]] = None
     min_relatedness: Optional[float] = None
+    metadata_fields: Optional[Dict[str, MetadataFieldType]] = None
+    context_compression: Optional[Dict[str, Any]] = None
+    retrieval_gate: Optional[Dict[str, Any]] = None
+    model_router: Optional[Dict[str, Any]] = None
+    scheduling: Optional[Dict[str, Any]] = None
     
     class Config:
         arbitrary_types_allowed = True
-        json_encoders = {ObjectId: str}
\ No newline at end of file
+        json_encoders = {ObjectId: str}
+        protected_namespaces = ()
\ No newline at end of file
@@ -6,6 +6,9 @@ class FunctionModel(BaseModel):
     name: str
     description: str
     parameters: Dict[str, Any] = {}
+    endpoint: Optional[str] = None
+    timeout: Optional[float] = None
+    cache_ttl: Optional[float] = None
     assistant_id: str
     
     class Config:
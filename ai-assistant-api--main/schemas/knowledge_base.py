@@ -32,4 +32,33 @@ class SearchResponse(BaseModel):
     results: List[TextDataResponse]
     total: int
 
-    
\ No newline at end of file
+    
+class TitleSuggestion(BaseModel):
+    id: str
+    title: str
+    score: float
+
+class SuggestResponse(BaseModel):
+    suggestions: List[TitleSuggestion]
+    total: int
+
+class IngestionFileStatus(BaseModel):
+    name: str
+    status: str
+    sections: int = 0
+    chunks: int = 0
+    error: Optional[str] = None
+
+class IngestionJobResponse(BaseModel):
+    id: str
+    assistant_id: Optional[str] = None
+    status: str
+    files: List[IngestionFileStatus]
+    files_total: int
+    files_parsed: int
+    chunks_inserted: int
+    chunks_synced: int = 0
+    chunks_failed: int = 0
+    created_at: datetime
+    updated_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
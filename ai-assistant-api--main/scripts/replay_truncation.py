@@ -0,0 +1,108 @@
+"""
+Replay recorded conversations through the truncation strategies and compare prompt sizes.
+
+Every user message in the history export is replayed as a bot turn, laid out like the bots'
+prompts: the instructions, the dialogue truncated by the strategy (with the instructions and
+knowledge base context of the given sizes reserved from the budget), then the knowledge base
+context. The prompt is measured and the recorded bot reply is appended to the dialogue.
+Each strategy is compared with the untruncated prompt; a budget that never binds saves nothing,
+so also report how many turns it actually truncated.
+
+    python scripts/replay_truncation.py --dataset ../dataset.json --max-tokens 3000
+"""
+import os
+import sys
+import json
+import argparse
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.tokens import count_messages_tokens
+from utils.truncation import truncate_messages
+
+FILLER = "Занятия проходят в группах по 8 человек, первое пробное занятие бесплатно. "
+
+
+def load_conversations(path):
+    with open(path, encoding="utf-8") as f:
+        records = json.load(f)
+
+    conversations = defaultdict(list)
+    for record in records:
+        timestamp = record.get("timestamp")
+        if isinstance(timestamp, dict):
+            timestamp = timestamp.get("$date")
+        conversations[record["user_id"]].append((str(timestamp), record["message_type"], record["message"]))
+
+    for messages in conversations.values():
+        messages.sort(key=lambda item: item[0])
+    return conversations
+
+
+def replay(conversations, strategy, instructions, kb_context, model):
+    fixed = [{"role": "system", "content": instructions}, {"role": "system", "content": kb_context}]
+    reserved = count_messages_tokens(fixed, model)
+    prompt_sizes = []
+    truncated = 0
+    for records in conversations.values():
+        session = []
+        for _, message_type, text in records:
+            if message_type == "user":
+                session.append({"role": "user", "content": text})
+                if strategy:
+                    before = len(session)
+                    truncate_messages(session, strategy, model, reserved)
+                    truncated += len(session) < before
+                prompt_sizes.append(reserved + count_messages_tokens(session, model))
+            else:
+                session.append({"role": "assistant", "content": text})
+    return prompt_sizes, truncated
+
+
+def summarize(prompt_sizes, truncated):
+    ordered = sorted(prompt_sizes)
+    return {
+        "turns": len(ordered),
+        "truncated": truncated,
+        "avg": round(sum(ordered) / len(ordered), 1) if ordered else 0,
+        "p95": ordered[int(0.95 * (len(ordered) - 1))] if ordered else 0,
+        "max": ordered[-1] if ordered else 0,
+        "total": sum(ordered)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", default=os.path.join(os.path.dirname(__file__), "..", "..", "dataset.json"))
+    parser.add_argument("--last-messages", type=int, default=10)
+    parser.add_argument("--max-tokens", type=int, default=3000)
+    parser.add_argument("--instructions-chars", type=int, default=1500, help="size of the assistant instructions")
+    parser.add_argument("--kb-chars", type=int, default=3000, help="size of the knowledge base context per turn")
+    parser.add_argument("--model", default="gpt-4")
+    args = parser.parse_args()
+
+    conversations = load_conversations(args.dataset)
+    filler = FILLER * (1 + max(args.instructions_chars, args.kb_chars) // len(FILLER))
+    instructions, kb_context = filler[:args.instructions_chars], filler[:args.kb_chars]
+
+    strategies = {
+        "none": None,
+        f"last_messages={args.last_messages}": {"type": "last_messages", "last_messages": args.last_messages},
+        f"max_tokens={args.max_tokens}": {"type": "max_tokens", "max_tokens": args.max_tokens},
+    }
+
+    results = {name: summarize(*replay(conversations, strategy, instructions, kb_context, args.model))
+               for name, strategy in strategies.items()}
+
+    baseline = results["none"]["total"]
+    print(f"{len(conversations)} conversations")
+    print(f"{'strategy':<24}{'turns':>8}{'truncated':>11}{'avg':>10}{'p95':>8}{'max':>8}{'total':>12}{'saved':>8}")
+    for name, result in results.items():
+        saved = 100 * (1 - result["total"] / baseline) if baseline else 0.0
+        print(f"{name:<24}{result['turns']:>8}{result['truncated']:>11}{result['avg']:>10}{result['p95']:>8}"
+              f"{result['max']:>8}{result['total']:>12}{saved:>7.1f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+from bson import ObjectId
+from services.tool_registry import tool_registry, EMPTY_TOOLSET
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Entries are refreshed after CACHE_FALLBACK_TTL seconds when change streams are unavailable
+# (standalone MongoDB), so writes from the API show up within about a second. With a working
+# change stream invalidation is push-based and CACHE_MAX_AGE is only a safety net.
+CACHE_FALLBACK_TTL = float(os.getenv("ASSISTANT_CACHE_TTL", "1.0"))
+CACHE_MAX_AGE = float(os.getenv("ASSISTANT_CACHE_MAX_AGE", "300"))
+WATCH_RETRY_SECONDS = 60
+WATCHED_COLLECTIONS = ["assistants", "functions", "save_user_data_function", "google_sheets_integrations"]
+
+
+async def find_sheets_integration(db, assistant_id: ObjectId, integration_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    sheets_integration = None
+
+    # 1. The integration explicitly linked in the save_user_data config
+    if integration_id:
+        sheets_integration = await db.google_sheets_integrations.find_one({"_id": ObjectId(integration_id)})
+
+    # 2. By assistant_id stored as ObjectId or as string
+    if not sheets_integration:
+        sheets_integration = await db.google_sheets_integrations.find_one({"assistant_id": assistant_id})
+    if not sheets_integration:
+        sheets_integration = await db.google_sheets_integrations.find_one({"assistant_id": str(assistant_id)})
+
+    # 3. The first integration as fallback
+    if not sheets_integration:
+        integrations = await db.google_sheets_integrations.find().to_list(None)
+        if integrations:
+            sheets_integration = integrations[0]
+            logger.warning(f"Using fallback integration with ID: {sheets_integration.get('_id')}")
+
+    return sheets_integration
+
+
+class AssistantConfigCache:
+    """
+    Read-through cache of everything a bot turn needs about an assistant: the assistant
+    document, save_user_data config, custom functions, compiled tools and the resolved
+    Google Sheets integrations. Concurrent misses for the same assistant share one load.
+
+    Entries are invalidated by a MongoDB change stream on the source collections; if
+    change streams are not supported the cache falls back to a short TTL.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.entries: Dict[str, tuple] = {}
+        self.loading: Dict[str, asyncio.Future] = {}
+        self.generations: Dict[str, int] = {}
+        self.ttl = CACHE_FALLBACK_TTL
+        self.watch_task: Optional[asyncio.Task] = None
+
+    async def get(self, assistant_id) -> Dict[str, Any]:
+        key = str(assistant_id)
+        self.start()
+
+        entry = self.entries.get(key)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            metrics.inc("assistant_config_cache_hits_total")
+            return entry[0]
+
+        metrics.inc("assistant_config_cache_misses_total")
+        future = self.loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key))
+            self.loading[key] = future
+            future.add_done_callback(lambda _: self.loading.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _load(self, key: str) -> Dict[str, Any]:
+        generation = self.generations.get(key, 0)
+        assistant_id = ObjectId(key)
+
+        assistant, save_user_data_config, function_docs = await asyncio.gather(
+            self.db.assistants.find_one({"_id": assistant_id}),
+            self.db.save_user_data_function.find_one({"assistant_id": assistant_id}),
+            self.db.functions.find({
+                "assistant_id": assistant_id,
+                "name": {"$ne": "save_user_data"}  # Exclude save_user_data, it is configured separately
+            }).to_list(None)
+        )
+
+        user_data_integration, conversation_integration = await asyncio.gather(
+            find_sheets_integration(self.db, assistant_id, (save_user_data_config or {}).get("integration_id")),
+            find_sheets_integration(self.db, assistant_id)
+        )
+
+        config = {
+            "assistant": assistant,
+            "save_user_data": save_user_data_config,
+            "function_docs": function_docs,
+            "tools": tool_registry.get(assistant, save_user_data_config, function_docs) if assistant else EMPTY_TOOLSET,
+            "user_data_integration": user_data_integration,
+            "conversation_integration": conversation_integration
+        }
+
+        # Skip caching if the entry was invalidated while loading
+        if self.generations.get(key, 0) == generation:
+            self.entries[key] = (config, time.monotonic())
+        return config
+
+    def invalidate(self, assistant_id=None):
+        if assistant_id is None:
+            for key in list(self.entries) + list(self.loading):
+                self.generations[key] = self.generations.get(key, 0) + 1
+            self.entries.clear()
+            return
+        key = str(assistant_id)
+        self.generations[key] = self.generations.get(key, 0) + 1
+        self.entries.pop(key, None)
+
+    def start(self):
+        if self.watch_task is None or self.watch_task.done():
+            self.watch_task = asyncio.create_task(self.watch())
+
+    async def stop(self):
+        if self.watch_task:
+            self.watch_task.cancel()
+            try:
+                await self.watch_task
+            except asyncio.CancelledError:
+                pass
+            self.watch_task = None
+
+    async def watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}}]
+        while True:
+            try:
+                async with self.db.watch(pipeline, full_document="updateLookup") as stream:
+                    self.ttl = CACHE_MAX_AGE
+                    # Anything cached before the stream opened may already be stale
+                    self.invalidate()
+                    logger.info("Assistant config cache is watching MongoDB change streams")
+                    async for change in stream:
+                        self.handle_change(change)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.ttl != CACHE_FALLBACK_TTL:
+                    logger.warning(f"Change streams unavailable, assistant config cache falls back to a {CACHE_FALLBACK_TTL}s TTL: {e}")
+                self.ttl = CACHE_FALLBACK_TTL
+                self.invalidate()
+                await asyncio.sleep(WATCH_RETRY_SECONDS)
+
+    def handle_change(self, change: Dict[str, Any]):
+        metrics.inc("assistant_config_cache_invalidations_total", collection=change["ns"]["coll"])
+        if change["ns"]["coll"] == "assistants":
+            self.invalidate(change["documentKey"]["_id"])
+            return
+
+        # Deletes carry no document, and integrations may be shared as a fallback
+        document = change.get("fullDocument") or {}
+        assistant_id = document.get("assistant_id")
+        if assistant_id and change["ns"]["coll"] != "google_sheets_integrations":
+            self.invalidate(assistant_id)
+        else:
+            self.invalidate()
+
+
+_caches: Dict[str, AssistantConfigCache] = {}
+
+
+def get_assistant_cache(db) -> AssistantConfigCache:
+    """One cache per database, shared by every bot service in the process."""
+    cache = _caches.get(db.name)
+    if cache is None:
+        cache = _caches[db.name] = AssistantConfigCache(db)
+    return cache
@@ -0,0 +1,152 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from utils.embeddings import get_embeddings_batch
+from utils.tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+MAX_CACHED_DOCUMENTS = 2048
+DEFAULT_TOKEN_BUDGET = 800
+# Embedding requests are split so none exceeds the API's input limits
+COMPRESSION_BATCH_SIZE = int(os.getenv("COMPRESSION_BATCH_SIZE", "256"))
+COMPRESSION_BATCH_TOKENS = int(os.getenv("COMPRESSION_BATCH_TOKENS", "8000"))
+MAX_SENTENCES_PER_DOCUMENT = int(os.getenv("MAX_SENTENCES_PER_DOCUMENT", "200"))
+# Only the start of an overlong sentence (e.g. a table row dump) is embedded
+MAX_SENTENCE_CHARS = 2000
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip() for s in SENTENCE_SPLIT_RE.split(text or "") if s and s.strip()]
+
+
+def content_key(doc: Dict[str, Any]) -> str:
+    """Sentence vectors depend only on the content, so title or metadata edits keep the cache."""
+    return hashlib.sha1((doc.get("content") or "").encode("utf-8")).hexdigest()
+
+
+def embedding_batches(texts: List[str], model: str = "gpt-4") -> List[List[str]]:
+    batches: List[List[str]] = []
+    tokens = 0
+    for text in texts:
+        text_tokens = count_tokens(text, model)
+        if not batches or len(batches[-1]) >= COMPRESSION_BATCH_SIZE or tokens + text_tokens > COMPRESSION_BATCH_TOKENS:
+            batches.append([])
+            tokens = 0
+        batches[-1].append(text)
+        tokens += text_tokens
+    return batches
+
+
+class ContextCompressor:
+    """
+    Query-time extractive compression of retrieved documents.
+
+    Documents are split into sentences, each sentence is scored against the query embedding
+    and only the best sentences that fit the token budget are kept, in their original order.
+    At most `MAX_SENTENCES_PER_DOCUMENT` sentences of a document are considered. Sentences are
+    embedded in bounded batches sent concurrently, and cached by document content.
+    """
+
+    def __init__(self, max_cached_documents: int = MAX_CACHED_DOCUMENTS):
+        self.max_cached_documents = max_cached_documents
+        self.cache: "OrderedDict[str, Tuple[List[str], np.ndarray]]" = OrderedDict()
+
+    def _cached(self, key: str):
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, sentences: List[str], vectors: np.ndarray):
+        self.cache[key] = (sentences, vectors)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_cached_documents:
+            self.cache.popitem(last=False)
+
+    async def sentence_vectors(self, docs: List[Dict[str, Any]], api_key: Optional[str]) -> List[Tuple[List[str], np.ndarray]]:
+        results: List[Optional[Tuple[List[str], np.ndarray]]] = []
+        missing = []
+        for doc in docs:
+            entry = self._cached(content_key(doc))
+            results.append(entry)
+            if entry is None:
+                sentences = split_sentences(doc.get("content", ""))[:MAX_SENTENCES_PER_DOCUMENT]
+                missing.append((len(results) - 1, doc, sentences))
+
+        texts = [sentence[:MAX_SENTENCE_CHARS] for _, _, sentences in missing for sentence in sentences]
+        if texts:
+            batches = await asyncio.gather(*[
+                get_embeddings_batch(batch, api_key=api_key) for batch in embedding_batches(texts)
+            ])
+            vectors = np.asarray([vector for batch in batches for vector in batch], dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+            offset = 0
+            for index, doc, sentences in missing:
+                doc_vectors = vectors[offset:offset + len(sentences)]
+                offset += len(sentences)
+                self._store(content_key(doc), sentences, doc_vectors)
+                results[index] = (sentences, doc_vectors)
+
+        for index, doc, sentences in missing:
+            if not sentences:
+                results[index] = ([], np.zeros((0, 1), dtype=np.float32))
+        return results
+
+    async def compress(self, docs: List[Dict[str, Any]], query_embedding: List[float],
+                       api_key: Optional[str] = None, token_budget: int = DEFAULT_TOKEN_BUDGET,
+                       model: str = "gpt-4") -> List[Dict[str, Any]]:
+        if not docs:
+            return docs
+
+        total_tokens = sum(count_tokens(doc.get("content", ""), model) for doc in docs)
+        if total_tokens <= token_budget:
+            return docs
+
+        try:
+            per_doc = await self.sentence_vectors(docs, api_key)
+        except Exception as e:
+            logger.error(f"Context compression failed, using full documents: {e}")
+            return docs
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) + 1e-12
+
+        candidates = []
+        for doc_index, (sentences, vectors) in enumerate(per_doc):
+            if not sentences:
+                continue
+            scores = vectors @ query
+            for sentence_index, score in enumerate(scores):
+                candidates.append((float(score), doc_index, sentence_index))
+
+        candidates.sort(reverse=True)
+        selected: Dict[int, List[int]] = {}
+        used = 0
+        for score, doc_index, sentence_index in candidates:
+            tokens = count_tokens(per_doc[doc_index][0][sentence_index], model)
+            if used + tokens > token_budget:
+                continue
+            used += tokens
+            selected.setdefault(doc_index, []).append(sentence_index)
+
+        compressed = []
+        for doc_index, doc in enumerate(docs):
+            if doc_index not in selected:
+                continue
+            sentences = per_doc[doc_index][0]
+            compressed_doc = dict(doc)
+            compressed_doc["content"] = " ".join(sentences[i] for i in sorted(selected[doc_index]))
+            compressed.append(compressed_doc)
+
+        logger.info(f"Compressed retrieved context from {total_tokens} to {used} tokens")
+        return compressed
+
+
+context_compressor = ContextCompressor()
@@ -0,0 +1,555 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from bson import ObjectId
+
+from services.openai_service import OpenAIService
+from services.vector_service import VectorSearchService
+from services.retrieval_gate import retrieval_gate
+from services.googlesheets_service import GoogleSheetsService
+from services.assistant_cache import get_assistant_cache
+from services.session_store import create_session_store
+from services.conversation_summarizer import conversation_summarizer, summary_message
+from services.message_buffer import MessageBuffer
+from services.turn_scheduler import turn_scheduler, Overloaded
+from services.function_runner import function_runner
+from services.model_router import model_router
+from services.degradation import degradation_controller
+from utils.background import background_tasks
+from utils.metrics import metrics
+from utils.tokens import count_messages_tokens
+from utils.truncation import truncate_messages, summary_overflow, DEFAULT_KEEP_TURNS
+
+logger = logging.getLogger(__name__)
+timing_logger = logging.getLogger("conversation_timings")
+
+DEFAULT_ERROR_MESSAGE = "Извините, не доступен, обратитесь позже."
+DEFAULT_HELLO_MESSAGE = "Я готов консультировать!"
+NOT_CONFIGURED_MESSAGE = "Ассистент не настроен!"
+MAX_TOOL_ROUNDS = int(os.getenv("MAX_TOOL_ROUNDS", "3"))
+
+STAGES = ("load", "retrieve", "build_prompt", "route", "generate", "tools", "reply", "persist")
+
+Stage = Callable[["Turn"], Awaitable[None]]
+
+
+class Turn:
+    """
+    State of a single user message as it moves through the pipeline stages.
+    Setting `done` stops the remaining stages (e.g. the assistant is not configured).
+    The session is only changed once the turn is `committed` in the reply stage, so
+    a turn cancelled before that leaves no trace in it. `side_effects_started` is set
+    before a tool that writes outside the session runs (save_user_data, an uncached
+    endpoint); such a turn must not be superseded and rerun.
+    """
+
+    def __init__(self, user_id: str, text: str, context: Any = None):
+        self.user_id = user_id
+        self.text = text
+        self.context = context
+        self.started_at = datetime.now()
+        self.session: Dict[str, Any] = {}
+        self.new_messages: List[Dict[str, Any]] = []
+        self.config: Dict[str, Any] = {}
+        self.assistant: Optional[Dict[str, Any]] = None
+        self.kb_context = ""
+        self.messages: List[Dict[str, Any]] = []
+        self.tools: List[Dict[str, Any]] = []
+        self.model = ""
+        self.degradation = 0
+        self.response = None
+        self.content = ""
+        self.function_calls: List[Dict[str, Any]] = []
+        self.tool_rounds = 0
+        self.reply = ""
+        self.hello_task: Optional[asyncio.Task] = None
+        self.timings: Dict[str, float] = {}
+        self.store_user_message = True
+        self.committed = False
+        self.side_effects_started = False
+        self.done = False
+
+
+class ConversationEngine:
+    """
+    Channel-agnostic turn pipeline shared by the Telegram and WhatsApp bots.
+
+    A channel adapter provides transport and naming:
+      - `channel_name`: label used in metrics and logs
+      - `history_collection`: MongoDB collection for message history
+      - `user_data_sheet`: Google Sheets tab used by save_user_data
+      - `user_id_arg`: optional save_user_data argument filled with the user id
+      - `greet_new_users`: send the assistant's hello message on first contact
+      - `async send_message(user_id, text, context)`: deliver a reply
+
+    Each stage in `STAGES` is an async callable taking the `Turn`; any of them can be
+    replaced through `stages`. Every stage is timed into `conversation_stage_seconds`.
+    """
+
+    def __init__(self, db, assistant_id, channel, stages: Optional[Dict[str, Stage]] = None):
+        self.db = db
+        self.assistant_id = ObjectId(assistant_id)
+        self.channel = channel
+        self.sessions = create_session_store(
+            self.db,
+            self.load_recent_messages,
+            namespace=f"{channel.channel_name}:{self.assistant_id}",
+            name=channel.channel_name
+        )
+        self.history_index_ready = False
+        self.vector_search = VectorSearchService(self.db)
+        self.config_cache = get_assistant_cache(self.db)
+        self.message_buffer = MessageBuffer(self.run_turn, Turn, self.store_message_history, name=channel.channel_name)
+
+        self.stages: Dict[str, Stage] = {name: getattr(self, f"stage_{name}") for name in STAGES}
+        for name, stage in (stages or {}).items():
+            if name not in self.stages:
+                raise ValueError(f"Unknown conversation stage: {name}")
+            self.stages[name] = stage
+
+    async def submit(self, user_id: str, text: str, context: Any = None):
+        """
+        Entry point for channel adapters. With the assistant's `message_buffer` above 1,
+        rapid consecutive messages are coalesced into one turn; otherwise the message is
+        handled right away.
+        """
+        config = await self.config_cache.get(self.assistant_id)
+        assistant = config["assistant"] or {}
+        if (assistant.get("message_buffer") or 1) > 1 or self.message_buffer.is_active(user_id):
+            await self.message_buffer.add(user_id, text, context, assistant)
+        else:
+            await self.handle_turn(user_id, text, context)
+
+    async def handle_turn(self, user_id: str, text: str, context: Any = None) -> str:
+        return await self.run_turn(Turn(user_id, text, context))
+
+    async def run_turn(self, turn: Turn) -> str:
+        user_id = turn.user_id
+        context = turn.context
+        channel = self.channel.channel_name
+        try:
+            # Turns of one chat run in order; they queue here rather than racing on the session
+            async with turn_scheduler.chat(f"{channel}:{self.assistant_id}:{user_id}"):
+                with metrics.timer("conversation_turn_seconds", channel=channel):
+                    for name in STAGES:
+                        if turn.done:
+                            break
+                        with metrics.timer("conversation_stage_seconds", channel=channel, stage=name) as timer:
+                            await self.stages[name](turn)
+                        turn.timings[name] = round(timer.elapsed, 4)
+        except Exception as e:
+            if isinstance(e, Overloaded):
+                logger.warning(f"Shedding {channel} message from {user_id}: {e.reason}")
+                if turn.assistant is None:
+                    try:
+                        turn.assistant = (await self.config_cache.get(self.assistant_id))["assistant"]
+                    except Exception as config_error:
+                        logger.error(f"Error loading assistant for shed reply: {str(config_error)}")
+            else:
+                logger.error(f"Error processing {channel} message: {str(e)}")
+                metrics.inc("conversation_errors_total", channel=channel)
+            await self.finish_hello(turn)
+            turn.reply = (turn.assistant or {}).get("error_message", DEFAULT_ERROR_MESSAGE)
+            await self.channel.send_message(user_id, turn.reply, context)
+            background_tasks.spawn(
+                self.store_message_history(user_id, turn.reply, "bot"),
+                name=f"{channel}_store_bot_message"
+            )
+
+        timing_logger.info(json.dumps({
+            "channel": channel,
+            "assistant_id": str(self.assistant_id),
+            "user_id": user_id,
+            "degradation": turn.degradation,
+            "timings": turn.timings
+        }))
+        return turn.reply
+
+    async def stage_load(self, turn: Turn):
+        # Cached assistant config and the session are read concurrently with the history write
+        turn.config, (turn.session, is_new), _ = await asyncio.gather(
+            self.config_cache.get(self.assistant_id),
+            self.sessions.get(turn.user_id, before=turn.started_at),
+            self.store_message_history(turn.user_id, turn.text, "user") if turn.store_user_message else asyncio.sleep(0)
+        )
+        turn.assistant = turn.config["assistant"]
+
+        if not turn.assistant:
+            turn.reply = NOT_CONFIGURED_MESSAGE
+            await self.channel.send_message(turn.user_id, turn.reply, turn.context)
+            turn.done = True
+            return
+
+        # Degradation is decided once per turn from the assistant's own model latency
+        turn.degradation = degradation_controller.level(turn.assistant.get("model", "gpt-4"))
+
+        if is_new and self.channel.greet_new_users:
+            # Greeting goes out while retrieval and generation run; awaited before the reply to keep order
+            turn.hello_task = asyncio.create_task(self.channel.send_message(
+                turn.user_id, turn.assistant.get("hello_message", DEFAULT_HELLO_MESSAGE), turn.context
+            ))
+
+    async def stage_retrieve(self, turn: Turn):
+        # Knowledge base context, unless the retrieval gate decides to reuse or skip it
+        turn.kb_context = await retrieval_gate.retrieve(
+            self.vector_search,
+            turn.text,
+            turn.assistant,
+            turn.session["retrieval"],
+            limit=degradation_controller.kb_limit(3, turn.degradation)
+        )
+
+    async def stage_build_prompt(self, turn: Turn):
+        """
+        Assemble the prompt so provider-side prompt caching can reuse its prefix: the
+        instructions (and tools) come first and stay byte-identical between turns, then the
+        running summary and the dialogue; this turn's knowledge base context goes last.
+        """
+        turn.new_messages.append({"role": "user", "content": turn.text})
+
+        prefix = []
+        instructions = turn.assistant.get("instructions", "")
+        if instructions:
+            prefix.append({"role": "system", "content": instructions})
+        summary = turn.session.get("summary")
+        if summary:
+            prefix.append(summary_message(summary))
+        suffix = [{"role": "system", "content": turn.kb_context}] if turn.kb_context else []
+
+        # The dialogue is a truncated copy; the session itself changes when the turn commits
+        dialogue = [message for message in turn.session["messages"] if message.get("role") != "system"]
+        dialogue += turn.new_messages
+        assistant = turn.assistant
+        if turn.degradation:
+            assistant = {**assistant, "truncation_strategy": degradation_controller.truncation_strategy(
+                assistant.get("truncation_strategy"), turn.degradation
+            )}
+        self.truncate_conversation_history(dialogue, assistant, prefix + suffix)
+        turn.messages = prefix + dialogue + suffix
+        turn.tools = turn.config["tools"].tools
+
+    async def stage_route(self, turn: Turn):
+        kb_scores = turn.session["retrieval"].get("kb_scores") if turn.kb_context else None
+        turn.model = model_router.route(turn.text, turn.assistant, kb_scores, bool(turn.tools))
+
+    async def stage_generate(self, turn: Turn):
+        await self.generate(turn)
+
+    async def stage_tools(self, turn: Turn):
+        # Tool results go back to the model until it answers without calling tools
+        while turn.function_calls and turn.tool_rounds < MAX_TOOL_ROUNDS:
+            turn.tool_rounds += 1
+            calls = turn.function_calls
+            tool_results = await self.execute_tool_calls(turn, calls)
+
+            turn.messages = turn.messages + [{
+                "role": "assistant",
+                "content": turn.content or None,
+                "tool_calls": [
+                    {"id": call["id"], "type": "function",
+                     "function": {"name": call["name"], "arguments": call["arguments"]}}
+                    for call in calls
+                ]
+            }] + [
+                {"role": "tool", "tool_call_id": call["id"], "content": result}
+                for call, result in zip(calls, tool_results)
+            ]
+            await self.generate(turn)
+
+        if turn.tool_rounds:
+            metrics.observe("tool_rounds", turn.tool_rounds, channel=self.channel.channel_name)
+        if turn.function_calls:
+            logger.warning(f"Tool loop for {turn.user_id} stopped after {MAX_TOOL_ROUNDS} rounds")
+            metrics.inc("tool_loop_exhausted_total", channel=self.channel.channel_name)
+            if not turn.content:
+                # Ask for an answer from the results so far; raw tool output never reaches the user
+                await self.generate(turn, tool_choice="none")
+        if not turn.reply:
+            turn.reply = turn.assistant.get("error_message", DEFAULT_ERROR_MESSAGE)
+
+    async def generate(self, turn: Turn, tool_choice: str = "auto"):
+        assistant = turn.assistant
+        openai_service = OpenAIService(api_key=assistant.get("openai_id"))
+
+        model = degradation_controller.model(turn.model or assistant.get("model", "gpt-4"), turn.degradation)
+
+        def observe_latency(seconds: float, response):
+            # Provider time of each attempt; a timed-out attempt has no response and no usage
+            usage = getattr(response, "usage", None)
+            degradation_controller.observe(model, seconds, getattr(usage, "completion_tokens", 0) or 0)
+
+        async with turn_scheduler.generation(str(self.assistant_id), assistant.get("scheduling")):
+            turn.response = await openai_service.generate_response(
+                messages=turn.messages,
+                model=model,
+                temperature=assistant.get("temperature", 0.7),
+                max_tokens=degradation_controller.max_tokens(assistant.get("max_tokens", 2000), turn.degradation),
+                functions=turn.tools if turn.tools else None,
+                tool_choice=tool_choice,
+                on_response=observe_latency
+            )
+
+        self.record_usage(turn.response)
+        processed_response = await openai_service.process_function_calls(turn.response)
+        turn.content = processed_response["content"] or ""
+        turn.function_calls = processed_response["function_calls"]
+        turn.reply = turn.content
+
+    async def stage_reply(self, turn: Turn):
+        turn.committed = True
+        turn.new_messages.append({"role": "assistant", "content": turn.reply})
+        session = turn.session["messages"]
+        if any(message.get("role") == "system" for message in session):
+            # Sessions from before the cache-friendly layout still hold per-turn system messages
+            session[:] = [message for message in session if message.get("role") != "system"]
+        session.extend(turn.new_messages)
+        truncate_messages(session, turn.assistant.get("truncation_strategy"), turn.assistant.get("model", "gpt-4"))
+        await self.finish_hello(turn)
+        await self.channel.send_message(turn.user_id, turn.reply, turn.context)
+        await self.sessions.save(turn.user_id, turn.session, turn.new_messages)
+
+    async def stage_persist(self, turn: Turn):
+        # Bookkeeping happens after the reply is sent and does not delay it
+        channel = self.channel.channel_name
+        background_tasks.spawn(
+            self.store_message_history(turn.user_id, turn.reply, "bot"),
+            name=f"{channel}_store_bot_message"
+        )
+        background_tasks.spawn(
+            self.store_conversation_to_sheets(turn.config["conversation_integration"], turn.user_id, turn.text, turn.reply),
+            name=f"{channel}_store_conversation_to_sheets"
+        )
+
+        strategy = turn.assistant.get("truncation_strategy") or {}
+        if strategy.get("type") == "summarize":
+            key = (channel, str(self.assistant_id), turn.user_id)
+            if key not in conversation_summarizer.running and \
+                    summary_overflow(turn.session["messages"], strategy.get("keep_turns", DEFAULT_KEEP_TURNS)):
+                conversation_summarizer.running.add(key)
+                task = background_tasks.spawn(
+                    self.update_summary(turn.user_id, turn.session, turn.assistant, strategy),
+                    name=f"{channel}_update_summary"
+                )
+                task.add_done_callback(lambda _: conversation_summarizer.running.discard(key))
+
+    async def update_summary(self, user_id: str, session: Dict[str, Any], assistant: Dict[str, Any],
+                             strategy: Dict[str, Any]):
+        messages = session["messages"]
+        overflow = messages[:summary_overflow(messages, strategy.get("keep_turns", DEFAULT_KEEP_TURNS))]
+        if not overflow:
+            return
+
+        summary = await conversation_summarizer.summarize(
+            session.get("summary", ""),
+            overflow,
+            api_key=assistant.get("openai_id"),
+            model=strategy.get("summary_model")
+        )
+
+        # Newer turns are only appended at the end; fold the summarized prefix if it is unchanged
+        if not await self.sessions.fold_summary(user_id, overflow, summary):
+            logger.info(f"Session of {user_id} changed while summarizing, summary discarded")
+
+    async def finish_hello(self, turn: Turn):
+        if turn.hello_task is None:
+            return
+        try:
+            await turn.hello_task
+        except Exception as e:
+            logger.error(f"Error sending hello message: {str(e)}")
+        turn.hello_task = None
+
+    def record_usage(self, response):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        assistant_id = str(self.assistant_id)
+        prompt_tokens = usage.prompt_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+        metrics.inc("openai_prompt_tokens_total", prompt_tokens, assistant_id=assistant_id)
+        metrics.inc("openai_cached_tokens_total", cached_tokens, assistant_id=assistant_id)
+        if prompt_tokens:
+            metrics.observe("openai_cached_token_ratio", cached_tokens / prompt_tokens, assistant_id=assistant_id)
+
+    async def execute_tool_calls(self, turn: Turn, calls: List[Dict[str, Any]]) -> List[str]:
+        """Run the tool calls of one model response concurrently; results keep the call order."""
+        function_docs = {doc.get("name"): doc for doc in turn.config["function_docs"]}
+        # Parallel save_user_data calls would race on the same sheet row
+        sheet_lock = asyncio.Lock()
+        return await asyncio.gather(*[
+            self.execute_tool_call(turn, call, function_docs.get(call["name"]), sheet_lock) for call in calls
+        ])
+
+    async def execute_tool_call(self, turn: Turn, call: Dict[str, Any], function_doc: Optional[Dict[str, Any]],
+                                sheet_lock: asyncio.Lock) -> str:
+        func_name = call["name"]
+        status = "ok"
+        with metrics.timer("tool_call_seconds", tool=func_name):
+            try:
+                args = json.loads(call["arguments"] or "{}")
+
+                if func_name == "save_user_data":
+                    turn.side_effects_started = True
+                    async with sheet_lock:
+                        result = await asyncio.wait_for(
+                            self.process_save_user_data(turn.user_id, "", args, turn.config),
+                            function_runner.timeout(None)
+                        )
+                elif function_doc is not None:
+                    if function_runner.has_side_effects(function_doc):
+                        turn.side_effects_started = True
+                    result = await asyncio.wait_for(
+                        function_runner.call(function_doc, args),
+                        function_runner.timeout(function_doc)
+                    )
+                else:
+                    status = "error"
+                    result = f"Ошибка: функция {func_name} не найдена"
+
+            except asyncio.TimeoutError:
+                status = "timeout"
+                logger.error(f"Function call {func_name} timed out")
+                result = f"Функция вызвана: {func_name} (ошибка: превышено время ожидания)"
+            except Exception as e:
+                status = "error"
+                logger.error(f"Error processing function call: {str(e)}")
+                result = f"Функция вызвана: {func_name} (ошибка: {str(e)})"
+
+        metrics.inc("tool_calls_total", tool=func_name, status=status)
+        return result
+
+    async def process_save_user_data(self, user_id: str, content: str, args: Dict[str, Any],
+                                     config: Dict[str, Any]) -> str:
+        """
+        Upsert the user's row in the channel's user data sheet: the header is
+        `user_id`, `updated_at` followed by the configured schema entities.
+        """
+        prefix = f"{content} \n" if content else ""
+        try:
+            save_user_data_config = config["save_user_data"]
+            if not save_user_data_config:
+                return f"{prefix}Ошибка: функция save_user_data не настроена"
+
+            sheets_integration = config["user_data_integration"]
+            if not sheets_integration:
+                return "Ошибка: Google Sheets интеграция не настроена"
+
+            try:
+                sheets_service = GoogleSheetsService(
+                    sheets_integration.get("credentials_json"),
+                    sheets_integration.get("spreadsheet_id")
+                )
+            except Exception as e:
+                logger.error(f"Error initializing Google Sheets service: {str(e)}")
+                return f"Ошибка инициализации Google Sheets: {str(e)}"
+
+            try:
+                sheet = self.channel.user_data_sheet
+                user_id_arg = self.channel.user_id_arg
+                if user_id_arg and user_id_arg not in args:
+                    args[user_id_arg] = user_id
+
+                data = await sheets_service.read_data(f"{sheet}!A:Z")
+                schema_header = ["user_id", "updated_at"] + list(save_user_data_config.get("schema", {}).keys())
+
+                existing_row = None
+                row_number = None
+                if not data:
+                    header = schema_header
+                    await sheets_service.write_data(f"{sheet}!A1", [header])
+                else:
+                    header = data[0]
+                    if len(header) < 2 or header[0] != "user_id" or header[1] != "updated_at":
+                        header = schema_header
+                        await sheets_service.write_data(f"{sheet}!A1", [header])
+
+                    for i, row in enumerate(data[1:], 2):  # Sheet rows are 1-based and row 1 is the header
+                        if row and str(row[0]) == str(user_id):
+                            existing_row = row
+                            row_number = i
+                            break
+
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+                if existing_row:
+                    row = {header[i]: existing_row[i] if i < len(existing_row) else "" for i in range(len(header))}
+                else:
+                    row = {}
+                row.update({k: str(v) for k, v in args.items()})
+                row["user_id"] = user_id
+                row["updated_at"] = timestamp
+                row_data = [row.get(col, "") for col in header]
+
+                if existing_row:
+                    await sheets_service.write_data(f"{sheet}!A{row_number}", [row_data])
+                    return f"{prefix}Данные пользователя обновлены!"
+
+                await sheets_service.append_data(f"{sheet}!A:Z", [row_data])
+                return f"{prefix}Данные пользователя сохранены!"
+
+            except Exception as sheet_error:
+                logger.error(f"Error working with Google Sheets: {str(sheet_error)}")
+                return f"Ошибка при работе с Google Sheets: {str(sheet_error)}"
+
+        except Exception as e:
+            logger.error(f"Error processing save_user_data: {str(e)}")
+            return f"Ошибка сохранения данных пользователя: {str(e)}"
+
+    def truncate_conversation_history(self, messages: List[Dict[str, Any]], assistant: Dict[str, Any],
+                                      fixed_messages: Optional[List[Dict[str, Any]]] = None):
+        model = assistant.get("model", "gpt-4")
+        reserved_tokens = count_messages_tokens(fixed_messages or [], model)
+        truncate_messages(messages, assistant.get("truncation_strategy"), model, reserved_tokens)
+        metrics.observe("conversation_prompt_tokens", reserved_tokens + count_messages_tokens(messages, model),
+                        channel=self.channel.channel_name)
+
+    async def store_conversation_to_sheets(self, sheets_integration: Optional[Dict[str, Any]], user_id: str,
+                                           user_message: str, bot_response: str):
+        try:
+            if not sheets_integration:
+                return
+
+            sheets_service = GoogleSheetsService(
+                sheets_integration.get("credentials_json"),
+                sheets_integration.get("spreadsheet_id")
+            )
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            await sheets_service.append_data(
+                "Conversations!A1:D1000",
+                [[timestamp, user_id, user_message, bot_response]]
+            )
+        except Exception as e:
+            logger.error(f"Error storing conversation to sheets: {str(e)}")
+
+    async def store_message_history(self, user_id: str, message: str, message_type: str):
+        try:
+            await self.db[self.channel.history_collection].insert_one({
+                "user_id": user_id,
+                "message": message,
+                "message_type": message_type,
+                "timestamp": datetime.now(),
+                "assistant_id": self.assistant_id
+            })
+        except Exception as e:
+            logger.error(f"Error storing message history: {str(e)}")
+
+    async def get_user_history(self, user_id: str, limit: int = 50) -> list:
+        cursor = self.db[self.channel.history_collection].find({"user_id": user_id}).sort("timestamp", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def load_recent_messages(self, user_id: str, limit: int, before: datetime) -> list:
+        collection = self.db[self.channel.history_collection]
+        if not self.history_index_ready:
+            await collection.create_index([("user_id", 1), ("assistant_id", 1), ("timestamp", -1)])
+            self.history_index_ready = True
+        cursor = collection.find({
+            "user_id": user_id,
+            "assistant_id": self.assistant_id,
+            "timestamp": {"$lt": before}
+        }).sort("timestamp", -1).limit(limit)
+        return await cursor.to_list(length=limit)
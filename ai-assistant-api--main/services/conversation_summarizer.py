@@ -0,0 +1,58 @@
+import os
+import logging
+from typing import Any, Dict, List, Optional
+from services.openai_service import OpenAIService
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткое резюме диалога консультанта с клиентом. Обнови резюме с учётом новых сообщений. "
+    "Обязательно сохрани имя клиента и ребёнка, возраст, контакты, выбранные даты, время и услуги, "
+    "а также все договорённости и открытые вопросы. Пиши кратко, списком фактов, без приветствий."
+)
+SUMMARY_HEADER = "Краткое содержание предыдущей части разговора:"
+
+
+def summary_message(summary: str) -> Dict[str, str]:
+    return {"role": "system", "content": f"{SUMMARY_HEADER}\n{summary}"}
+
+
+class ConversationSummarizer:
+    """
+    Folds turns that fall out of the verbatim window into a running summary using a
+    cheaper model. Runs in the background after the reply has been sent.
+    """
+
+    def __init__(self, model: str = SUMMARY_MODEL):
+        self.model = model
+        self.running = set()
+
+    async def summarize(self, previous_summary: str, messages: List[Dict[str, Any]],
+                        api_key: Optional[str], model: Optional[str] = None) -> str:
+        # Per-turn system messages only carry instructions and KB context, not dialogue
+        dialogue = "\n".join(
+            f"{'Клиент' if message['role'] == 'user' else 'Консультант'}: {message.get('content') or ''}"
+            for message in messages if message.get("role") in ("user", "assistant")
+        )
+        if not dialogue:
+            return previous_summary
+
+        openai_service = OpenAIService(api_key=api_key)
+        with metrics.timer("conversation_summary_seconds"):
+            response = await openai_service.generate_response(
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Текущее резюме:\n{previous_summary or '(пусто)'}\n\nНовые сообщения:\n{dialogue}"}
+                ],
+                model=model or self.model,
+                temperature=0,
+                max_tokens=SUMMARY_MAX_TOKENS
+            )
+        metrics.inc("conversation_summaries_total")
+        return (response.choices[0].message.content or "").strip() or previous_summary
+
+
+conversation_summarizer = ConversationSummarizer()
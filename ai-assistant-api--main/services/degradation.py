@@ -0,0 +1,141 @@
+import os
+import time
+import logging
+from collections import deque
+from typing import Any, Dict, Optional
+from utils.metrics import metrics
+from utils.truncation import DEFAULT_TRUNCATION_STRATEGY, DEFAULT_MAX_TOKENS, DEFAULT_KEEP_TURNS
+
+logger = logging.getLogger(__name__)
+
+DEGRADATION_ENABLED = os.getenv("DEGRADATION_ENABLED", "false").lower() in ("1", "true", "yes")
+# Seconds per completion token; 0.1 is 10 tokens/s
+GENERATION_TOKEN_LATENCY_SLO = float(os.getenv("GENERATION_TOKEN_LATENCY_SLO", "0.1"))
+# Short answers are judged as if they had this many tokens, so fixed per-request overhead
+# (prompt processing, network) does not make them look slow
+DEGRADATION_MIN_TOKENS = int(os.getenv("DEGRADATION_MIN_TOKENS", "50"))
+DEGRADATION_PERCENTILE = float(os.getenv("DEGRADATION_PERCENTILE", "0.9"))
+DEGRADATION_WINDOW = float(os.getenv("DEGRADATION_WINDOW", "60"))
+DEGRADATION_MIN_SAMPLES = int(os.getenv("DEGRADATION_MIN_SAMPLES", "5"))
+DEGRADATION_COOLDOWN = float(os.getenv("DEGRADATION_COOLDOWN", "30"))
+# Step back up once the percentile is below this share of the SLO
+DEGRADATION_RECOVERY_RATIO = float(os.getenv("DEGRADATION_RECOVERY_RATIO", "0.6"))
+DEGRADED_CONTEXT_FACTOR = 0.5
+DEGRADED_KB_LIMIT = 1
+DEGRADED_MAX_TOKENS = int(os.getenv("DEGRADED_MAX_TOKENS", "500"))
+DEGRADED_FALLBACK_MODEL = os.getenv("DEGRADED_FALLBACK_MODEL", "gpt-4o-mini")
+
+# Levels are cumulative: each one keeps the measures of the levels below it
+NORMAL = 0
+TRIM_CONTEXT = 1
+FEWER_DOCS = 2
+SHORT_ANSWERS = 3
+FALLBACK_MODEL = 4
+LEVEL_NAMES = ("normal", "trim_context", "fewer_docs", "short_answers", "fallback_model")
+
+
+class _ModelState:
+    def __init__(self):
+        self.samples = deque()
+        self.level = NORMAL
+        self.changed_at = 0.0
+
+
+class DegradationController:
+    """
+    Watches recent generation latencies per model and trades answer quality for speed
+    while a model is slow. Latency is the provider's time per completion token (at least
+    `DEGRADATION_MIN_TOKENS`), so long answers do not count as slow ones. When its
+    `DEGRADATION_PERCENTILE` over the last `DEGRADATION_WINDOW` seconds exceeds
+    `GENERATION_TOKEN_LATENCY_SLO`, the model moves one level down (trim history, fewer knowledge base documents, shorter answers, fallback
+    model); once it is back under `DEGRADATION_RECOVERY_RATIO` of the SLO, or it had no
+    samples for a whole window (e.g. all turns use the fallback model), it moves one level up.
+    Levels change at most once per `DEGRADATION_COOLDOWN` seconds.
+    """
+
+    def __init__(self, enabled: bool = DEGRADATION_ENABLED, slo: float = GENERATION_TOKEN_LATENCY_SLO):
+        self.enabled = enabled
+        self.slo = slo
+        self.models: Dict[str, _ModelState] = {}
+
+    def state(self, model: str) -> _ModelState:
+        state = self.models.get(model)
+        if state is None:
+            state = self.models[model] = _ModelState()
+        return state
+
+    def observe(self, model: str, seconds: float, completion_tokens: int = 0):
+        """Record one provider call that took `seconds` and produced `completion_tokens`."""
+        if not self.enabled:
+            return
+        state = self.state(model)
+        state.samples.append((time.monotonic(), seconds / max(completion_tokens, DEGRADATION_MIN_TOKENS)))
+        self.evaluate(model, state)
+
+    def level(self, model: str) -> int:
+        if not self.enabled:
+            return NORMAL
+        state = self.state(model)
+        self.evaluate(model, state)
+        return state.level
+
+    def evaluate(self, model: str, state: _ModelState):
+        now = time.monotonic()
+        while state.samples and now - state.samples[0][0] > DEGRADATION_WINDOW:
+            state.samples.popleft()
+        if now - state.changed_at < DEGRADATION_COOLDOWN:
+            return
+
+        if not state.samples:
+            # Probe back up if the model has been idle for a whole window at this level
+            if state.level > NORMAL and now - state.changed_at >= DEGRADATION_WINDOW:
+                self.set_level(model, state, state.level - 1, "no_recent_samples")
+            return
+        if len(state.samples) < DEGRADATION_MIN_SAMPLES:
+            return
+
+        ordered = sorted(latency for _, latency in state.samples)
+        latency = ordered[min(len(ordered) - 1, int(DEGRADATION_PERCENTILE * len(ordered)))]
+        reason = f"p{int(DEGRADATION_PERCENTILE * 100)}={latency * 1000:.0f}ms/token"
+        if latency > self.slo and state.level < FALLBACK_MODEL:
+            self.set_level(model, state, state.level + 1, reason)
+        elif latency < self.slo * DEGRADATION_RECOVERY_RATIO and state.level > NORMAL:
+            self.set_level(model, state, state.level - 1, reason)
+
+    def set_level(self, model: str, state: _ModelState, level: int, reason: str):
+        direction = "down" if level > state.level else "up"
+        logger.warning(f"Degradation level for {model}: {LEVEL_NAMES[state.level]} -> {LEVEL_NAMES[level]} ({reason})")
+        state.level = level
+        state.changed_at = time.monotonic()
+        # Judge the new level on its own latencies
+        state.samples.clear()
+        metrics.set_gauge("degradation_level", level, model=model)
+        metrics.inc("degradation_level_changes_total", model=model, direction=direction)
+
+    @staticmethod
+    def truncation_strategy(strategy: Optional[Dict[str, Any]], level: int) -> Optional[Dict[str, Any]]:
+        if level < TRIM_CONTEXT:
+            return strategy
+        strategy = dict(strategy or DEFAULT_TRUNCATION_STRATEGY)
+        if strategy.get("type") == "max_tokens":
+            strategy["max_tokens"] = int(strategy.get("max_tokens", DEFAULT_MAX_TOKENS) * DEGRADED_CONTEXT_FACTOR)
+        elif strategy.get("type") == "summarize":
+            strategy["keep_turns"] = max(1, int(strategy.get("keep_turns", DEFAULT_KEEP_TURNS) * DEGRADED_CONTEXT_FACTOR))
+        else:
+            strategy["last_messages"] = max(1, int(strategy.get("last_messages", 10) * DEGRADED_CONTEXT_FACTOR))
+        return strategy
+
+    @staticmethod
+    def kb_limit(limit: int, level: int) -> int:
+        return min(limit, DEGRADED_KB_LIMIT) if level >= FEWER_DOCS else limit
+
+    @staticmethod
+    def max_tokens(max_tokens: int, level: int) -> int:
+        return min(max_tokens, DEGRADED_MAX_TOKENS) if level >= SHORT_ANSWERS else max_tokens
+
+    @staticmethod
+    def model(model: str, level: int) -> str:
+        return DEGRADED_FALLBACK_MODEL if level >= FALLBACK_MODEL else model
+
+
+degradation_controller = DegradationController()
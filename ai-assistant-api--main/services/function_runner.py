@@ -0,0 +1,129 @@
+import os
+import time
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+import httpx
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "10"))
+TOOL_RESULT_MAX_CHARS = int(os.getenv("TOOL_RESULT_MAX_CHARS", "4000"))
+FUNCTION_CACHE_MAX_ENTRIES = int(os.getenv("FUNCTION_CACHE_MAX_ENTRIES", "1000"))
+
+
+def cache_key(function_doc: Dict[str, Any], args: Dict[str, Any]) -> Tuple[str, ...]:
+    """
+    Results are shared per assistant and function version; arguments are canonicalized so
+    {"a": 1, "b": 2} and {"b": 2, "a": 1} hit the same entry.
+    """
+    return (
+        str(function_doc.get("assistant_id")),
+        str(function_doc.get("_id")),
+        str(function_doc.get("updated_at") or function_doc.get("created_at")),
+        function_doc.get("endpoint") or "",
+        json.dumps(args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    )
+
+
+class FunctionRunner:
+    """
+    Executes custom functions for the tool loop. A function with an `endpoint` is called
+    with its arguments as a JSON POST body and the response body is returned to the model;
+    a function without one only acknowledges the call. One pooled HTTP client is shared by
+    all assistants.
+
+    Functions with a positive `cache_ttl` are memoized for that many seconds in a bounded
+    LRU cache; concurrent identical calls share one execution. Failures are not cached.
+    """
+
+    def __init__(self, max_entries: int = FUNCTION_CACHE_MAX_ENTRIES):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.max_entries = max_entries
+        self.cache: "OrderedDict[Tuple[str, ...], Tuple[str, float]]" = OrderedDict()
+        self.inflight: Dict[Tuple[str, ...], asyncio.Future] = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+        return self.client
+
+    @staticmethod
+    def timeout(function_doc: Optional[Dict[str, Any]]) -> float:
+        return float((function_doc or {}).get("timeout") or TOOL_TIMEOUT)
+
+    @staticmethod
+    def has_side_effects(function_doc: Dict[str, Any]) -> bool:
+        # Cached functions are declared safe to replay; functions without an endpoint do nothing
+        return bool(function_doc.get("endpoint")) and float(function_doc.get("cache_ttl") or 0) <= 0
+
+    async def call(self, function_doc: Dict[str, Any], args: Dict[str, Any]) -> str:
+        ttl = float(function_doc.get("cache_ttl") or 0)
+        if ttl <= 0:
+            return await self.execute(function_doc, args)
+
+        name = function_doc.get("name")
+        key = cache_key(function_doc, args)
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self.cache.move_to_end(key)
+                metrics.inc("function_cache_requests_total", function=name, result="hit")
+                return entry[0]
+            del self.cache[key]
+
+        future = self.inflight.get(key)
+        if future is None:
+            metrics.inc("function_cache_requests_total", function=name, result="miss")
+            future = asyncio.ensure_future(self.execute_and_store(key, function_doc, args, ttl))
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self.on_execution_done(key, done))
+        else:
+            metrics.inc("function_cache_requests_total", function=name, result="coalesced")
+        # A caller timing out must not cancel the execution other callers are waiting for
+        return await asyncio.shield(future)
+
+    async def execute_and_store(self, key: Tuple[str, ...], function_doc: Dict[str, Any],
+                                args: Dict[str, Any], ttl: float) -> str:
+        result = await self.execute(function_doc, args)
+        self.cache[key] = (result, time.monotonic() + ttl)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+        metrics.set_gauge("function_cache_entries", len(self.cache))
+        return result
+
+    def on_execution_done(self, key: Tuple[str, ...], future: asyncio.Future):
+        self.inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is not None:
+            # Retrieved here so an execution whose callers all timed out does not warn
+            logger.debug(f"Function execution failed: {future.exception()}")
+
+    async def execute(self, function_doc: Dict[str, Any], args: Dict[str, Any]) -> str:
+        name = function_doc.get("name")
+        endpoint = function_doc.get("endpoint")
+        if not endpoint:
+            args_str = ", ".join([f"{k}={v}" for k, v in args.items()])
+            return f"Функция вызвана: {name}({args_str})"
+
+        response = await self.get_client().post(endpoint, json=args, timeout=self.timeout(function_doc))
+        response.raise_for_status()
+        try:
+            result = json.dumps(response.json(), ensure_ascii=False)
+        except ValueError:
+            result = response.text
+        if len(result) > TOOL_RESULT_MAX_CHARS:
+            logger.warning(f"Result of function {name} truncated from {len(result)} characters")
+            result = result[:TOOL_RESULT_MAX_CHARS]
+        return result
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+function_runner = FunctionRunner()
@@ -0,0 +1,210 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+from utils.document_parser import parse_document, chunk_section
+from utils.metrics import metrics
+from services.vector_sync_worker import new_sync_state
+
+logger = logging.getLogger(__name__)
+
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", str(os.cpu_count() or 2)))
+INSERT_BATCH_SIZE = 100
+INTERRUPTED_ERROR = "Interrupted by a restart"
+
+
+class IngestionService:
+    """
+    Runs file upload jobs: files are parsed in a process pool, sections are chunked as each
+    file finishes, and chunks are written to MongoDB in batches with a pending `vector_sync`
+    entry so the sync worker embeds and indexes them in batches.
+
+    Uploaded files are only held in memory, so jobs left queued or running by a previous
+    process cannot be resumed; `start` marks them as failed.
+    """
+
+    def __init__(self, db, title_index, sync_worker):
+        self.db = db
+        self.title_index = title_index
+        self.sync_worker = sync_worker
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.tasks = set()
+        self.indexes_ready = False
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=INGESTION_WORKERS)
+        return self.executor
+
+    def spawn(self, coro) -> asyncio.Task:
+        # The event loop only keeps weak references to tasks
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def start(self):
+        self.spawn(self.fail_interrupted_jobs(datetime.now()))
+
+    async def fail_interrupted_jobs(self, started_at: datetime):
+        try:
+            jobs = await self.db.ingestion_jobs.find({
+                "status": {"$in": ["queued", "running"]},
+                "created_at": {"$lt": started_at}
+            }).to_list(None)
+            for job in jobs:
+                files = job.get("files") or []
+                for file in files:
+                    if file.get("status") == "queued":
+                        file["status"] = "failed"
+                        file["error"] = INTERRUPTED_ERROR
+                parsed = sum(1 for file in files if file.get("status") == "parsed")
+                now = datetime.now()
+                await self.db.ingestion_jobs.update_one(
+                    {"_id": job["_id"], "status": job["status"]},
+                    {"$set": {
+                        "status": "completed_with_errors" if parsed else "failed",
+                        "files": files,
+                        "finished_at": now,
+                        "updated_at": now
+                    }}
+                )
+            if jobs:
+                logger.warning(f"Marked {len(jobs)} interrupted ingestion jobs as failed")
+        except Exception as e:
+            logger.error(f"Error recovering interrupted ingestion jobs: {e}")
+
+    async def shutdown(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def start_job(self, assistant_id: Optional[str], files: List[Tuple[str, bytes]],
+                        metadata: Optional[Dict[str, Any]] = None) -> str:
+        if not self.indexes_ready:
+            await self.db.knowledge_texts.create_index("metadata.ingestion_job_id", sparse=True)
+            self.indexes_ready = True
+        
+        job = {
+            "assistant_id": assistant_id,
+            "status": "queued",
+            "files": [{"name": name, "status": "queued", "sections": 0, "chunks": 0, "error": None} for name, _ in files],
+            "files_total": len(files),
+            "files_parsed": 0,
+            "chunks_inserted": 0,
+            "created_at": datetime.now(),
+            "updated_at": None,
+            "finished_at": None
+        }
+        result = await self.db.ingestion_jobs.insert_one(job)
+        job_id = str(result.inserted_id)
+
+        self.spawn(self.run_job(job_id, assistant_id, files, metadata or {}))
+        return job_id
+
+    async def run_job(self, job_id: str, assistant_id: Optional[str], files: List[Tuple[str, bytes]],
+                      metadata: Dict[str, Any]):
+        job_oid = ObjectId(job_id)
+        await self.db.ingestion_jobs.update_one({"_id": job_oid}, {"$set": {"status": "running", "updated_at": datetime.now()}})
+
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        futures = {
+            asyncio.ensure_future(loop.run_in_executor(executor, parse_document, name, data)): (index, name)
+            for index, (name, data) in enumerate(files)
+        }
+
+        failed = 0
+        pending = set(futures)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                index, name = futures[future]
+                try:
+                    with metrics.timer("ingestion_file_seconds"):
+                        sections = future.result()
+                        inserted = await self.store_sections(job_id, assistant_id, name, sections, metadata)
+                    await self.db.ingestion_jobs.update_one({"_id": job_oid}, {
+                        "$set": {
+                            f"files.{index}.status": "parsed",
+                            f"files.{index}.sections": len(sections),
+                            f"files.{index}.chunks": inserted,
+                            "updated_at": datetime.now()
+                        },
+                        "$inc": {"files_parsed": 1, "chunks_inserted": inserted}
+                    })
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Ingestion of {name} failed in job {job_id}: {e}")
+                    await self.db.ingestion_jobs.update_one({"_id": job_oid}, {
+                        "$set": {
+                            f"files.{index}.status": "failed",
+                            f"files.{index}.error": str(e),
+                            "updated_at": datetime.now()
+                        },
+                        "$inc": {"files_parsed": 1}
+                    })
+
+        status = "completed" if not failed else ("failed" if failed == len(files) else "completed_with_errors")
+        await self.db.ingestion_jobs.update_one({"_id": job_oid}, {
+            "$set": {"status": status, "finished_at": datetime.now(), "updated_at": datetime.now()}
+        })
+        logger.info(f"Ingestion job {job_id} finished with status {status}")
+
+    async def store_sections(self, job_id: str, assistant_id: Optional[str], filename: str,
+                             sections: List[Dict[str, str]], metadata: Dict[str, Any]) -> int:
+        inserted = 0
+        batch: List[Dict[str, Any]] = []
+        chunk_number = 0
+
+        async def flush():
+            nonlocal inserted, batch
+            if not batch:
+                return
+            result = await self.db.knowledge_texts.insert_many(batch)
+            for doc, doc_id in zip(batch, result.inserted_ids):
+                self.title_index.add(str(doc_id), doc["title"], assistant_id)
+            inserted += len(batch)
+            batch = []
+            self.sync_worker.notify()
+
+        for section in sections:
+            for chunk in chunk_section(section):
+                chunk_number += 1
+                batch.append({
+                    "title": chunk["title"],
+                    "content": chunk["content"],
+                    "metadata": {
+                        **metadata,
+                        "source_file": filename,
+                        "chunk": chunk_number,
+                        "ingestion_job_id": job_id
+                    },
+                    "assistant_id": assistant_id,
+                    "created_at": datetime.now(),
+                    "updated_at": None,
+                    "vector_sync": new_sync_state()
+                })
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    await flush()
+        await flush()
+
+        metrics.inc("ingestion_chunks_total", inserted)
+        return inserted
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await self.db.ingestion_jobs.find_one({"_id": ObjectId(job_id)})
+        if not job:
+            return None
+
+        query = {"metadata.ingestion_job_id": job_id}
+        job["chunks_synced"] = await self.db.knowledge_texts.count_documents({**query, "vector_sync.state": "synced"})
+        job["chunks_failed"] = await self.db.knowledge_texts.count_documents({**query, "vector_sync.state": "failed"})
+        job["id"] = str(job["_id"])
+        job["_id"] = str(job["_id"])
+        return job
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from utils.background import background_tasks
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_WINDOW = 2.0
+
+
+class _ChatBuffer:
+    def __init__(self):
+        self.pending: List[Tuple[str, Any]] = []
+        self.first_received_at: Optional[datetime] = None
+        self.timer: Optional[asyncio.Task] = None
+        self.turn = None
+        self.turn_messages: List[Tuple[str, Any]] = []
+        self.task: Optional[asyncio.Task] = None
+
+
+class MessageBuffer:
+    """
+    Per-chat debounce buffer. Messages are collected until the chat has been quiet for
+    `message_buffer_window` seconds or `message_buffer` messages are pending, then merged
+    into a single turn. A message that arrives while the previous merged turn is still
+    generating cancels that turn, and its messages are merged with the new one, unless
+    the turn already committed its reply or started a side-effecting tool; rerunning
+    those would send or write twice, so the new message waits for its own turn.
+    """
+
+    def __init__(self, run_turn: Callable[[Any], Awaitable[str]], turn_factory: Callable[..., Any],
+                 store_message: Callable[[str, str, str], Awaitable[None]], name: str = "default"):
+        self.run_turn = run_turn
+        self.turn_factory = turn_factory
+        self.store_message = store_message
+        self.name = name
+        self.buffers: Dict[str, _ChatBuffer] = {}
+
+    def is_active(self, user_id: str) -> bool:
+        return user_id in self.buffers
+
+    async def add(self, user_id: str, text: str, context: Any, assistant: Dict[str, Any]):
+        buffer = self.buffers.setdefault(user_id, _ChatBuffer())
+        if not buffer.pending and buffer.first_received_at is None:
+            buffer.first_received_at = datetime.now()
+        buffer.pending.append((text, context))
+        metrics.inc("message_buffer_messages_total", channel=self.name)
+
+        # Raw messages go to history as they arrive; the merged turn does not store them again
+        background_tasks.spawn(self.store_message(user_id, text, "user"), name=f"{self.name}_store_user_message")
+
+        if buffer.task and not buffer.task.done() and not self.is_locked_in(buffer.turn):
+            buffer.task.cancel()
+            buffer.pending[:0] = buffer.turn_messages
+            buffer.first_received_at = buffer.turn.started_at
+            buffer.turn_messages = []
+            metrics.inc("message_buffer_superseded_total", channel=self.name)
+
+        if buffer.timer:
+            buffer.timer.cancel()
+            buffer.timer = None
+
+        max_messages = max(1, assistant.get("message_buffer") or 1)
+        window = assistant.get("message_buffer_window", DEFAULT_BUFFER_WINDOW)
+        if len(buffer.pending) >= max_messages or window <= 0:
+            self.flush(user_id)
+        else:
+            buffer.timer = asyncio.create_task(self.flush_later(user_id, window))
+
+    @staticmethod
+    def is_locked_in(turn: Any) -> bool:
+        return turn.committed or turn.side_effects_started
+
+    async def flush_later(self, user_id: str, window: float):
+        await asyncio.sleep(window)
+        buffer = self.buffers.get(user_id)
+        if buffer:
+            buffer.timer = None
+        self.flush(user_id)
+
+    def flush(self, user_id: str):
+        buffer = self.buffers.get(user_id)
+        if not buffer or not buffer.pending:
+            return
+
+        messages = buffer.pending
+        text = "\n".join(message for message, _ in messages)
+        turn = self.turn_factory(user_id, text, messages[-1][1])
+        turn.store_user_message = False
+        turn.started_at = buffer.first_received_at or turn.started_at
+        metrics.observe("message_buffer_merged_messages", len(messages), channel=self.name)
+
+        buffer.pending = []
+        buffer.first_received_at = None
+        buffer.turn = turn
+        buffer.turn_messages = messages
+        buffer.task = asyncio.create_task(self.run_turn(turn))
+        buffer.task.add_done_callback(lambda task: self.on_turn_done(user_id, task))
+
+    def on_turn_done(self, user_id: str, task: asyncio.Task):
+        buffer = self.buffers.get(user_id)
+        if buffer is None:
+            return
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Buffered turn for {user_id} failed: {task.exception()}")
+        if buffer.task is task:
+            buffer.task = None
+            buffer.turn = None
+            buffer.turn_messages = []
+        # Drop idle chats so the buffer map only holds chats with work in progress
+        if not buffer.pending and buffer.timer is None and buffer.task is None:
+            self.buffers.pop(user_id, None)
@@ -0,0 +1,96 @@
+import re
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from services.retrieval_gate import QUESTION_RE, SMALL_TALK_RE, SLOT_VALUE_RE
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+decision_logger = logging.getLogger("model_router")
+
+SIMPLE = "simple"
+COMPLEX = "complex"
+
+DEFAULT_ROUTER_CONFIG = {
+    "enabled": False,
+    "fast_model": "gpt-4o-mini",
+    "max_simple_words": 12,
+    "min_kb_score": 0.8
+}
+
+REASONING_RE = re.compile(
+    r"\b(почему|зачем|объясните|объясни|сравните|сравни|разница|отличается|отличие|посчитайте|рассчитайте|"
+    r"посоветуйте|что лучше|какой лучше|какая лучше|why|explain|compare|difference|calculate|recommend)\b",
+    re.IGNORECASE | re.UNICODE
+)
+TOOL_INTENT_RE = re.compile(
+    r"\b(запиш\w*|записать\w*|записаться|бронир\w*|забронир\w*|оформ\w*|сохран\w*|"
+    r"меня зовут|мой номер|мой телефон|book|sign me up|my name is|my phone)\b",
+    re.IGNORECASE | re.UNICODE
+)
+
+
+class ModelRouter:
+    """
+    Picks the model for a turn with a local, rule-based classifier. Simple turns (small talk,
+    short messages, questions that the knowledge base answers with a strong hit) go to the
+    assistant's `model_router.fast_model`; turns that look like reasoning, long or multi-part
+    questions, questions without a good knowledge base match, or likely tool calls keep the
+    assistant's `model`. Every decision is logged (without the message text) as a JSON line
+    on the `model_router` logger.
+    """
+
+    def decide(self, message: str, config: Dict[str, Any], kb_scores: List[float],
+               has_tools: bool) -> Tuple[str, str]:
+        config = {**DEFAULT_ROUTER_CONFIG, **(config or {})}
+        text = (message or "").strip()
+        words = len(text.split())
+
+        if not config.get("enabled") or not config.get("fast_model"):
+            return COMPLEX, "router_disabled"
+        if has_tools and (TOOL_INTENT_RE.search(text) or SLOT_VALUE_RE.search(text)):
+            # Argument extraction is where cheap models fail most visibly
+            return COMPLEX, "tool_likely"
+        if SMALL_TALK_RE.match(text):
+            return SIMPLE, "small_talk"
+        if words > config["max_simple_words"]:
+            return COMPLEX, "long_message"
+        if text.count("?") > 1:
+            return COMPLEX, "multiple_questions"
+        if REASONING_RE.search(text):
+            return COMPLEX, "reasoning"
+        if kb_scores:
+            if max(kb_scores) >= config["min_kb_score"]:
+                return SIMPLE, "kb_hit"
+            return COMPLEX, "kb_weak_match"
+        if QUESTION_RE.search(text):
+            return COMPLEX, "question_without_context"
+        return SIMPLE, "short_message"
+
+    def route(self, message: str, assistant: Dict[str, Any], kb_scores: Optional[List[float]] = None,
+              has_tools: bool = False) -> str:
+        """Return the model to use for this turn and log the decision."""
+        config = {**DEFAULT_ROUTER_CONFIG, **(assistant.get("model_router") or {})}
+        default_model = assistant.get("model", "gpt-4")
+        kb_scores = kb_scores or []
+
+        decision, reason = self.decide(message, config, kb_scores, has_tools)
+        model = config.get("fast_model") if decision == SIMPLE else default_model
+
+        metrics.inc("model_router_decisions_total", decision=decision, reason=reason)
+        if config.get("enabled"):
+            # Features only: user messages may contain personal data
+            decision_logger.info(json.dumps({
+                "assistant_id": str(assistant.get("_id")),
+                "decision": decision,
+                "reason": reason,
+                "model": model,
+                "chars": len(message or ""),
+                "words": len((message or "").split()),
+                "kb_top_score": round(max(kb_scores), 4) if kb_scores else None,
+                "has_tools": has_tools
+            }))
+        return model
+
+
+model_router = ModelRouter()
@@ -1,8 +1,12 @@
 import os
+import json
 from openai import AsyncOpenAI
 import logging
 import traceback
-from typing import List, Dict, Any, Optional
+from typing import Any, Callable, Dict, List, Optional
+from utils.rate_limiter import openai_rate_limiter
+from utils.hedging import request_hedger
+from utils.tokens import count_messages_tokens, count_tokens
 
 logger = logging.getLogger(__name__)
 
@@ -12,30 +16,37 @@ class OpenAIService:
         if not self.api_key:
             raise ValueError("OpenAI API key is required but not provided.")
         
-        self.client = AsyncOpenAI(api_key=self.api_key)
+        # Retries are handled by the rate limiter so 429s respect the key's budget
+        self.client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
     
     async def generate_response(self, messages: List[Dict[str, str]], 
                                model: str, 
                                temperature: float, 
                                max_tokens: int, 
-                               functions: Optional[List[Dict[str, Any]]] = None):
+                               functions: Optional[List[Dict[str, Any]]] = None,
+                               tool_choice: str = "auto",
+                               on_response: Optional[Callable[[float, Any], None]] = None):
         try:
+            params = {
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens
+            }
             if functions and len(functions) > 0:
-                response = await self.client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    tools=functions,
-                    tool_choice="auto"
-                )
-            else:
-                response = await self.client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temperature,
-                    max_tokens=max_tokens
-                )
+                params["tools"] = functions
+                params["tool_choice"] = tool_choice
+            
+            estimated_tokens = count_messages_tokens(messages, model) + max_tokens
+            if functions:
+                estimated_tokens += count_tokens(json.dumps(functions, ensure_ascii=False), model)
+            
+            response = await openai_rate_limiter.call(
+                self.api_key, model, estimated_tokens,
+                lambda: self.client.chat.completions.with_raw_response.create(**params),
+                on_response=on_response,
+                hedger=request_hedger
+            )
             
             return response
         except Exception as e:
@@ -70,6 +81,7 @@ class OpenAIService:
             for tool_call in message.tool_calls:
                 if tool_call.type == 'function':
                     function_calls.append({
+                        "id": tool_call.id,
                         "name": tool_call.function.name,
                         "arguments": tool_call.function.arguments
                     })
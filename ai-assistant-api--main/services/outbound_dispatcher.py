@@ -0,0 +1,174 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, List, Optional, Sequence, Tuple
+import httpx
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+OUTBOUND_BACKOFF_BASE = float(os.getenv("OUTBOUND_BACKOFF_BASE", "0.5"))
+OUTBOUND_BACKOFF_MAX = float(os.getenv("OUTBOUND_BACKOFF_MAX", "30"))
+OUTBOUND_MAX_LIMITERS = int(os.getenv("OUTBOUND_MAX_LIMITERS", "10000"))
+
+# (key, sends per second, burst)
+RateLimit = Tuple[str, float, int]
+# Returns the delay before a retry, or None if the error must not be retried
+RetryPolicy = Callable[[Exception], Optional[float]]
+
+
+def split_message(text: str, max_length: int) -> List[str]:
+    """
+    Split a reply into parts of at most `max_length` characters, preferring paragraph,
+    line, sentence and word boundaries in that order.
+    """
+    text = text or ""
+    parts = []
+    while len(text) > max_length:
+        window = text[:max_length]
+        cut = -1
+        for separator in ("\n\n", "\n", ". ", " "):
+            index = window.rfind(separator)
+            if index > max_length // 2:
+                cut = index + len(separator)
+                break
+        if cut <= 0:
+            cut = max_length
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+class _SendLimiter:
+    """Token bucket; waiters are admitted in FIFO order."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class OutboundDispatcher:
+    """
+    Delivers bot replies for all channels: long replies are split to the channel's
+    maximum length, every part waits for the channel's rate limiters (e.g. per bot and
+    per chat), and sends that fail with a retryable error (429, or a connection that
+    never sent the request) are retried with jittered exponential backoff or the
+    server's retry-after. Channels that talk HTTP
+    directly share one pooled keep-alive client from `get_client`.
+    """
+
+    def __init__(self, max_limiters: int = OUTBOUND_MAX_LIMITERS):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.max_limiters = max_limiters
+        self.limiters: "OrderedDict[str, _SendLimiter]" = OrderedDict()
+        self.waiting = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self.client is None or self.client.is_closed:
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+        return self.client
+
+    def limiter(self, key: str, rate: float, burst: int) -> _SendLimiter:
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            limiter = self.limiters[key] = _SendLimiter(rate, burst)
+            # Per-chat limiters pile up; the least recently used one has long refilled
+            while len(self.limiters) > self.max_limiters:
+                self.limiters.popitem(last=False)
+        self.limiters.move_to_end(key)
+        return limiter
+
+    async def send(self, channel: str, text: str, send_part: Callable[[int, str], Awaitable[Any]],
+                   limits: Sequence[RateLimit], max_length: int, retry_policy: RetryPolicy) -> List[Any]:
+        """Send `text` as one or more parts; `send_part(index, part)` performs one API call."""
+        parts = split_message(text, max_length)
+        if len(parts) > 1:
+            metrics.inc("outbound_split_messages_total", channel=channel)
+
+        results = []
+        with metrics.timer("outbound_send_seconds", channel=channel):
+            for index, part in enumerate(parts):
+                results.append(await self.send_with_retries(channel, index, part, send_part, limits, retry_policy))
+        return results
+
+    async def send_with_retries(self, channel: str, index: int, part: str,
+                                send_part: Callable[[int, str], Awaitable[Any]],
+                                limits: Sequence[RateLimit], retry_policy: RetryPolicy) -> Any:
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await self.wait_for_limits(channel, limits)
+            try:
+                result = await send_part(index, part)
+                metrics.inc("outbound_messages_total", channel=channel, status="sent")
+                return result
+            except Exception as e:
+                retry_after = retry_policy(e)
+                if retry_after is None or attempt == OUTBOUND_MAX_RETRIES:
+                    metrics.inc("outbound_messages_total", channel=channel, status="failed")
+                    raise
+                backoff = random.uniform(0, min(OUTBOUND_BACKOFF_MAX, OUTBOUND_BACKOFF_BASE * 2 ** attempt))
+                delay = max(backoff, retry_after)
+                metrics.inc("outbound_retries_total", channel=channel)
+                logger.warning(f"Retrying {channel} send in {delay:.2f}s: {str(e)}")
+                await asyncio.sleep(delay)
+
+    async def wait_for_limits(self, channel: str, limits: Sequence[RateLimit]):
+        self.waiting[channel] = self.waiting.get(channel, 0) + 1
+        metrics.set_gauge("outbound_queue_depth", self.waiting[channel], channel=channel)
+        try:
+            with metrics.timer("outbound_rate_limit_wait_seconds", channel=channel):
+                for key, rate, burst in limits:
+                    await self.limiter(key, rate, burst).acquire()
+        finally:
+            self.waiting[channel] -= 1
+            metrics.set_gauge("outbound_queue_depth", self.waiting[channel], channel=channel)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+def http_retry_policy(error: Exception) -> Optional[float]:
+    """
+    Retry 429 responses (honouring Retry-After) and failed connections. Sends are not
+    idempotent: a 5xx may come after the message was delivered, so it is not retried.
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        if error.response.status_code == 429:
+            try:
+                return float(error.response.headers.get("retry-after") or 0)
+            except ValueError:
+                return 0.0
+        return None
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        # Nothing was sent, so a retry cannot duplicate the message
+        return 0.0
+    return None
+
+
+outbound_dispatcher = OutboundDispatcher()
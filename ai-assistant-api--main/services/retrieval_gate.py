@@ -0,0 +1,134 @@
+import re
+import json
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+decision_logger = logging.getLogger("retrieval_gate")
+
+SEARCH = "search"
+REUSE = "reuse"
+SKIP = "skip"
+
+DEFAULT_GATE_CONFIG = {
+    "enabled": False,
+    "max_short_words": 2,
+    "max_reuse_turns": 3
+}
+
+QUESTION_RE = re.compile(
+    r"\?|\b(как|какой|какая|какое|какие|каков|сколько|где|когда|куда|откуда|почему|зачем|что|чем|кто|"
+    r"можно|есть ли|нужно ли|расскажите|подскажите|объясните|"
+    r"how|what|when|where|which|why|who|can|could|is there|do you)\b",
+    re.IGNORECASE | re.UNICODE
+)
+SMALL_TALK_RE = re.compile(
+    r"^(да|нет|ага|угу|ок|окей|ok|okay|хорошо|ладно|понятно|ясно|отлично|супер|класс|спасибо|благодарю|"
+    r"здравствуйте|привет|добрый день|добрый вечер|доброе утро|пока|до свидания|yes|no|thanks|thank you|hi|hello)"
+    r"[\s!.,)]*$",
+    re.IGNORECASE | re.UNICODE
+)
+SLOT_VALUE_RE = re.compile(
+    r"^[\s+()\-\d]{6,}$|"
+    r"\b\d{1,2}[:.]\d{2}\b|"
+    r"^\d+\s*(лет|год|года|years?)?[\s!.]*$|"
+    r"\b(понедельник|вторник|среда|среду|четверг|пятница|пятницу|суббота|субботу|воскресенье)\b",
+    re.IGNORECASE | re.UNICODE
+)
+
+
+class RetrievalGate:
+    """
+    Decides per turn whether to run a knowledge base search, reuse the previous turn's
+    context from the session, or skip retrieval. Slot-filling replies ("Среда 18:00 подойдет",
+    "+77001234567", "Спасибо!") rarely need new knowledge, so they reuse or skip.
+
+    An optional classifier `(message, config) -> decision | None` is consulted before the
+    lexical rules; returning None defers to them. While the gate is enabled, every decision
+    is logged with its message features (no content) as a JSON line on the `retrieval_gate`
+    logger for offline tuning.
+    """
+
+    def __init__(self, classifier: Optional[Callable[[str, Dict[str, Any]], Optional[str]]] = None):
+        self.classifier = classifier
+
+    def decide(self, message: str, config: Dict[str, Any], has_previous_context: bool,
+               reuse_count: int) -> Tuple[str, str]:
+        config = {**DEFAULT_GATE_CONFIG, **(config or {})}
+        text = (message or "").strip()
+
+        if not config.get("enabled"):
+            return SEARCH, "gate_disabled"
+        if not text:
+            return SKIP, "empty"
+
+        fallback = REUSE if has_previous_context and reuse_count < config["max_reuse_turns"] else SKIP
+
+        if self.classifier:
+            try:
+                decision = self.classifier(text, config)
+                if decision in (SEARCH, REUSE, SKIP):
+                    if decision == REUSE and fallback != REUSE:
+                        return SEARCH, "classifier_reuse_unavailable"
+                    return decision, "classifier"
+            except Exception as e:
+                logger.error(f"Retrieval gate classifier failed: {e}")
+
+        if QUESTION_RE.search(text):
+            return SEARCH, "question"
+        if SMALL_TALK_RE.match(text):
+            return SKIP if not has_previous_context else fallback, "small_talk"
+        if SLOT_VALUE_RE.search(text):
+            return fallback, "slot_value"
+        if len(text.split()) <= config["max_short_words"]:
+            return fallback, "short_message"
+        return SEARCH, "default"
+
+    async def retrieve(self, vector_search, message: str, assistant: Dict[str, Any],
+                       state: Dict[str, Any], limit: int = 3) -> str:
+        """
+        Return the knowledge base context for this turn, updating `state`
+        (`kb_context`, `kb_scores`, `reused`) so the next turn can reuse it.
+        """
+        decision, reason = self.decide(
+            message,
+            assistant.get("retrieval_gate") or {},
+            bool(state.get("kb_context")),
+            state.get("reused", 0)
+        )
+
+        if decision == SEARCH:
+            kb_results = await vector_search.search_knowledge_base(
+                query=message,
+                assistant_id=str(assistant["_id"]),
+                limit=limit,
+                assistant=assistant
+            )
+            kb_context = vector_search.format_context(kb_results)
+            state["kb_context"] = kb_context
+            state["kb_scores"] = [doc["score"] for doc in kb_results if doc.get("score") is not None]
+            state["reused"] = 0
+        elif decision == REUSE:
+            kb_context = state.get("kb_context", "")
+            state["reused"] = state.get("reused", 0) + 1
+        else:
+            kb_context = ""
+
+        metrics.inc("retrieval_gate_decisions_total", decision=decision, reason=reason)
+        if reason != "gate_disabled":
+            # Features only: user messages may contain personal data
+            scores = state.get("kb_scores") or []
+            decision_logger.info(json.dumps({
+                "assistant_id": str(assistant.get("_id")),
+                "decision": decision,
+                "reason": reason,
+                "chars": len(message or ""),
+                "words": len((message or "").split()),
+                "reused": state.get("reused", 0),
+                "top_score": max(scores) if decision != SKIP and scores else None
+            }))
+        return kb_context
+
+
+retrieval_gate = RetrievalGate()
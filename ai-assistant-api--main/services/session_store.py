@@ -0,0 +1,287 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "10000"))
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", "21600"))
+SESSION_RESTORE_TURNS = int(os.getenv("SESSION_RESTORE_TURNS", "10"))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_MAX_STORED_MESSAGES = int(os.getenv("SESSION_MAX_STORED_MESSAGES", "60"))
+SESSION_SAVE_RETRIES = 3
+
+HISTORY_ROLES = {"user": "user", "bot": "assistant"}
+
+# loader(user_id, limit, before) -> history documents older than `before`, newest first
+HistoryLoader = Callable[[str, int, datetime], Awaitable[List[Dict[str, Any]]]]
+
+
+def new_session(messages: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    return {"messages": messages or [], "retrieval": {}}
+
+
+def fold_prefix(session: Dict[str, Any], overflow: List[Dict[str, Any]], summary: str) -> bool:
+    # Compared by value: a session refreshed from MongoDB holds equal but new message objects
+    messages = session["messages"]
+    if not overflow or messages[:len(overflow)] != overflow:
+        return False
+    del messages[:len(overflow)]
+    session["summary"] = summary
+    return True
+
+
+def history_to_messages(history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Convert history documents (newest first) into chat messages in chronological order."""
+    messages = []
+    for record in reversed(history):
+        role = HISTORY_ROLES.get(record.get("message_type"))
+        if role and record.get("message"):
+            messages.append({"role": role, "content": record["message"]})
+    return messages
+
+
+class SessionStore:
+    """
+    In-memory conversation sessions with an LRU cap and idle TTL. A user seen for the
+    first time since eviction or restart gets the last `restore_turns` turns restored
+    from message history, so memory stays bounded without losing context.
+
+    A session is `{"messages": [...], "retrieval": {...}}` and is mutated in place by
+    the conversation engine.
+    """
+
+    def __init__(self, loader: HistoryLoader, max_sessions: int = SESSION_MAX_USERS,
+                 idle_ttl: float = SESSION_IDLE_TTL, restore_turns: int = SESSION_RESTORE_TURNS,
+                 name: str = "default"):
+        self.loader = loader
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.restore_turns = restore_turns
+        self.name = name
+        self.sessions: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+        self.restoring: Dict[str, asyncio.Future] = {}
+
+    async def get(self, user_id: str, before: Optional[datetime] = None) -> Tuple[Dict[str, Any], bool]:
+        """
+        Return `(session, is_new)`; `is_new` is True when the user has no history at all.
+        `before` excludes history written by the current turn from a restore.
+        """
+        now = time.monotonic()
+        self.evict_idle(now)
+
+        entry = self.sessions.get(user_id)
+        if entry is not None:
+            self.sessions[user_id] = (entry[0], now)
+            self.sessions.move_to_end(user_id)
+            return entry[0], False
+
+        future = self.restoring.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self.restore(user_id, before or datetime.now()))
+            self.restoring[user_id] = future
+            future.add_done_callback(lambda _: self.restoring.pop(user_id, None))
+            session, is_new = await future
+        else:
+            # A concurrent message from the same user is already restoring the session
+            session, _ = await future
+            is_new = False
+        return session, is_new
+
+    async def restore(self, user_id: str, before: datetime) -> Tuple[Dict[str, Any], bool]:
+        history = []
+        if self.restore_turns > 0:
+            try:
+                history = await self.loader(user_id, self.restore_turns * 2, before)
+            except Exception as e:
+                logger.error(f"Error restoring session for {user_id}: {str(e)}")
+        if history:
+            metrics.inc("session_restores_total", store=self.name)
+
+        session = new_session(history_to_messages(history))
+        self.put(user_id, session)
+        return session, not history
+
+    async def save(self, user_id: str, session: Dict[str, Any],
+                   new_messages: Optional[List[Dict[str, Any]]] = None):
+        # Sessions are mutated in place; only refresh recency
+        self.put(user_id, session)
+
+    async def fold_summary(self, user_id: str, overflow: List[Dict[str, Any]], summary: str) -> bool:
+        """
+        Replace the leading `overflow` messages of the user's session with `summary`. Returns
+        False, leaving the session alone, if they are no longer its first messages.
+        """
+        entry = self.sessions.get(user_id)
+        if entry is None or not fold_prefix(entry[0], overflow, summary):
+            return False
+        self.put(user_id, entry[0])
+        return True
+
+    def put(self, user_id: str, session: Dict[str, Any]):
+        self.sessions[user_id] = (session, time.monotonic())
+        self.sessions.move_to_end(user_id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            metrics.inc("session_evictions_total", store=self.name, reason="capacity")
+        metrics.set_gauge("sessions_in_memory", len(self.sessions), store=self.name)
+
+    def evict_idle(self, now: float):
+        # Entries are kept in recency order, so idle ones are at the front
+        while self.sessions:
+            user_id, (_, last_seen) = next(iter(self.sessions.items()))
+            if now - last_seen < self.idle_ttl:
+                break
+            self.sessions.popitem(last=False)
+            metrics.inc("session_evictions_total", store=self.name, reason="idle")
+        metrics.set_gauge("sessions_in_memory", len(self.sessions), store=self.name)
+
+
+class MongoSessionStore(SessionStore):
+    """
+    Sessions shared between processes through MongoDB, one compact document per user in
+    `chat_sessions` (`_id` = "<namespace>:<user_id>"). The in-memory LRU acts as a
+    write-through cache: a read only transfers the document when its `version` changed,
+    and writes use the version for optimistic concurrency. On a conflict (the user's
+    previous message was handled by another worker) the turn's new messages are appended
+    to the stored session and the write is retried.
+    """
+
+    def __init__(self, db, loader: HistoryLoader, namespace: str, **kwargs):
+        super().__init__(loader, **kwargs)
+        self.collection = db.chat_sessions
+        self.namespace = namespace
+        self.indexes_ready = False
+
+    def key(self, user_id: str) -> str:
+        return f"{self.namespace}:{user_id}"
+
+    async def ensure_indexes(self):
+        if self.indexes_ready:
+            return
+        await self.collection.create_index("updated_at", expireAfterSeconds=int(self.idle_ttl))
+        self.indexes_ready = True
+
+    async def get(self, user_id: str, before: Optional[datetime] = None) -> Tuple[Dict[str, Any], bool]:
+        await self.ensure_indexes()
+        now = time.monotonic()
+        self.evict_idle(now)
+
+        entry = self.sessions.get(user_id)
+        version = entry[0].get("version", 0) if entry else 0
+        # Returns the document only if another worker wrote a newer version
+        document = await self.collection.find_one({"_id": self.key(user_id), "version": {"$ne": version}})
+        if document is not None:
+            metrics.inc("session_cache_refreshes_total", store=self.name)
+            session = self.from_document(document)
+            self.put(user_id, session)
+            return session, False
+        if entry is not None:
+            self.sessions[user_id] = (entry[0], now)
+            self.sessions.move_to_end(user_id)
+            return entry[0], False
+
+        return await super().get(user_id, before)
+
+    async def restore(self, user_id: str, before: datetime) -> Tuple[Dict[str, Any], bool]:
+        session, is_new = await super().restore(user_id, before)
+        try:
+            await self.collection.insert_one({**self.to_document(session), "_id": self.key(user_id), "version": 1})
+            session["version"] = 1
+        except DuplicateKeyError:
+            # Another worker created the session first
+            document = await self.collection.find_one({"_id": self.key(user_id)})
+            if document is not None:
+                session = self.from_document(document)
+                self.put(user_id, session)
+                is_new = False
+        except Exception as e:
+            # The first save upserts the document instead
+            logger.error(f"Error creating session {self.key(user_id)}: {str(e)}")
+        return session, is_new
+
+    async def save(self, user_id: str, session: Dict[str, Any],
+                   new_messages: Optional[List[Dict[str, Any]]] = None):
+        for _ in range(SESSION_SAVE_RETRIES):
+            version = session.get("version", 0)
+            try:
+                document = await self.collection.find_one_and_update(
+                    {"_id": self.key(user_id), "version": version},
+                    {"$set": self.to_document(session), "$inc": {"version": 1}},
+                    upsert=version == 0,
+                    return_document=ReturnDocument.AFTER,
+                    projection={"version": 1}
+                )
+            except DuplicateKeyError:
+                document = None
+            if document is not None:
+                session["version"] = document["version"]
+                self.put(user_id, session)
+                return
+
+            metrics.inc("session_save_conflicts_total", store=self.name)
+            stored = await self.collection.find_one({"_id": self.key(user_id)})
+            merged = self.from_document(stored) if stored else new_session()
+            merged["messages"].extend(new_messages or [])
+            merged["retrieval"] = session.get("retrieval", {})
+            session.clear()
+            session.update(merged)
+
+        logger.error(f"Could not save session {self.key(user_id)} after {SESSION_SAVE_RETRIES} conflicts")
+        self.sessions.pop(user_id, None)
+
+    async def fold_summary(self, user_id: str, overflow: List[Dict[str, Any]], summary: str) -> bool:
+        for _ in range(SESSION_SAVE_RETRIES):
+            # Works on the latest stored version; another worker may have answered meanwhile
+            session, _ = await self.get(user_id)
+            if not fold_prefix(session, overflow, summary):
+                return False
+            version = session.get("version", 0)
+            document = await self.collection.find_one_and_update(
+                {"_id": self.key(user_id), "version": version},
+                {"$set": self.to_document(session), "$inc": {"version": 1}},
+                return_document=ReturnDocument.AFTER,
+                projection={"version": 1}
+            )
+            if document is not None:
+                session["version"] = document["version"]
+                self.put(user_id, session)
+                return True
+            metrics.inc("session_save_conflicts_total", store=self.name)
+            # The folded copy is stale; the next get() reloads the stored version
+            self.sessions.pop(user_id, None)
+        return False
+
+    @staticmethod
+    def to_document(session: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "messages": session["messages"][-SESSION_MAX_STORED_MESSAGES:],
+            "retrieval": session.get("retrieval", {}),
+            "summary": session.get("summary", ""),
+            "updated_at": datetime.now()
+        }
+
+    @staticmethod
+    def from_document(document: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "messages": document.get("messages", []),
+            "retrieval": document.get("retrieval", {}),
+            "summary": document.get("summary", ""),
+            "version": document.get("version", 0)
+        }
+
+
+def create_session_store(db, loader: HistoryLoader, namespace: str, name: str = "default") -> SessionStore:
+    """Build the session store selected by `SESSION_BACKEND` (`memory` or `mongo`)."""
+    if SESSION_BACKEND == "mongo":
+        return MongoSessionStore(db, loader, namespace, name=name)
+    if SESSION_BACKEND != "memory":
+        logger.warning(f"Unknown SESSION_BACKEND {SESSION_BACKEND!r}, using in-memory sessions")
+    return SessionStore(loader, name=name)
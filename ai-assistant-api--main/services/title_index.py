@@ -0,0 +1,158 @@
+import asyncio
+import bisect
+import logging
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_title(text: str) -> str:
+    return " ".join(WORD_RE.findall((text or "").casefold()))
+
+
+def title_trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class _AssistantTitles:
+    def __init__(self):
+        self.titles: Dict[str, str] = {}
+        self.normalized: Dict[str, str] = {}
+        self.trigrams: Dict[str, Set[str]] = {}
+        self.words: List[Tuple[str, str]] = []
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def add(self, doc_id: str, title: str):
+        self.remove(doc_id)
+        normalized = normalize_title(title)
+        self.titles[doc_id] = title
+        self.normalized[doc_id] = normalized
+        for gram in title_trigrams(normalized):
+            self.trigrams.setdefault(gram, set()).add(doc_id)
+        for word in set(normalized.split()):
+            bisect.insort(self.words, (word, doc_id))
+
+    def remove(self, doc_id: str):
+        normalized = self.normalized.pop(doc_id, None)
+        if normalized is None:
+            return
+        self.titles.pop(doc_id, None)
+        for gram in title_trigrams(normalized):
+            ids = self.trigrams.get(gram)
+            if ids is not None:
+                ids.discard(doc_id)
+                if not ids:
+                    del self.trigrams[gram]
+        for word in set(normalized.split()):
+            i = bisect.bisect_left(self.words, (word, doc_id))
+            if i < len(self.words) and self.words[i] == (word, doc_id):
+                del self.words[i]
+
+    def prefix_matches(self, prefix: str) -> Set[str]:
+        matches = set()
+        i = bisect.bisect_left(self.words, (prefix, ""))
+        while i < len(self.words) and self.words[i][0].startswith(prefix):
+            matches.add(self.words[i][1])
+            i += 1
+        return matches
+
+    def suggest(self, query: str, limit: int) -> List[Dict[str, object]]:
+        query = normalize_title(query)
+        if not query:
+            return []
+
+        scores: Dict[str, float] = {}
+        last_word = query.split()[-1]
+        for doc_id in self.prefix_matches(last_word):
+            scores[doc_id] = 0.5
+
+        if len(query) >= 3:
+            query_grams = title_trigrams(query)
+            counts: Dict[str, int] = {}
+            for gram in query_grams:
+                for doc_id in self.trigrams.get(gram, ()):
+                    counts[doc_id] = counts.get(doc_id, 0) + 1
+            for doc_id, count in counts.items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + count / len(query_grams)
+
+        for doc_id in scores:
+            normalized = self.normalized[doc_id]
+            if normalized.startswith(query):
+                scores[doc_id] += 1.0
+            elif query in normalized:
+                scores[doc_id] += 0.5
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self.normalized[item[0]]))[:limit]
+        return [
+            {"id": doc_id, "title": self.titles[doc_id], "score": round(score, 4)}
+            for doc_id, score in ranked
+        ]
+
+
+class TitleSuggestIndex:
+    """
+    In-memory prefix/trigram index over knowledge base titles, one per assistant plus one
+    across all assistants for lookups without an assistant_id (like `GET /` and `/count`).
+    Loaded lazily from MongoDB on first use and kept current by the knowledge base router.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.assistants: Dict[str, _AssistantTitles] = {}
+        self.all = _AssistantTitles()
+        self.doc_assistants: Dict[str, Optional[str]] = {}
+
+    def _entry(self, assistant_id: Optional[str]) -> _AssistantTitles:
+        if assistant_id is None:
+            return self.all
+        entry = self.assistants.get(assistant_id)
+        if entry is None:
+            entry = _AssistantTitles()
+            self.assistants[assistant_id] = entry
+        return entry
+
+    async def ensure_loaded(self, assistant_id: Optional[str]) -> _AssistantTitles:
+        entry = self._entry(assistant_id)
+        if entry.loaded:
+            return entry
+
+        async with entry.lock:
+            if not entry.loaded:
+                query = {"deleted_at": None}
+                if assistant_id is not None:
+                    query["assistant_id"] = assistant_id
+                cursor = self.db.knowledge_texts.find(query, {"title": 1, "assistant_id": 1})
+                async for doc in cursor:
+                    doc_id = str(doc["_id"])
+                    if doc_id not in entry.titles:
+                        entry.add(doc_id, doc.get("title", ""))
+                        self.doc_assistants[doc_id] = doc.get("assistant_id")
+                entry.loaded = True
+                logger.info(f"Loaded {len(entry.titles)} titles into suggest index for assistant {assistant_id or 'all'}")
+        return entry
+
+    def add(self, doc_id: str, title: str, assistant_id: Optional[str]):
+        self.remove(doc_id)
+        if assistant_id is not None:
+            self._entry(assistant_id).add(doc_id, title)
+        self.all.add(doc_id, title)
+        self.doc_assistants[doc_id] = assistant_id
+
+    def remove(self, doc_id: str):
+        if doc_id not in self.doc_assistants:
+            return
+        assistant_id = self.doc_assistants.pop(doc_id)
+        entry = self.assistants.get(assistant_id)
+        if entry:
+            entry.remove(doc_id)
+        self.all.remove(doc_id)
+
+    async def suggest(self, query: str, assistant_id: Optional[str], limit: int = 10) -> List[Dict[str, object]]:
+        """Suggest titles of one assistant's documents, or of all documents when `assistant_id` is None."""
+        entry = await self.ensure_loaded(assistant_id)
+        return entry.suggest(query, limit)
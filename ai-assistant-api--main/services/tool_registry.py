@@ -0,0 +1,147 @@
+import re
+import json
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# save_user_data entity types and their JSON Schema equivalents
+ENTITY_TYPES = {
+    "string": "string",
+    "bool": "boolean",
+    "int": "integer",
+    "float": "number",
+    "dict": "object"
+}
+TOOL_NAME_RE = re.compile(r"^[a-zA-Z0-9_-]{1,64}$")
+SAVE_USER_DATA_DESCRIPTION = "Save user data to the system"
+
+
+def validate_entity_schema(schema: Dict[str, Dict[str, Any]]):
+    for entity_name, entity_config in schema.items():
+        if "type" not in entity_config:
+            raise ValueError(f"Entity '{entity_name}' missing 'type' field")
+        if entity_config["type"] not in ENTITY_TYPES:
+            raise ValueError(f"Invalid type for entity '{entity_name}': {entity_config['type']}")
+        if "description" not in entity_config:
+            raise ValueError(f"Entity '{entity_name}' missing 'description' field")
+
+
+def compile_entity_schema(schema: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Build the JSON Schema `parameters` object for a save_user_data entity schema."""
+    validate_entity_schema(schema)
+    return {
+        "type": "object",
+        "properties": {
+            entity_name: {
+                "type": ENTITY_TYPES[entity_config["type"]],
+                "description": entity_config["description"]
+            }
+            for entity_name, entity_config in schema.items()
+        },
+        "required": []
+    }
+
+
+def compile_tool(name: str, description: str, parameters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not TOOL_NAME_RE.match(name or ""):
+        raise ValueError(f"Invalid function name: {name!r}")
+    parameters = parameters or {"type": "object", "properties": {}}
+    if not isinstance(parameters, dict) or parameters.get("type", "object") != "object":
+        raise ValueError(f"Parameters of function '{name}' must be a JSON Schema object")
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description or "",
+            "parameters": parameters
+        }
+    }
+
+
+class ToolSet:
+    """
+    Compiled, validated tool definitions for one assistant in canonical form
+    (tools sorted by name, keys sorted), so the serialized request prefix is stable.
+    `tools` is shared between turns and must not be mutated.
+    """
+    __slots__ = ("tools", "names", "canonical", "fingerprint")
+
+    def __init__(self, tools: List[Dict[str, Any]]):
+        ordered = sorted(tools, key=lambda tool: tool["function"]["name"])
+        self.canonical = json.dumps(ordered, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        self.tools: Tuple[Dict[str, Any], ...] = tuple(json.loads(self.canonical))
+        self.names = frozenset(tool["function"]["name"] for tool in self.tools)
+        self.fingerprint = hashlib.sha256(self.canonical.encode("utf-8")).hexdigest()[:16]
+
+    def __bool__(self):
+        return bool(self.tools)
+
+    def __len__(self):
+        return len(self.tools)
+
+
+EMPTY_TOOLSET = ToolSet([])
+
+
+def _source_version(doc: Dict[str, Any]) -> Tuple[str, str]:
+    return str(doc.get("_id")), str(doc.get("updated_at") or doc.get("created_at"))
+
+
+class ToolRegistry:
+    """
+    Compiles an assistant's tool set once and reuses it until one of its source
+    documents (save_user_data config, custom functions, `functions_on`) changes.
+    """
+
+    def __init__(self):
+        self.compiled: Dict[str, Tuple[Tuple, ToolSet]] = {}
+
+    def get(self, assistant: Dict[str, Any], save_user_data_config: Optional[Dict[str, Any]],
+            function_docs: List[Dict[str, Any]]) -> ToolSet:
+        key = str(assistant["_id"])
+        if not assistant.get("functions_on", True):
+            self.compiled.pop(key, None)
+            return EMPTY_TOOLSET
+
+        version = (
+            _source_version(save_user_data_config) if save_user_data_config else None,
+            tuple(sorted(_source_version(doc) for doc in function_docs))
+        )
+        cached = self.compiled.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        toolset = self.compile(save_user_data_config, function_docs)
+        self.compiled[key] = (version, toolset)
+        metrics.inc("tool_registry_compilations_total")
+        logger.info(f"Compiled {len(toolset)} tools for assistant {key} ({toolset.fingerprint})")
+        return toolset
+
+    def compile(self, save_user_data_config: Optional[Dict[str, Any]],
+                function_docs: List[Dict[str, Any]]) -> ToolSet:
+        tools = []
+        if save_user_data_config:
+            try:
+                parameters = save_user_data_config.get("parameters")
+                if not parameters:
+                    parameters = compile_entity_schema(save_user_data_config.get("schema", {}))
+                tools.append(compile_tool("save_user_data", SAVE_USER_DATA_DESCRIPTION, parameters))
+            except ValueError as e:
+                logger.error(f"Skipping invalid save_user_data function: {e}")
+
+        for func in function_docs:
+            if any(tool["function"]["name"] == func.get("name") for tool in tools):
+                logger.error(f"Skipping duplicate function {func.get('name')} ({func.get('_id')})")
+                continue
+            try:
+                tools.append(compile_tool(func.get("name"), func.get("description", ""), func.get("parameters")))
+            except ValueError as e:
+                logger.error(f"Skipping invalid function {func.get('_id')}: {e}")
+
+        return ToolSet(tools)
+
+
+tool_registry = ToolRegistry()
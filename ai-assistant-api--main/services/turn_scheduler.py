@@ -0,0 +1,217 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "32"))
+MAX_GENERATIONS_PER_ASSISTANT = int(os.getenv("MAX_GENERATIONS_PER_ASSISTANT", "8"))
+MAX_QUEUE_PER_ASSISTANT = int(os.getenv("MAX_QUEUE_PER_ASSISTANT", "50"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "200"))
+MAX_QUEUE_WAIT = float(os.getenv("MAX_QUEUE_WAIT", "20"))
+MAX_CHAT_QUEUE = int(os.getenv("MAX_CHAT_QUEUE", "5"))
+MIN_TENANT_WEIGHT = 0.01
+
+
+class Overloaded(Exception):
+    """Raised when a turn is shed instead of queued; `reason` is used as a metric label."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Turn shed: {reason}")
+        self.reason = reason
+
+
+class _ChatQueue:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.size = 0
+
+
+class _Tenant:
+    """Generation queue and quota of one assistant."""
+
+    def __init__(self, assistant_id: str):
+        self.assistant_id = assistant_id
+        self.weight = 1.0
+        self.max_concurrent = MAX_GENERATIONS_PER_ASSISTANT
+        self.max_queue = MAX_QUEUE_PER_ASSISTANT
+        self.queue = deque()
+        self.active = 0
+        self.deficit = 0.0
+        self.in_ring = False
+
+    def configure(self, scheduling: Optional[Dict[str, Any]]):
+        scheduling = scheduling or {}
+        self.weight = max(MIN_TENANT_WEIGHT, float(scheduling.get("weight") or 1.0))
+        self.max_concurrent = int(scheduling.get("max_concurrent") or MAX_GENERATIONS_PER_ASSISTANT)
+        self.max_queue = int(scheduling.get("max_queue") or MAX_QUEUE_PER_ASSISTANT)
+
+    def eligible(self) -> bool:
+        self.drop_abandoned()
+        return bool(self.queue) and self.active < self.max_concurrent
+
+    def drop_abandoned(self):
+        # A waiter whose wait timed out or was cancelled may not have discarded its future yet
+        while self.queue and self.queue[0].done():
+            self.queue.popleft()
+
+
+class TurnScheduler:
+    """
+    Process-wide admission control for bot turns:
+
+      - turns of the same chat run one at a time, in arrival order
+      - LLM generations are capped per process and per assistant (`scheduling.max_concurrent`)
+      - free generation slots are handed out across assistants by deficit round-robin with
+        the assistant's `scheduling.weight`, so one busy assistant cannot starve the others
+      - when too many turns are queued (per assistant or in total), a chat has too many
+        pending turns, or a slot is not free within `MAX_QUEUE_WAIT` seconds, the turn is
+        shed with `Overloaded` so the bot can answer with the error message quickly
+    """
+
+    def __init__(self, max_generations: int = MAX_CONCURRENT_GENERATIONS,
+                 max_queue_depth: int = MAX_QUEUE_DEPTH, max_queue_wait: float = MAX_QUEUE_WAIT,
+                 max_chat_queue: int = MAX_CHAT_QUEUE):
+        self.max_generations = max_generations
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_wait = max_queue_wait
+        self.max_chat_queue = max_chat_queue
+        self.active = 0
+        self.waiting = 0
+        self.tenants: Dict[str, _Tenant] = {}
+        self.ring = deque()
+        self.chats: Dict[str, _ChatQueue] = {}
+
+    @asynccontextmanager
+    async def chat(self, key: str):
+        queue = self.chats.get(key)
+        if queue is None:
+            queue = self.chats[key] = _ChatQueue()
+        if queue.size >= self.max_chat_queue:
+            self.shed("chat_queue")
+        queue.size += 1
+        try:
+            async with queue.lock:
+                yield
+        finally:
+            queue.size -= 1
+            if queue.size == 0:
+                self.chats.pop(key, None)
+
+    @asynccontextmanager
+    async def generation(self, assistant_id: str, scheduling: Optional[Dict[str, Any]] = None):
+        tenant = self.tenants.get(assistant_id)
+        if tenant is None:
+            tenant = self.tenants[assistant_id] = _Tenant(assistant_id)
+        tenant.configure(scheduling)
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        tenant.queue.append(future)
+        self.waiting += 1
+        if not tenant.in_ring:
+            tenant.in_ring = True
+            self.ring.append(tenant)
+        self.dispatch()
+
+        try:
+            if not future.done():
+                if len(tenant.queue) > tenant.max_queue:
+                    self.shed("tenant_queue", tenant)
+                if self.waiting > self.max_queue_depth:
+                    self.shed("queue_depth", tenant)
+                self.report(tenant)
+                await asyncio.wait_for(future, self.max_queue_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended
+                self.release(tenant)
+            else:
+                future.cancel()
+                self.discard(tenant, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self.shed("queue_wait", tenant)
+            raise
+        finally:
+            self.waiting -= 1
+            metrics.observe("turn_queue_wait_seconds", time.monotonic() - started, assistant_id=assistant_id)
+
+        self.report(tenant)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+    def dispatch(self):
+        """Hand free generation slots to waiting turns in deficit round-robin order."""
+        while self.active < self.max_generations:
+            tenant = self.next_tenant()
+            if tenant is None:
+                return
+            future = tenant.queue.popleft()
+            tenant.active += 1
+            self.active += 1
+            future.set_result(None)
+
+    def next_tenant(self) -> Optional[_Tenant]:
+        if not any(tenant.eligible() for tenant in self.ring):
+            return None
+        while True:
+            tenant = self.ring[0]
+            tenant.drop_abandoned()
+            if not tenant.queue:
+                self.ring.popleft()
+                tenant.in_ring = False
+                tenant.deficit = 0.0
+                continue
+            if tenant.active >= tenant.max_concurrent:
+                # At its concurrency quota; its share goes to the others for now
+                self.ring.rotate(-1)
+                continue
+            if tenant.deficit < 1:
+                tenant.deficit += tenant.weight
+            if tenant.deficit >= 1:
+                tenant.deficit -= 1
+                if tenant.deficit < 1:
+                    self.ring.rotate(-1)
+                return tenant
+            self.ring.rotate(-1)
+
+    def release(self, tenant: _Tenant):
+        tenant.active -= 1
+        self.active -= 1
+        self.dispatch()
+        self.report(tenant)
+
+    def discard(self, tenant: _Tenant, future: asyncio.Future):
+        try:
+            tenant.queue.remove(future)
+        except ValueError:
+            pass
+
+    def shed(self, reason: str, tenant: Optional[_Tenant] = None):
+        labels = {"assistant_id": tenant.assistant_id} if tenant else {}
+        metrics.inc("turns_shed_total", reason=reason, **labels)
+        raise Overloaded(reason)
+
+    def report(self, tenant: _Tenant):
+        metrics.set_gauge("turn_queue_depth", self.waiting)
+        metrics.set_gauge("generations_in_flight", self.active)
+        metrics.set_gauge("turn_queue_depth", len(tenant.queue), assistant_id=tenant.assistant_id)
+        metrics.set_gauge("generations_in_flight", tenant.active, assistant_id=tenant.assistant_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self.waiting,
+            "generations_in_flight": self.active,
+            "assistants_waiting": sum(1 for tenant in self.tenants.values() if tenant.queue),
+            "chats_with_pending_turns": len(self.chats)
+        }
+
+
+turn_scheduler = TurnScheduler()
@@ -1,9 +1,12 @@
 import os
+import asyncio
 import logging
 from typing import List, Dict, Any, Optional
 from bson import ObjectId
 from qdrant_client import QdrantClient
 from utils.embeddings import get_embeddings
+from utils.qdrant_filters import build_search_filter
+from services.context_compressor import context_compressor, DEFAULT_TOKEN_BUDGET
 
 logger = logging.getLogger(__name__)
 
@@ -20,28 +23,33 @@ class VectorSearchService:
             logger.error(f"Failed to connect to Qdrant: {str(e)}")
             self.qdrant_client = None
 
-    async def search_knowledge_base(self, query: str, assistant_id: str, limit: int = 3) -> List[Dict[str, Any]]:
+    async def search_knowledge_base(self, query: str, assistant_id: str, limit: int = 3,
+                                    filter_by: Optional[Dict[str, Any]] = None,
+                                    assistant: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         try:
             if not self.qdrant_client:
                 logger.error("Qdrant client not initialized")
                 return []
-                
-            assistant = await self.db.assistants.find_one({"_id": ObjectId(assistant_id)})
+            
+            if assistant is None:
+                assistant = await self.db.assistants.find_one({"_id": ObjectId(assistant_id)})
             if not assistant:
                 logger.error(f"Assistant {assistant_id} not found")
                 return []
                 
-            query_embeddings = await get_embeddings(query, api_key=assistant.get("openai_id"))
-            
-            from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+            filter_obj = build_search_filter(
+                filter_by,
+                assistant.get("metadata_fields") or {},
+                assistant_id=str(assistant_id)
+            )
             
-            filter_obj = Filter(
-                must=[
-                    FieldCondition(key="assistant_id", match=MatchValue(value=str(assistant_id)))
-                ]
+            query_embeddings = await get_embeddings(
+                query,
+                api_key=assistant.get("openai_id") or os.getenv("OPENAI_API_KEY")
             )
             
-            search_results = self.qdrant_client.search(
+            search_results = await asyncio.to_thread(
+                self.qdrant_client.search,
                 collection_name=COLLECTION_NAME,
                 query_vector=query_embeddings,
                 limit=limit,
@@ -49,15 +57,25 @@ class VectorSearchService:
             )
             
             mongodb_ids = [result.payload.get("mongodb_id") for result in search_results]
+            object_ids = [ObjectId(doc_id) for doc_id in mongodb_ids if doc_id and ObjectId.is_valid(doc_id)]
+            
+            docs_by_id = {}
+            if object_ids:
+                docs = await self.db.knowledge_texts.find({"_id": {"$in": object_ids}, "deleted_at": None}).to_list(None)
+                docs_by_id = {str(doc["_id"]): doc for doc in docs}
+            
+            scores = {result.payload.get("mongodb_id"): result.score for result in search_results}
+            result_docs = [{**docs_by_id[doc_id], "score": scores[doc_id]} for doc_id in mongodb_ids if doc_id in docs_by_id]
             
-            result_docs = []
-            for doc_id in mongodb_ids:
-                try:
-                    doc = await self.db.knowledge_texts.find_one({"_id": ObjectId(doc_id)})
-                    if doc:
-                        result_docs.append(doc)
-                except Exception as e:
-                    logger.error(f"Error fetching document {doc_id}: {e}")
+            compression = assistant.get("context_compression") or {}
+            if compression.get("enabled") and result_docs:
+                result_docs = await context_compressor.compress(
+                    result_docs,
+                    query_embeddings,
+                    api_key=assistant.get("openai_id"),
+                    token_budget=compression.get("token_budget", DEFAULT_TOKEN_BUDGET),
+                    model=assistant.get("model", "gpt-4")
+                )
             
             return result_docs
             
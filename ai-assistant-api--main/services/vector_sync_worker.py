@@ -0,0 +1,370 @@
+import os
+import time
+import uuid
+import asyncio
+import random
+import logging
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional
+from bson import ObjectId
+from pymongo import UpdateOne, ASCENDING
+from openai import BadRequestError, UnprocessableEntityError
+from qdrant_client import QdrantClient
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import PointStruct, OverwritePayloadOperation, SetPayload
+from utils.embeddings import get_embeddings_batch
+from utils.qdrant_filters import coerce_metadata, ensure_payload_indexes
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH_SIZE = int(os.getenv("VECTOR_SYNC_BATCH_SIZE", "64"))
+SYNC_POLL_INTERVAL = float(os.getenv("VECTOR_SYNC_POLL_INTERVAL", "0.5"))
+SYNC_MAX_ATTEMPTS = int(os.getenv("VECTOR_SYNC_MAX_ATTEMPTS", "8"))
+SYNC_MAX_BACKOFF = 300.0
+# A claimed batch is left to its worker for this long; a crashed worker's claims then expire
+SYNC_LEASE_SECONDS = float(os.getenv("VECTOR_SYNC_LEASE_SECONDS", "300"))
+SYNC_LAG_REPORT_INTERVAL = float(os.getenv("VECTOR_SYNC_LAG_REPORT_INTERVAL", "15"))
+
+
+def point_id_for(text_id: str) -> int:
+    return int(str(text_id)[-6:], 16)
+
+
+def new_sync_state() -> Dict[str, Any]:
+    now = datetime.now()
+    return {
+        "state": "pending",
+        "seq": 1,
+        "reembed": True,
+        "attempts": 0,
+        "queued_at": now,
+        "next_attempt_at": now,
+        "error": None
+    }
+
+
+def pending_sync_update(reembed: bool) -> Dict[str, Any]:
+    """
+    Update operators that put an existing document back into the outbox.
+    `reembed` is only ever switched on here; the worker clears it once the new vector is stored.
+    """
+    now = datetime.now()
+    fields = {
+        "vector_sync.state": "pending",
+        "vector_sync.attempts": 0,
+        "vector_sync.queued_at": now,
+        "vector_sync.next_attempt_at": now,
+        "vector_sync.error": None
+    }
+    if reembed:
+        fields["vector_sync.reembed"] = True
+    return {"$set": fields, "$inc": {"vector_sync.seq": 1}}
+
+
+def is_document_error(error: Exception) -> bool:
+    """
+    Whether a batch failed because of one of its documents (e.g. a text over the embedding
+    input limit) rather than because OpenAI or Qdrant is unavailable.
+    """
+    if isinstance(error, (BadRequestError, UnprocessableEntityError)):
+        return True
+    return isinstance(error, UnexpectedResponse) and error.status_code in (400, 422)
+
+
+async def requeue_assistant_payloads(db, assistant_id: str) -> int:
+    """
+    Put every document of an assistant back into the outbox as a payload-only update, so
+    existing points are rewritten with metadata coerced to the assistant's current `metadata_fields`.
+    """
+    result = await db.knowledge_texts.update_many(
+        {"assistant_id": assistant_id, "deleted_at": None},
+        pending_sync_update(reembed=False)
+    )
+    return result.modified_count
+
+
+class VectorSyncWorker:
+    """
+    Drains knowledge base documents whose `vector_sync` outbox entry is pending into Qdrant.
+    Embeddings are computed in batches per assistant, point writes are batched, and failures
+    are retried with jittered exponential backoff. A batch rejected because of its contents
+    is bisected so only the offending documents are marked failed.
+
+    Every API process runs a worker, so each batch is claimed first with a lease
+    (`vector_sync.lease_owner` / `lease_until`). A document edited while it is claimed
+    stays claimed until the batch finishes, so an older version can never overwrite a newer
+    one in Qdrant; claims of a worker that died expire after `VECTOR_SYNC_LEASE_SECONDS`.
+    """
+
+    def __init__(self, db, qdrant_client: QdrantClient, collection_name: str):
+        self.db = db
+        self.qdrant_client = qdrant_client
+        self.collection_name = collection_name
+        self.task: Optional[asyncio.Task] = None
+        self.wakeup = asyncio.Event()
+        self.lag_reported_at = 0.0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+            logger.info("Vector sync worker started")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            logger.info("Vector sync worker stopped")
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def run(self):
+        try:
+            await self.db.knowledge_texts.create_index(
+                [("vector_sync.state", ASCENDING), ("vector_sync.next_attempt_at", ASCENDING)]
+            )
+        except Exception as e:
+            logger.error(f"Error creating vector sync index: {e}")
+
+        while True:
+            try:
+                processed = await self.sync_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Vector sync iteration failed: {e}")
+                processed = 0
+
+            if processed < SYNC_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=SYNC_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+
+    async def sync_once(self) -> int:
+        docs, owner = await self.claim()
+
+        if docs:
+            try:
+                with metrics.timer("vector_sync_batch_seconds"):
+                    deletes = [doc for doc in docs if doc.get("deleted_at")]
+                    upserts = [doc for doc in docs if not doc.get("deleted_at")]
+                    if deletes:
+                        await self.apply_deletes(deletes)
+                    if upserts:
+                        await self.apply_upserts(upserts)
+            finally:
+                await self.release(docs, owner)
+
+        if time.monotonic() - self.lag_reported_at >= SYNC_LAG_REPORT_INTERVAL:
+            await self.report_lag()
+        return len(docs)
+
+    async def claim(self):
+        """Claim up to `SYNC_BATCH_SIZE` due documents for this worker and return them."""
+        now = datetime.now()
+        due = {
+            "vector_sync.state": "pending",
+            "vector_sync.next_attempt_at": {"$lte": now},
+            "$or": [{"vector_sync.lease_until": None}, {"vector_sync.lease_until": {"$lt": now}}]
+        }
+        candidates = await self.db.knowledge_texts.find(due, {"_id": 1}).sort(
+            "vector_sync.next_attempt_at", ASCENDING
+        ).limit(SYNC_BATCH_SIZE).to_list(SYNC_BATCH_SIZE)
+        if not candidates:
+            return [], None
+
+        # The filter is re-checked per document, so a document claimed by another worker in
+        # the meantime is skipped
+        owner = uuid.uuid4().hex
+        await self.db.knowledge_texts.update_many(
+            {**due, "_id": {"$in": [doc["_id"] for doc in candidates]}},
+            {"$set": {
+                "vector_sync.lease_owner": owner,
+                "vector_sync.lease_until": now + timedelta(seconds=SYNC_LEASE_SECONDS)
+            }}
+        )
+        docs = await self.db.knowledge_texts.find({"vector_sync.lease_owner": owner}).sort(
+            "vector_sync.next_attempt_at", ASCENDING
+        ).to_list(None)
+        return docs, owner
+
+    async def release(self, docs: List[Dict[str, Any]], owner: str):
+        await self.db.knowledge_texts.update_many(
+            {"_id": {"$in": [doc["_id"] for doc in docs]}, "vector_sync.lease_owner": owner},
+            {"$unset": {"vector_sync.lease_owner": "", "vector_sync.lease_until": ""}}
+        )
+
+    async def report_lag(self):
+        self.lag_reported_at = time.monotonic()
+        oldest = await self.db.knowledge_texts.find_one(
+            {"vector_sync.state": "pending"},
+            {"vector_sync.queued_at": 1},
+            sort=[("vector_sync.queued_at", ASCENDING)]
+        )
+        lag = 0.0
+        if oldest:
+            lag = max(0.0, (datetime.now() - oldest["vector_sync"]["queued_at"]).total_seconds())
+        metrics.set_gauge("vector_sync_lag_seconds", lag)
+
+    async def status(self, assistant_id: Optional[str] = None) -> Dict[str, Any]:
+        query: Dict[str, Any] = {}
+        if assistant_id:
+            query["assistant_id"] = assistant_id
+
+        pending = await self.db.knowledge_texts.count_documents({**query, "vector_sync.state": "pending"})
+        failed = await self.db.knowledge_texts.count_documents({**query, "vector_sync.state": "failed"})
+        oldest = await self.db.knowledge_texts.find_one(
+            {**query, "vector_sync.state": "pending"},
+            {"vector_sync.queued_at": 1},
+            sort=[("vector_sync.queued_at", ASCENDING)]
+        )
+        lag = 0.0
+        if oldest:
+            lag = max(0.0, (datetime.now() - oldest["vector_sync"]["queued_at"]).total_seconds())
+        return {"pending": pending, "failed": failed, "lag_seconds": round(lag, 3)}
+
+    async def apply_deletes(self, docs: List[Dict[str, Any]]):
+        try:
+            await asyncio.to_thread(
+                self.qdrant_client.delete,
+                collection_name=self.collection_name,
+                points_selector=[point_id_for(doc["_id"]) for doc in docs]
+            )
+        except Exception as e:
+            logger.error(f"Qdrant batch delete failed: {e}")
+            await self.mark_failed(docs, str(e))
+            return
+
+        await self.db.knowledge_texts.delete_many({
+            "$or": [{"_id": doc["_id"], "vector_sync.seq": doc["vector_sync"]["seq"]} for doc in docs]
+        })
+        metrics.inc("vector_sync_deletes_total", len(docs))
+
+    async def apply_upserts(self, docs: List[Dict[str, Any]]):
+        assistant_ids = {doc.get("assistant_id") for doc in docs if doc.get("assistant_id")}
+        assistants = {}
+        if assistant_ids:
+            object_ids = [ObjectId(a) for a in assistant_ids if ObjectId.is_valid(a)]
+            for assistant in await self.db.assistants.find({"_id": {"$in": object_ids}}).to_list(None):
+                assistants[str(assistant["_id"])] = assistant
+
+        groups: Dict[Optional[str], List[Dict[str, Any]]] = {}
+        for doc in docs:
+            groups.setdefault(doc.get("assistant_id"), []).append(doc)
+
+        for assistant_id, group in groups.items():
+            await self.apply_upsert_group(assistants.get(assistant_id), group)
+
+    async def apply_upsert_group(self, assistant: Optional[Dict[str, Any]], docs: List[Dict[str, Any]]):
+        fields = (assistant or {}).get("metadata_fields") or {}
+        if fields:
+            await asyncio.to_thread(ensure_payload_indexes, self.qdrant_client, self.collection_name, fields)
+
+        payloads = {}
+        invalid = []
+        for doc in docs:
+            try:
+                payloads[doc["_id"]] = {
+                    "mongodb_id": str(doc["_id"]),
+                    "title": doc.get("title"),
+                    "assistant_id": doc.get("assistant_id"),
+                    **coerce_metadata(doc.get("metadata") or {}, fields)
+                }
+            except ValueError as e:
+                invalid.append((doc, str(e)))
+
+        for doc, error in invalid:
+            await self.mark_failed([doc], error, permanent=True)
+
+        valid = [doc for doc in docs if doc["_id"] in payloads]
+        synced = await self.write_points(assistant, valid, payloads)
+
+        if synced:
+            await self.db.knowledge_texts.bulk_write([
+                UpdateOne(
+                    {"_id": doc["_id"], "vector_sync.seq": doc["vector_sync"]["seq"]},
+                    {"$set": {
+                        "vector_sync.state": "synced",
+                        "vector_sync.reembed": False,
+                        "vector_sync.synced_at": datetime.now(),
+                        "vector_sync.error": None
+                    }}
+                )
+                for doc in synced
+            ], ordered=False)
+            metrics.inc("vector_sync_upserts_total", len(synced))
+
+    async def write_points(self, assistant: Optional[Dict[str, Any]], docs: List[Dict[str, Any]],
+                           payloads: Dict[Any, Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Write the points of `docs` and return the documents that were written."""
+        if not docs:
+            return []
+        try:
+            await self.upsert_points(assistant, docs, payloads)
+            return docs
+        except Exception as e:
+            if len(docs) > 1 and is_document_error(e):
+                metrics.inc("vector_sync_batch_splits_total")
+                middle = len(docs) // 2
+                return (await self.write_points(assistant, docs[:middle], payloads)
+                        + await self.write_points(assistant, docs[middle:], payloads))
+            logger.error(f"Vector sync upsert failed for {len(docs)} documents: {e}")
+            # A document rejected on its own will be rejected again until it is edited
+            await self.mark_failed(docs, str(e), permanent=is_document_error(e))
+            return []
+
+    async def upsert_points(self, assistant: Optional[Dict[str, Any]], docs: List[Dict[str, Any]],
+                            payloads: Dict[Any, Dict[str, Any]]):
+        reembed = [doc for doc in docs if doc["vector_sync"].get("reembed")]
+        payload_only = [doc for doc in docs if not doc["vector_sync"].get("reembed")]
+
+        if reembed:
+            api_key = (assistant or {}).get("openai_id") or os.getenv("OPENAI_API_KEY")
+            vectors = await get_embeddings_batch([doc.get("content", "") for doc in reembed], api_key=api_key)
+            await asyncio.to_thread(
+                self.qdrant_client.upsert,
+                collection_name=self.collection_name,
+                points=[
+                    PointStruct(id=point_id_for(doc["_id"]), vector=vector, payload=payloads[doc["_id"]])
+                    for doc, vector in zip(reembed, vectors)
+                ]
+            )
+        if payload_only:
+            await asyncio.to_thread(
+                self.qdrant_client.batch_update_points,
+                collection_name=self.collection_name,
+                update_operations=[
+                    OverwritePayloadOperation(overwrite_payload=SetPayload(
+                        payload=payloads[doc["_id"]],
+                        points=[point_id_for(doc["_id"])]
+                    ))
+                    for doc in payload_only
+                ]
+            )
+
+    async def mark_failed(self, docs: List[Dict[str, Any]], error: str, permanent: bool = False):
+        if not docs:
+            return
+        metrics.inc("vector_sync_failures_total", len(docs))
+        operations = []
+        for doc in docs:
+            attempts = doc["vector_sync"].get("attempts", 0) + 1
+            give_up = permanent or attempts >= SYNC_MAX_ATTEMPTS
+            backoff = min(SYNC_MAX_BACKOFF, 2 ** attempts) * random.uniform(0.5, 1.5)
+            operations.append(UpdateOne(
+                {"_id": doc["_id"], "vector_sync.seq": doc["vector_sync"]["seq"]},
+                {"$set": {
+                    "vector_sync.state": "failed" if give_up else "pending",
+                    "vector_sync.attempts": attempts,
+                    "vector_sync.next_attempt_at": datetime.now() + timedelta(seconds=backoff),
+                    "vector_sync.error": error
+                }}
+            ))
+        await self.db.knowledge_texts.bulk_write(operations, ordered=False)
@@ -0,0 +1,178 @@
+import asyncio
+from datetime import datetime
+from services.message_buffer import MessageBuffer
+
+
+class FakeTurn:
+    def __init__(self, user_id, text, context):
+        self.user_id = user_id
+        self.text = text
+        self.context = context
+        self.started_at = datetime.now()
+        self.store_user_message = True
+        self.committed = False
+        self.side_effects_started = False
+
+
+class Harness:
+    def __init__(self):
+        self.turns = []
+        self.finished = []
+        self.cancelled = []
+        self.stored = []
+        self.release = asyncio.Event()
+        self.buffer = MessageBuffer(self.run_turn, FakeTurn, self.store_message, name="test")
+
+    async def run_turn(self, turn):
+        self.turns.append(turn)
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled.append(turn)
+            raise
+        self.finished.append(turn)
+        return turn.text
+
+    async def store_message(self, user_id, text, message_type):
+        self.stored.append((user_id, text, message_type))
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_flushes_when_window_ends():
+    async def scenario():
+        h = Harness()
+        assistant = {"message_buffer": 5, "message_buffer_window": 0.05}
+        await h.buffer.add("u1", "a", "ctx-a", assistant)
+        first_received = h.buffer.buffers["u1"].first_received_at
+        await h.buffer.add("u1", "b", "ctx-b", assistant)
+        await settle()
+        assert h.turns == []
+
+        await asyncio.sleep(0.1)
+        assert len(h.turns) == 1
+        turn = h.turns[0]
+        assert turn.text == "a\nb"
+        assert turn.context == "ctx-b"
+        assert turn.started_at == first_received
+        assert turn.store_user_message is False
+        assert h.stored == [("u1", "a", "user"), ("u1", "b", "user")]
+        h.release.set()
+        await settle()
+
+    asyncio.run(scenario())
+
+
+def test_flushes_at_message_limit_without_waiting():
+    async def scenario():
+        h = Harness()
+        assistant = {"message_buffer": 2, "message_buffer_window": 10}
+        await h.buffer.add("u1", "a", None, assistant)
+        assert h.buffer.buffers["u1"].timer is not None
+        await h.buffer.add("u1", "b", None, assistant)
+        await settle()
+
+        assert [turn.text for turn in h.turns] == ["a\nb"]
+        assert h.buffer.buffers["u1"].timer is None
+        h.release.set()
+        await settle()
+
+    asyncio.run(scenario())
+
+
+def test_new_message_cancels_uncommitted_turn_and_merges_its_messages():
+    async def scenario():
+        h = Harness()
+        assistant = {"message_buffer": 1}
+        await h.buffer.add("u1", "a", None, assistant)
+        await settle()
+        first = h.turns[0]
+
+        await h.buffer.add("u1", "b", None, assistant)
+        await settle()
+
+        assert h.cancelled == [first]
+        assert [turn.text for turn in h.turns] == ["a", "a\nb"]
+        assert h.turns[1].started_at == first.started_at
+        h.release.set()
+        await settle()
+        assert h.finished == [h.turns[1]]
+
+    asyncio.run(scenario())
+
+
+def test_new_message_does_not_cancel_committed_turn():
+    async def scenario():
+        h = Harness()
+        assistant = {"message_buffer": 1}
+        await h.buffer.add("u1", "a", None, assistant)
+        await settle()
+        first = h.turns[0]
+        first.committed = True
+
+        await h.buffer.add("u1", "b", None, assistant)
+        await settle()
+
+        assert h.cancelled == []
+        assert [turn.text for turn in h.turns] == ["a", "b"]
+        h.release.set()
+        await settle()
+        assert h.finished == h.turns
+
+    asyncio.run(scenario())
+
+
+def test_new_message_does_not_cancel_turn_with_side_effects():
+    async def scenario():
+        h = Harness()
+        assistant = {"message_buffer": 1}
+        await h.buffer.add("u1", "a", None, assistant)
+        await settle()
+        first = h.turns[0]
+        first.side_effects_started = True
+
+        await h.buffer.add("u1", "b", None, assistant)
+        await settle()
+
+        assert h.cancelled == []
+        assert [turn.text for turn in h.turns] == ["a", "b"]
+        h.release.set()
+        await settle()
+        assert h.finished == h.turns
+
+    asyncio.run(scenario())
+
+
+def test_idle_buffer_is_dropped_when_turn_finishes():
+    async def scenario():
+        h = Harness()
+        await h.buffer.add("u1", "a", None, {"message_buffer": 1})
+        await settle()
+        assert h.buffer.is_active("u1")
+
+        h.release.set()
+        await settle()
+        assert not h.buffer.is_active("u1")
+        assert h.buffer.buffers == {}
+
+    asyncio.run(scenario())
+
+
+def test_buffer_with_pending_messages_survives_turn_end():
+    async def scenario():
+        h = Harness()
+        await h.buffer.add("u1", "a", None, {"message_buffer": 1})
+        await settle()
+        h.turns[0].committed = True
+        await h.buffer.add("u1", "b", None, {"message_buffer": 5, "message_buffer_window": 10})
+
+        h.release.set()
+        await settle()
+        assert h.buffer.is_active("u1")
+        assert [text for text, _ in h.buffer.buffers["u1"].pending] == ["b"]
+        h.buffer.buffers["u1"].timer.cancel()
+
+    asyncio.run(scenario())
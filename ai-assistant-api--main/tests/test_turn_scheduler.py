@@ -0,0 +1,203 @@
+import asyncio
+import pytest
+from services.turn_scheduler import Overloaded, TurnScheduler
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def assert_idle(scheduler):
+    assert scheduler.active == 0
+    assert scheduler.waiting == 0
+    for tenant in scheduler.tenants.values():
+        assert tenant.active == 0
+        assert not tenant.queue
+    assert scheduler.chats == {}
+
+
+async def hold(scheduler, assistant_id, release, scheduling=None, started=None):
+    async with scheduler.generation(assistant_id, scheduling):
+        if started is not None:
+            started.append(assistant_id)
+        await release.wait()
+
+
+def test_free_slots_follow_assistant_weights():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(hold(scheduler, "blocker", release))
+        await settle()
+
+        order = []
+
+        async def generate(assistant_id, weight):
+            async with scheduler.generation(assistant_id, {"weight": weight}):
+                order.append(assistant_id)
+
+        waiters = [asyncio.create_task(generate("A", 3)) for _ in range(4)]
+        waiters += [asyncio.create_task(generate("B", 1)) for _ in range(4)]
+        await settle()
+        assert scheduler.waiting == 8
+
+        release.set()
+        await asyncio.gather(blocker, *waiters)
+        assert "".join(order) == "AAABABBB"
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_assistant_is_capped_at_max_concurrent():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=10)
+        release = asyncio.Event()
+        started = []
+        tasks = [asyncio.create_task(hold(scheduler, "A", release, {"max_concurrent": 2}, started)) for _ in range(4)]
+        await settle()
+        assert started == ["A", "A"]
+        assert scheduler.tenants["A"].active == 2
+        assert len(scheduler.tenants["A"].queue) == 2
+
+        # Another assistant is not blocked by A's quota
+        tasks.append(asyncio.create_task(hold(scheduler, "B", release, None, started)))
+        await settle()
+        assert started == ["A", "A", "B"]
+        assert scheduler.active == 3
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == ["A", "A", "B", "A", "A"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_turn_is_shed_after_max_queue_wait():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=1, max_queue_wait=0.05)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(hold(scheduler, "A", release))
+        await settle()
+
+        with pytest.raises(Overloaded) as error:
+            await hold(scheduler, "B", release)
+        assert error.value.reason == "queue_wait"
+        assert not scheduler.tenants["B"].queue
+
+        release.set()
+        await blocker
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_turn_is_shed_when_assistant_queue_is_full():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=1)
+        release = asyncio.Event()
+        scheduling = {"max_queue": 1}
+        blocker = asyncio.create_task(hold(scheduler, "A", release, scheduling))
+        queued = asyncio.create_task(hold(scheduler, "A", release, scheduling))
+        await settle()
+        assert len(scheduler.tenants["A"].queue) == 1
+
+        with pytest.raises(Overloaded) as error:
+            await hold(scheduler, "A", release, scheduling)
+        assert error.value.reason == "tenant_queue"
+        assert len(scheduler.tenants["A"].queue) == 1
+        assert scheduler.waiting == 1
+
+        release.set()
+        await asyncio.gather(blocker, queued)
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_turn_is_shed_when_total_queue_is_full():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=1, max_queue_depth=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(hold(scheduler, "A", release))
+        queued = asyncio.create_task(hold(scheduler, "B", release))
+        await settle()
+
+        with pytest.raises(Overloaded) as error:
+            await hold(scheduler, "C", release)
+        assert error.value.reason == "queue_depth"
+        assert scheduler.waiting == 1
+
+        release.set()
+        await asyncio.gather(blocker, queued)
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_chat_turns_run_in_order_and_excess_turns_are_shed():
+    async def scenario():
+        scheduler = TurnScheduler(max_chat_queue=2)
+        release = asyncio.Event()
+        order = []
+
+        async def turn(name):
+            async with scheduler.chat("chat-1"):
+                order.append(name)
+                await release.wait()
+
+        tasks = [asyncio.create_task(turn(name)) for name in ("first", "second")]
+        await settle()
+        assert order == ["first"]
+
+        with pytest.raises(Overloaded) as error:
+            await turn("third")
+        assert error.value.reason == "chat_queue"
+
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["first", "second"]
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_leaves_no_trace():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=1)
+        release = asyncio.Event()
+        blocker = asyncio.create_task(hold(scheduler, "A", release))
+        waiter = asyncio.create_task(hold(scheduler, "B", release))
+        await settle()
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not scheduler.tenants["B"].queue
+
+        release.set()
+        await blocker
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
+
+
+def test_waiter_timing_out_while_a_slot_is_released():
+    async def scenario():
+        scheduler = TurnScheduler(max_generations=1, max_queue_wait=0.05)
+        async with scheduler.generation("A"):
+            waiter = asyncio.create_task(hold(scheduler, "B", asyncio.Event()))
+            await settle()
+            queued = scheduler.tenants["B"].queue[0]
+            while not queued.cancelled():
+                await asyncio.sleep(0)
+            # The slot is released here: B's wait timed out but B has not discarded its future yet
+
+        with pytest.raises(Overloaded) as error:
+            await waiter
+        assert error.value.reason == "queue_wait"
+        assert_idle(scheduler)
+
+    asyncio.run(scenario())
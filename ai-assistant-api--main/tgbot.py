@@ -1,15 +1,28 @@
 import os
 import asyncio
 import logging
+import json
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 from services.telegram_service import TelegramBotService
+from services.assistant_cache import get_assistant_cache
+from services.turn_scheduler import turn_scheduler
+from services.function_runner import function_runner
+from services.outbound_dispatcher import outbound_dispatcher
+from utils.background import background_tasks
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://mongodb:27017")
 DB_NAME = os.getenv("DB_NAME", "ai_assistant_db")
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL", "60"))
+
+async def log_queue_metrics():
+    # The Telegram bot has no HTTP server, so queue state is logged periodically instead
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        logger.info(f"Turn queue: {json.dumps(turn_scheduler.stats())}")
 
 async def main():
     try:
@@ -25,7 +38,7 @@ async def main():
                 await asyncio.sleep(30)
                 telegram_integrations = await db.telegram_integrations.find().to_list(None)
         
-        bot_tasks = []
+        bot_tasks = [asyncio.create_task(log_queue_metrics())]
         for integration in telegram_integrations:
             bot_service = TelegramBotService(
                 integration['bot_token'],
@@ -41,6 +54,11 @@ async def main():
     except Exception as e:
         logger.error(f"Error in main function: {str(e)}")
     finally:
+        await background_tasks.drain()
+        await function_runner.close()
+        await outbound_dispatcher.close()
+        if 'db' in locals():
+            await get_assistant_cache(db).stop()
         if 'mongodb_client' in locals():
             mongodb_client.close()
             logger.info("Disconnected from MongoDB")
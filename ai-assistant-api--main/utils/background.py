@@ -0,0 +1,46 @@
+import asyncio
+import logging
+from typing import Awaitable, Optional, Set
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundTasks:
+    """
+    Supervises fire-and-forget coroutines (history writes, Sheets logging) that run after a reply
+    is sent: keeps strong references so tasks are not garbage collected, logs failures and
+    lets the process drain outstanding work on shutdown.
+    """
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+
+    def spawn(self, coro: Awaitable, name: Optional[str] = None) -> asyncio.Task:
+        task = asyncio.create_task(coro, name=name)
+        self.tasks.add(task)
+        metrics.set_gauge("background_tasks_in_flight", len(self.tasks))
+        task.add_done_callback(self._on_done)
+        return task
+
+    def _on_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        metrics.set_gauge("background_tasks_in_flight", len(self.tasks))
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            metrics.inc("background_task_failures_total", task=task.get_name())
+            logger.error(f"Background task {task.get_name()} failed: {error}")
+
+    async def drain(self, timeout: float = 10.0):
+        if not self.tasks:
+            return
+        done, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Cancelled {len(pending)} background tasks on shutdown")
+
+
+background_tasks = BackgroundTasks()
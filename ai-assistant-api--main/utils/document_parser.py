@@ -0,0 +1,186 @@
+import io
+import os
+import re
+import csv
+from typing import Dict, List
+
+SUPPORTED_EXTENSIONS = {".docx", ".html", ".htm", ".txt", ".csv"}
+DEFAULT_CHUNK_CHARS = int(os.getenv("INGESTION_CHUNK_CHARS", "2000"))
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+")
+
+# Parsing functions run inside a ProcessPoolExecutor, so they must stay
+# top-level, picklable and free of event loop or database dependencies.
+
+
+def file_extension(filename: str) -> str:
+    return os.path.splitext(filename or "")[1].lower()
+
+
+def decode_text(data: bytes) -> str:
+    for encoding in ("utf-8-sig", "cp1251", "latin-1"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return data.decode("utf-8", errors="ignore")
+
+
+def parse_docx(filename: str, data: bytes) -> List[Dict[str, str]]:
+    from docx import Document
+
+    document = Document(io.BytesIO(data))
+    sections = []
+    title = os.path.splitext(filename)[0]
+    lines: List[str] = []
+
+    for paragraph in document.paragraphs:
+        text = paragraph.text.strip()
+        if not text:
+            continue
+        style = (paragraph.style.name or "").lower() if paragraph.style is not None else ""
+        if style.startswith("heading") or style.startswith("заголовок") or style == "title":
+            if lines:
+                sections.append({"title": title, "content": "\n".join(lines)})
+                lines = []
+            title = text
+        else:
+            lines.append(text)
+
+    if lines:
+        sections.append({"title": title, "content": "\n".join(lines)})
+
+    for index, table in enumerate(document.tables, 1):
+        rows = [" | ".join(cell.text.strip() for cell in row.cells) for row in table.rows]
+        rows = [row for row in rows if row.strip(" |")]
+        if rows:
+            sections.append({"title": f"{os.path.splitext(filename)[0]} - table {index}", "content": "\n".join(rows)})
+
+    return sections
+
+
+def parse_html(filename: str, data: bytes) -> List[Dict[str, str]]:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(data, "lxml")
+    for tag in soup(["script", "style", "noscript", "nav", "footer", "header"]):
+        tag.decompose()
+
+    page_title = soup.title.get_text(strip=True) if soup.title else os.path.splitext(filename)[0]
+    body = soup.body or soup
+    sections = []
+    title = page_title
+    lines: List[str] = []
+
+    for element in body.find_all(["h1", "h2", "h3", "p", "li", "td", "pre", "blockquote"]):
+        text = element.get_text(" ", strip=True)
+        if not text:
+            continue
+        if element.name in ("h1", "h2", "h3"):
+            if lines:
+                sections.append({"title": title, "content": "\n".join(lines)})
+                lines = []
+            title = text
+        else:
+            lines.append(text)
+
+    if lines:
+        sections.append({"title": title, "content": "\n".join(lines)})
+
+    if not sections:
+        text = body.get_text("\n", strip=True)
+        if text:
+            sections.append({"title": page_title, "content": text})
+
+    return sections
+
+
+def parse_txt(filename: str, data: bytes) -> List[Dict[str, str]]:
+    text = decode_text(data).strip()
+    if not text:
+        return []
+    return [{"title": os.path.splitext(filename)[0], "content": text}]
+
+
+def parse_csv(filename: str, data: bytes) -> List[Dict[str, str]]:
+    text = decode_text(data)
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+
+    rows = list(csv.reader(io.StringIO(text), dialect))
+    if not rows:
+        return []
+
+    header = [column.strip() for column in rows[0]]
+    base_title = os.path.splitext(filename)[0]
+    sections = []
+    for number, row in enumerate(rows[1:], 1):
+        values = [value.strip() for value in row]
+        if not any(values):
+            continue
+        content = "\n".join(
+            f"{header[i] if i < len(header) and header[i] else f'column_{i + 1}'}: {value}"
+            for i, value in enumerate(values) if value
+        )
+        title = values[0] if values[0] else f"{base_title} #{number}"
+        sections.append({"title": title, "content": content})
+    return sections
+
+
+PARSERS = {
+    ".docx": parse_docx,
+    ".html": parse_html,
+    ".htm": parse_html,
+    ".txt": parse_txt,
+    ".csv": parse_csv,
+}
+
+
+def parse_document(filename: str, data: bytes) -> List[Dict[str, str]]:
+    extension = file_extension(filename)
+    if extension not in PARSERS:
+        raise ValueError(f"Unsupported file type: {extension or filename}")
+    return PARSERS[extension](filename, data)
+
+
+def chunk_section(section: Dict[str, str], max_chars: int = DEFAULT_CHUNK_CHARS) -> List[Dict[str, str]]:
+    """
+    Split a section into chunks of at most `max_chars`, breaking on paragraphs first and
+    sentences second. Chunks after the first get a "(part n)" suffix in their title.
+    """
+    content = section["content"].strip()
+    if len(content) <= max_chars:
+        return [section] if content else []
+
+    pieces: List[str] = []
+    for paragraph in content.split("\n"):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE_SPLIT_RE.split(paragraph):
+            while len(sentence) > max_chars:
+                pieces.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if sentence:
+                pieces.append(sentence)
+
+    chunks: List[str] = []
+    current = ""
+    for piece in pieces:
+        candidate = f"{current}\n{piece}" if current else piece
+        if len(candidate) > max_chars and current:
+            chunks.append(current)
+            current = piece
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+
+    return [
+        {"title": section["title"] if i == 1 else f"{section['title']} (part {i})", "content": chunk}
+        for i, chunk in enumerate(chunks, 1)
+    ]
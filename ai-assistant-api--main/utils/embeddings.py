@@ -3,34 +3,57 @@ import logging
 from typing import List, Optional
 import numpy as np
 from openai import AsyncOpenAI
+from utils.rate_limiter import openai_rate_limiter
+from utils.tokens import count_tokens
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DEFAULT_MODEL = "text-embedding-ada-002"
 
+def random_embedding(model: str = DEFAULT_MODEL) -> List[float]:
+    size = 1536 if model == "text-embedding-ada-002" else 768
+    return [np.random.uniform(-1, 1) for _ in range(size)]
+
+
 async def get_embeddings(text: str, api_key: Optional[str] = os.getenv("OPENAI_API_KEY"), model: str = DEFAULT_MODEL) -> List[float]:
-    try:
-        if not api_key:
-            logger.warning("OpenAI API key not found. Using random embeddings for demonstration.")
-            if model == "text-embedding-ada-002":
-                return [np.random.uniform(-1, 1) for _ in range(1536)]
-            else:
-                return [np.random.uniform(-1, 1) for _ in range(768)]
-        
-        client = AsyncOpenAI(api_key=api_key)
-        
-        response = await client.embeddings.create(
-            input=text,
-            model=model
-        )
-        
-        embeddings = response.data[0].embedding
-        return embeddings
+    """
+    Embed a single text. API errors are raised so a failed request never searches with a
+    random vector; without an API key random embeddings are returned, as in get_embeddings_batch.
+    """
+    if not api_key:
+        logger.warning("OpenAI API key not found. Using random embeddings for demonstration.")
+        return random_embedding(model)
+    
+    client = AsyncOpenAI(api_key=api_key, max_retries=0)
+    
+    response = await openai_rate_limiter.call(
+        api_key, model, count_tokens(text, model),
+        lambda: client.embeddings.with_raw_response.create(input=text, model=model),
+        operation="embeddings"
+    )
+    
+    return response.data[0].embedding
+
+
+async def get_embeddings_batch(texts: List[str], api_key: Optional[str] = os.getenv("OPENAI_API_KEY"), model: str = DEFAULT_MODEL) -> List[List[float]]:
+    """
+    Embed several texts in a single request. API errors are raised so callers that retry
+    (e.g. the vector sync worker) never index random vectors.
+    """
+    if not texts:
+        return []
+    
+    if not api_key:
+        logger.warning("OpenAI API key not found. Using random embeddings for demonstration.")
+        return [random_embedding(model) for _ in texts]
+    
+    client = AsyncOpenAI(api_key=api_key, max_retries=0)
+    
+    response = await openai_rate_limiter.call(
+        api_key, model, sum(count_tokens(text, model) for text in texts),
+        lambda: client.embeddings.with_raw_response.create(input=texts, model=model),
+        operation="embeddings"
+    )
     
-    except Exception as e:
-        logger.error(f"Error generating embeddings: {e}")
-        if model == "text-embedding-ada-002":
-            return [np.random.uniform(-1, 1) for _ in range(1536)]
-        else:
-            return [np.random.uniform(-1, 1) for _ in range(768)]
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
@@ -0,0 +1,101 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() in ("1", "true", "yes")
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.05"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = 200
+# Unused hedge budget carried over from quiet periods, in requests
+HEDGE_MAX_BURST = 5.0
+
+
+class RequestHedger:
+    """
+    Tail-latency hedging for idempotent requests. When a request has not completed after
+    the `HEDGE_PERCENTILE` latency of recent requests for the same model, a duplicate is
+    sent; the first one to succeed is used and the other is cancelled. Every request earns
+    `HEDGE_MAX_RATE` of a hedge, so at most that share of traffic is ever duplicated.
+
+    `request` should be the bare provider call: the rate limiter runs the hedger once the
+    primary's budget is reserved, so only provider time is observed, and `reserve` must
+    take the duplicate's budget without waiting or the hedge is skipped.
+    """
+
+    def __init__(self, enabled: bool = HEDGE_REQUESTS, percentile: float = HEDGE_PERCENTILE,
+                 max_rate: float = HEDGE_MAX_RATE):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.latencies: Dict[str, deque] = {}
+        self.budget = 0.0
+
+    def delay(self, model: str) -> Optional[float]:
+        samples = self.latencies.get(model)
+        if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return max(HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))])
+
+    def observe(self, model: str, seconds: float):
+        samples = self.latencies.get(model)
+        if samples is None:
+            samples = self.latencies[model] = deque(maxlen=HEDGE_WINDOW)
+        samples.append(seconds)
+        metrics.observe("openai_request_seconds", seconds, model=model)
+
+    async def run(self, model: str, request: Callable[[], Awaitable[Any]],
+                  reserve: Optional[Callable[[], bool]] = None) -> Any:
+        if not self.enabled:
+            return await request()
+
+        self.budget = min(HEDGE_MAX_BURST, self.budget + self.max_rate)
+        started = time.monotonic()
+        delay = self.delay(model)
+        primary = asyncio.ensure_future(request())
+        tasks = {primary}
+        hedged = False
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    if self.budget < 1:
+                        metrics.inc("openai_hedges_skipped_total", model=model, reason="budget")
+                    elif reserve is not None and not reserve():
+                        # Duplicating a request to a paused or throttled key only adds load
+                        metrics.inc("openai_hedges_skipped_total", model=model, reason="throttled")
+                    else:
+                        self.budget -= 1
+                        tasks.add(asyncio.ensure_future(request()))
+                        hedged = True
+                        metrics.inc("openai_hedges_total", model=model)
+
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.discard(task)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    break
+                if not tasks:
+                    # Every attempt failed; surface the primary's error
+                    raise primary.exception()
+
+            if hedged:
+                metrics.inc("openai_hedge_wins_total", model=model, winner="primary" if winner is primary else "hedge")
+            self.observe(model, time.monotonic() - started)
+            return winner.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+request_hedger = RequestHedger()
@@ -0,0 +1,107 @@
+import time
+import threading
+from collections import deque
+from typing import Any, Dict, Tuple
+
+SUMMARY_WINDOW = 1024
+
+
+class _Summary:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=SUMMARY_WINDOW)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def percentile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+    def snapshot(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "p50": round(self.percentile(0.5), 6),
+            "p95": round(self.percentile(0.95), 6),
+            "p99": round(self.percentile(0.99), 6),
+        }
+
+
+class MetricsRegistry:
+    """
+    Minimal in-process metrics: counters, gauges and windowed summaries keyed by name and labels.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.summaries: Dict[Tuple[str, Tuple], _Summary] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = _Summary()
+            summary.observe(value)
+
+    def timer(self, name: str, **labels):
+        return _Timer(self, name, labels)
+
+    def snapshot(self) -> Dict[str, Any]:
+        def render(items, value_fn):
+            result: Dict[str, list] = {}
+            for (name, labels), value in items:
+                result.setdefault(name, []).append({"labels": dict(labels), "value": value_fn(value)})
+            return result
+
+        with self.lock:
+            return {
+                "counters": render(self.counters.items(), lambda v: v),
+                "gauges": render(self.gauges.items(), lambda v: v),
+                "summaries": render(self.summaries.items(), lambda v: v.snapshot()),
+            }
+
+
+class _Timer:
+    def __init__(self, registry: MetricsRegistry, name: str, labels: Dict[str, Any]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.elapsed, **self.labels)
+        return False
+
+
+metrics = MetricsRegistry()
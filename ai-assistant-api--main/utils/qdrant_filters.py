@@ -0,0 +1,128 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+from qdrant_client import QdrantClient
+from qdrant_client.http.models import (
+    Filter, FieldCondition, MatchValue, MatchAny, Range, DatetimeRange, PayloadSchemaType
+)
+
+logger = logging.getLogger(__name__)
+
+METADATA_FIELD_TYPES = {
+    "keyword": PayloadSchemaType.KEYWORD,
+    "integer": PayloadSchemaType.INTEGER,
+    "datetime": PayloadSchemaType.DATETIME,
+}
+
+BUILTIN_FIELDS = {
+    "assistant_id": "keyword",
+    "title": "keyword",
+}
+
+RANGE_OPERATORS = ("gt", "gte", "lt", "lte")
+
+_created_indexes: Set[Tuple[str, str, str]] = set()
+
+
+def ensure_payload_indexes(qdrant_client: QdrantClient, collection_name: str, fields: Dict[str, str]):
+    for field_name, field_type in fields.items():
+        key = (collection_name, field_name, field_type)
+        if key in _created_indexes:
+            continue
+        try:
+            qdrant_client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field_name,
+                field_schema=METADATA_FIELD_TYPES[field_type]
+            )
+            _created_indexes.add(key)
+            logger.info(f"Ensured {field_type} payload index on {collection_name}.{field_name}")
+        except Exception as e:
+            logger.error(f"Error creating payload index on {field_name}: {e}")
+
+
+def _coerce_value(field_name: str, field_type: str, value: Any) -> Any:
+    if isinstance(value, list):
+        return [_coerce_value(field_name, field_type, item) for item in value]
+    try:
+        if field_type == "integer":
+            if isinstance(value, bool):
+                raise ValueError("booleans are not integers")
+            return int(value)
+        if field_type == "datetime":
+            if isinstance(value, datetime):
+                return value.isoformat()
+            return datetime.fromisoformat(str(value)).isoformat()
+        return str(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid {field_type} value for metadata field '{field_name}': {value!r} ({e})")
+
+
+def coerce_metadata(metadata: Dict[str, Any], fields: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Convert declared metadata fields to the payload types Qdrant indexes them as.
+    Undeclared fields are passed through unchanged.
+    """
+    coerced = dict(metadata or {})
+    for field_name, field_type in (fields or {}).items():
+        if coerced.get(field_name) is not None:
+            coerced[field_name] = _coerce_value(field_name, field_type, coerced[field_name])
+    return coerced
+
+
+def _field_condition(field_name: str, field_type: str, value: Any) -> FieldCondition:
+    if isinstance(value, dict):
+        if "eq" in value:
+            return _field_condition(field_name, field_type, value["eq"])
+        if "in" in value:
+            return _field_condition(field_name, field_type, list(value["in"]))
+
+        bounds = {op: value[op] for op in RANGE_OPERATORS if value.get(op) is not None}
+        unknown = set(value) - set(RANGE_OPERATORS)
+        if unknown or not bounds:
+            raise ValueError(f"Unsupported filter operators for '{field_name}': {sorted(unknown) or list(value)}")
+        if field_type == "integer":
+            return FieldCondition(
+                key=field_name,
+                range=Range(**{op: _coerce_value(field_name, field_type, v) for op, v in bounds.items()})
+            )
+        if field_type == "datetime":
+            return FieldCondition(
+                key=field_name,
+                range=DatetimeRange(**{op: _coerce_value(field_name, field_type, v) for op, v in bounds.items()})
+            )
+        raise ValueError(f"Range filters are not supported on {field_type} field '{field_name}'")
+
+    if isinstance(value, list):
+        if field_type == "datetime":
+            raise ValueError(f"In-list filters are not supported on datetime field '{field_name}'")
+        return FieldCondition(key=field_name, match=MatchAny(any=_coerce_value(field_name, field_type, value)))
+
+    return FieldCondition(key=field_name, match=MatchValue(value=_coerce_value(field_name, field_type, value)))
+
+
+def build_search_filter(
+    filter_by: Optional[Dict[str, Any]],
+    fields: Dict[str, str],
+    assistant_id: Optional[str] = None
+) -> Optional[Filter]:
+    """
+    Build a Qdrant filter from a `filter_by` mapping.
+
+    Each key is a declared metadata field (or `assistant_id`/`title`) and each value is one of:
+    a scalar (equality), a list or {"in": [...]} (in-list), {"eq": v}, or a range
+    such as {"gte": 1, "lt": 10}. Raises ValueError on undeclared fields or bad values.
+    """
+    conditions: List[FieldCondition] = []
+    if assistant_id:
+        conditions.append(FieldCondition(key="assistant_id", match=MatchValue(value=str(assistant_id))))
+
+    declared = {**(fields or {}), **BUILTIN_FIELDS}
+    for key, value in (filter_by or {}).items():
+        if value is None or (key == "assistant_id" and (assistant_id or not value)):
+            continue
+        if key not in declared:
+            raise ValueError(f"Metadata field '{key}' is not declared as filterable for this assistant")
+        conditions.append(_field_condition(key, declared[key], value))
+
+    return Filter(must=conditions) if conditions else None
@@ -0,0 +1,239 @@
+import os
+import re
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from utils.hedging import RequestHedger
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Limits used before the first response headers arrive; 0 means "learn from the headers"
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "0"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "0"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "20"))
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Parse `x-ratelimit-reset-*` durations such as "20ms", "1s" or "6m0s" into seconds."""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def key_fingerprint(api_key: Optional[str]) -> str:
+    """Short, non-reversible label for an API key, safe for logs and metrics."""
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:8]
+
+
+class _Bucket:
+    """Token bucket refilled continuously at `limit` units per minute; no limit means unthrottled."""
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.limit:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.limit:
+            return 0.0
+        # A request larger than the whole bucket only waits for a full bucket
+        missing = min(amount, self.limit) - self.level
+        return max(0.0, missing * 60 / self.limit)
+
+    def take(self, amount: float):
+        if self.limit:
+            self.level -= min(amount, self.limit)
+
+    def sync(self, limit: Optional[int], remaining: Optional[int], now: float):
+        if limit:
+            self.limit = limit
+        if remaining is not None and self.limit:
+            # The server's count is authoritative and already includes requests in flight
+            self.level = min(self.limit, remaining)
+            self.updated = now
+
+
+class _KeyBudget:
+    def __init__(self, label: str, model: str):
+        self.label = label
+        self.model = model
+        self.requests = _Bucket(OPENAI_RPM_LIMIT)
+        self.tokens = _Bucket(OPENAI_TPM_LIMIT)
+        self.blocked_until = 0.0
+        # asyncio.Lock wakes waiters in FIFO order, so requests are admitted in arrival order
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> float:
+        started = time.monotonic()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                delay = max(self.blocked_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+        return time.monotonic() - started
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Take the budget of one request only if it is free right now, without queueing."""
+        now = time.monotonic()
+        if self.lock.locked() or self.blocked_until > now:
+            return False
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        if self.requests.wait_time(1) > 0 or self.tokens.wait_time(tokens) > 0:
+            return False
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        return True
+
+    def update(self, headers: Any):
+        if not headers:
+            return
+        now = time.monotonic()
+        self.requests.sync(_int_header(headers, "x-ratelimit-limit-requests"),
+                           _int_header(headers, "x-ratelimit-remaining-requests"), now)
+        self.tokens.sync(_int_header(headers, "x-ratelimit-limit-tokens"),
+                         _int_header(headers, "x-ratelimit-remaining-tokens"), now)
+
+        for kind, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            if bucket.limit and bucket.level <= 0:
+                # Daily limits refill much slower than limit/60 per second; trust the reset header
+                reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+            metrics.set_gauge(f"openai_ratelimit_remaining_{kind}", bucket.level, key=self.label, model=self.model)
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+def _int_header(headers: Any, name: str) -> Optional[int]:
+    value = headers.get(name)
+    try:
+        return int(float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_after(error: RateLimitError) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    return parse_reset(headers.get("retry-after"))
+
+
+class OpenAIRateLimiter:
+    """
+    Client-side rate limiting per API key and model. Each request reserves one request and
+    its estimated tokens (prompt + `max_tokens`, which is how OpenAI counts against TPM)
+    from token buckets whose limits and levels follow the `x-ratelimit-*` response headers.
+    Requests that would exceed the budget wait in FIFO order instead of failing; a 429 pauses
+    the key for `retry-after` (or a jittered exponential backoff) and the request is retried.
+    Connection errors and 5xx responses are retried with the same backoff.
+    """
+
+    def __init__(self, max_retries: int = OPENAI_MAX_RETRIES):
+        self.max_retries = max_retries
+        self.budgets: Dict[Tuple[str, str], _KeyBudget] = {}
+
+    def budget(self, api_key: Optional[str], model: str) -> _KeyBudget:
+        label = key_fingerprint(api_key)
+        budget = self.budgets.get((label, model))
+        if budget is None:
+            budget = self.budgets[(label, model)] = _KeyBudget(label, model)
+        return budget
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    async def call(self, api_key: Optional[str], model: str, estimated_tokens: int,
+                   request: Callable[[], Awaitable[Any]], operation: str = "chat",
+                   on_response: Optional[Callable[[float, Any], None]] = None,
+                   hedger: Optional[RequestHedger] = None) -> Any:
+        """
+        Run `request` (an OpenAI `with_raw_response` call) within the key's budget and
+        return the parsed response. `on_response(seconds, response)` gets the duration of
+        each successful attempt alone, without budget waits and retries; an attempt that
+        timed out is reported with a None response. With a `hedger`, each attempt is
+        hedged once its budget is reserved; only the winning request is reported.
+        """
+        budget = self.budget(api_key, model)
+
+        async def timed_request() -> Tuple[Any, float]:
+            request_started = time.monotonic()
+            raw = await request()
+            return raw, time.monotonic() - request_started
+
+        for attempt in range(self.max_retries + 1):
+            waited = await budget.acquire(estimated_tokens)
+            metrics.observe("openai_throttle_wait_seconds", waited, key=budget.label, operation=operation)
+            if waited > 0.01:
+                metrics.inc("openai_throttled_total", key=budget.label, operation=operation)
+
+            started = time.monotonic()
+            try:
+                if hedger is not None:
+                    raw, elapsed = await hedger.run(model, timed_request,
+                                                    reserve=lambda: budget.try_acquire(estimated_tokens))
+                else:
+                    raw, elapsed = await timed_request()
+            except RateLimitError as e:
+                metrics.inc("openai_rate_limited_total", key=budget.label, operation=operation)
+                budget.update(getattr(getattr(e, "response", None), "headers", None))
+                if getattr(e, "code", None) == "insufficient_quota" or attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt, _retry_after(e))
+                budget.pause(delay)
+                metrics.inc("openai_retries_total", key=budget.label, operation=operation)
+                logger.warning(f"OpenAI rate limit for key {budget.label} ({model}), retrying in {delay:.2f}s")
+                continue
+            except (APIConnectionError, InternalServerError) as e:
+                if on_response is not None and isinstance(e, APITimeoutError):
+                    on_response(time.monotonic() - started, None)
+                # The SDK's own retries are disabled, so transient failures are retried here
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt, None)
+                metrics.inc("openai_retries_total", key=budget.label, operation=operation)
+                logger.warning(f"OpenAI request failed for key {budget.label} ({model}): {str(e)}, retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            budget.update(raw.headers)
+            response = raw.parse()
+            if on_response is not None:
+                on_response(elapsed, response)
+            return response
+
+
+openai_rate_limiter = OpenAIRateLimiter()
@@ -0,0 +1,43 @@
+import logging
+from functools import lru_cache
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        logger.warning("tiktoken is not installed. Falling back to approximate token counts.")
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning(f"Could not load tokenizer for {model}, using approximate token counts: {e}")
+        return None
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(message: Dict[str, Any], model: str = "gpt-4") -> int:
+    return MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "", model)
+
+
+def count_messages_tokens(messages: List[Dict[str, Any]], model: str = "gpt-4") -> int:
+    return sum(count_message_tokens(message, model) for message in messages)
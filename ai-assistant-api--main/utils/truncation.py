@@ -0,0 +1,95 @@
+from typing import Any, Dict, List, Optional
+from utils.tokens import count_message_tokens
+
+DEFAULT_TRUNCATION_STRATEGY = {"type": "last_messages", "last_messages": 10}
+DEFAULT_MAX_TOKENS = 3000
+DEFAULT_KEEP_TURNS = 4
+# With "summarize", turns that still wait for the background summary are kept up to this many
+# times `keep_turns`, so a failing summarizer cannot grow the session without bound
+SUMMARY_BACKLOG_FACTOR = 3
+
+
+def turn_starts(messages: List[Dict[str, Any]]) -> List[int]:
+    """Indexes of the user messages that open each turn."""
+    return [i for i, message in enumerate(messages) if message.get("role") == "user"]
+
+
+def summary_overflow(messages: List[Dict[str, Any]], keep_turns: int) -> int:
+    """Number of leading messages that fall outside the last `keep_turns` turns."""
+    starts = turn_starts(messages)
+    if len(starts) <= keep_turns:
+        return 0
+    return starts[-keep_turns] if keep_turns > 0 else len(messages)
+
+
+def truncate_last_messages(messages: List[Dict[str, Any]], last_messages: int):
+    # Each turn adds a user and an assistant message, hence the factor of two
+    if len(messages) > last_messages * 2:
+        del messages[:-last_messages * 2]
+
+
+def dialogue_turns(messages: List[Dict[str, Any]]) -> List[List[int]]:
+    """
+    Group message indexes into turns: each turn opens with the user message(s) and runs up
+    to the next user message, so an assistant `tool_calls` message stays with its `tool`
+    results and the reply. Messages before the first user message form their own group.
+    """
+    turns: List[List[int]] = []
+    for i, message in enumerate(messages):
+        opens_turn = message.get("role") == "user" and (i == 0 or messages[i - 1].get("role") != "user")
+        if opens_turn or not turns:
+            turns.append([])
+        turns[-1].append(i)
+    return turns
+
+
+def truncate_to_token_budget(messages: List[Dict[str, Any]], max_tokens: int, model: str = "gpt-4"):
+    """
+    Drop messages in place until the conversation fits in `max_tokens`. Stale per-turn
+    system messages (old instructions + knowledge base context) go first, then whole turns
+    from the oldest end. The latest system prompt and the current turn are always kept.
+    """
+    counts = [count_message_tokens(message, model) for message in messages]
+    total = sum(counts)
+    if total <= max_tokens:
+        return
+
+    systems = [i for i, message in enumerate(messages) if message.get("role") == "system"]
+    dropped = set()
+    for i in systems[:-1]:
+        if total <= max_tokens:
+            break
+        dropped.add(i)
+        total -= counts[i]
+
+    protected = set(systems[-1:])
+    for turn in dialogue_turns(messages)[:-1]:
+        if total <= max_tokens:
+            break
+        for i in turn:
+            if i not in protected and i not in dropped:
+                dropped.add(i)
+                total -= counts[i]
+
+    messages[:] = [message for i, message in enumerate(messages) if i not in dropped]
+
+
+def truncate_messages(messages: List[Dict[str, Any]], strategy: Optional[Dict[str, Any]], model: str = "gpt-4",
+                      reserved_tokens: int = 0):
+    """
+    Apply an assistant's `truncation_strategy` to a session's messages in place.
+    `reserved_tokens` is taken from the `max_tokens` budget for prompt parts that are
+    sent alongside the messages (instructions, knowledge base context).
+    """
+    strategy = strategy or DEFAULT_TRUNCATION_STRATEGY
+
+    if strategy.get("type") == "max_tokens":
+        budget = strategy.get("max_tokens", DEFAULT_MAX_TOKENS) - reserved_tokens
+        truncate_to_token_budget(messages, max(0, budget), model)
+    elif strategy.get("type") == "summarize":
+        keep_turns = strategy.get("keep_turns", DEFAULT_KEEP_TURNS)
+        overflow = summary_overflow(messages, keep_turns * SUMMARY_BACKLOG_FACTOR)
+        if overflow:
+            del messages[:overflow]
+    elif strategy.get("type") == "last_messages":
+        truncate_last_messages(messages, strategy.get("last_messages", 10))
@@ -1,16 +1,25 @@
-from fastapi import APIRouter, HTTPException, Body, Query, Depends
+from fastapi import APIRouter, HTTPException, Body, Query, Depends, File, Form, UploadFile
+from pymongo import ReturnDocument
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 import os
+import asyncio
 from datetime import datetime
 from bson import ObjectId
 import logging
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import VectorParams, Distance, PointStruct
-from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+from qdrant_client.http.models import VectorParams, Distance
 import numpy as np
+from openai import APIConnectionError, APIStatusError, RateLimitError
 from utils.embeddings import get_embeddings
-from schemas.knowledge_base import TextData, TextDataResponse, TextDataUpdate, SearchQuery, SearchResponse
+from utils.qdrant_filters import build_search_filter, ensure_payload_indexes, BUILTIN_FIELDS
+from services.title_index import TitleSuggestIndex
+from services.vector_sync_worker import VectorSyncWorker, new_sync_state, pending_sync_update
+from services.ingestion_service import IngestionService
+from utils.document_parser import SUPPORTED_EXTENSIONS, file_extension
+from schemas.knowledge_base import (
+    TextData, TextDataResponse, TextDataUpdate, SearchQuery, SearchResponse, SuggestResponse, IngestionJobResponse
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,11 +27,14 @@ logger = logging.getLogger(__name__)
 QDRANT_URL = os.getenv("QDRANT_URL", "http://qdrant:6333")
 COLLECTION_NAME = os.getenv("VECTOR_COLLECTION_NAME", "knowledge_base")
 VECTOR_SIZE = 1536  
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_READ_CHUNK = 1024 * 1024
 
 def create_vector_store_router(db):
     router = APIRouter(prefix="/knowledge-base", tags=["Knowledge Base"])
     
     qdrant_client = QdrantClient(url=QDRANT_URL)
+    title_index = TitleSuggestIndex(db)
     
     try:
         collections = qdrant_client.get_collections()
@@ -32,49 +44,74 @@ def create_vector_store_router(db):
                 vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.COSINE)
             )
             logger.info(f"Created collection {COLLECTION_NAME}")
+        ensure_payload_indexes(qdrant_client, COLLECTION_NAME, BUILTIN_FIELDS)
     except Exception as e:
         logger.error(f"Error setting up Qdrant collection: {e}")
     
+    # Vector writes go through the `vector_sync` outbox embedded in each document,
+    # so every write endpoint is a single atomic MongoDB operation.
+    sync_worker = VectorSyncWorker(db, qdrant_client, COLLECTION_NAME)
+    sync_worker.start()
+    router.on_event("shutdown")(sync_worker.stop)
+    
+    ingestion_service = IngestionService(db, title_index, sync_worker)
+    ingestion_service.start()
+    router.on_event("shutdown")(ingestion_service.shutdown)
+    
     @router.post("/", response_model=TextDataResponse)
     async def add_text(text_data: TextData = Body(...)):
-        assistant = await db.assistants.find_one({"_id": ObjectId(text_data.assistant_id)})
-        embeddings = await get_embeddings(text_data.content, api_key=assistant.get("openai_id"))
-        
         doc = text_data.model_dump()
         doc["created_at"] = datetime.now()
         doc["updated_at"] = None
+        doc["vector_sync"] = new_sync_state()
         
         result = await db.knowledge_texts.insert_one(doc)
         doc_id = str(result.inserted_id)
         
-        point_id = int(str(result.inserted_id)[-6:], 16)  
+        title_index.add(doc_id, text_data.title, text_data.assistant_id)
+        sync_worker.notify()
         
-        try:
-            qdrant_client.upsert(
-                collection_name=COLLECTION_NAME,
-                points=[
-                    PointStruct(
-                        id=point_id,
-                        vector=embeddings,
-                        payload={
-                            "mongodb_id": doc_id,
-                            "title": text_data.title,
-                            "assistant_id": text_data.assistant_id,
-                            **text_data.metadata
-                        }
-                    )
-                ]
-            )
-        except Exception as e:
-            await db.knowledge_texts.delete_one({"_id": result.inserted_id})
-            logger.error(f"Qdrant insert failed: {e}")
-            raise HTTPException(status_code=500, detail=f"Failed to add text to vector store: {str(e)}")
+        doc["id"] = doc_id
+        doc["_id"] = doc_id
+        
+        return doc
+    
+    @router.post("/upload", response_model=IngestionJobResponse, status_code=202)
+    async def upload_files(
+        files: List[UploadFile] = File(...),
+        assistant_id: str = Form(...)
+    ):
+        # Bot retrieval filters by assistant, so texts of a missing assistant would never be found
+        if not ObjectId.is_valid(assistant_id) or not await db.assistants.find_one({"_id": ObjectId(assistant_id)}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Assistant not found")
         
-        created_doc = await db.knowledge_texts.find_one({"_id": result.inserted_id})
-        created_doc["id"] = doc_id
-        created_doc["_id"] = doc_id
+        payloads = []
+        for upload in files:
+            if file_extension(upload.filename) not in SUPPORTED_EXTENSIONS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Unsupported file type: {upload.filename}. Supported: {', '.join(sorted(SUPPORTED_EXTENSIONS))}"
+                )
+            # Read in chunks so an oversized file is rejected without being held in memory
+            data = bytearray()
+            while chunk := await upload.read(UPLOAD_READ_CHUNK):
+                data.extend(chunk)
+                if len(data) > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File too large: {upload.filename}")
+            payloads.append((upload.filename, bytes(data)))
         
-        return created_doc
+        job_id = await ingestion_service.start_job(assistant_id, payloads)
+        return await ingestion_service.get_job(job_id)
+    
+    @router.get("/upload/{job_id}", response_model=IngestionJobResponse)
+    async def get_upload_job(job_id: str):
+        try:
+            job = await ingestion_service.get_job(job_id)
+        except Exception as e:
+            raise HTTPException(status_code=404, detail=f"Upload job not found: {str(e)}")
+        if not job:
+            raise HTTPException(status_code=404, detail="Upload job not found")
+        return job
     
     @router.get("/", response_model=List[TextDataResponse])
     async def get_texts(
@@ -82,12 +119,10 @@ def create_vector_store_router(db):
         limit: int = Query(10, ge=1, le=100),
         assistant_id: Optional[str] = None
     ):
-        query = {}
+        query = {"deleted_at": None}
         if assistant_id:
             query["assistant_id"] = assistant_id
         
-        total = await db.knowledge_texts.count_documents(query)
-        
         cursor = db.knowledge_texts.find(query).skip(skip).limit(limit)
         texts = await cursor.to_list(length=limit)
         
@@ -99,17 +134,33 @@ def create_vector_store_router(db):
     
     @router.get("/count", response_model=Dict[str, int])
     async def count_texts(assistant_id: Optional[str] = None):
-        query = {}
+        query = {"deleted_at": None}
         if assistant_id:
             query["assistant_id"] = assistant_id
         
         count = await db.knowledge_texts.count_documents(query)
         return {"count": count}
     
+    @router.get("/suggest", response_model=SuggestResponse)
+    async def suggest_titles(
+        q: str = Query(..., min_length=1),
+        assistant_id: Optional[str] = None,
+        limit: int = Query(10, ge=1, le=50)
+    ):
+        suggestions = await title_index.suggest(q, assistant_id, limit)
+        return {
+            "suggestions": suggestions,
+            "total": len(suggestions)
+        }
+    
+    @router.get("/sync-status", response_model=Dict[str, float])
+    async def get_sync_status(assistant_id: Optional[str] = None):
+        return await sync_worker.status(assistant_id)
+    
     @router.get("/{text_id}", response_model=TextDataResponse)
     async def get_text(text_id: str):
         try:
-            doc = await db.knowledge_texts.find_one({"_id": ObjectId(text_id)})
+            doc = await db.knowledge_texts.find_one({"_id": ObjectId(text_id), "deleted_at": None})
             if not doc:
                 raise HTTPException(status_code=404, detail="Text not found")
             
@@ -122,47 +173,23 @@ def create_vector_store_router(db):
     @router.put("/{text_id}", response_model=TextDataResponse)
     async def update_text(text_id: str, text_data: TextDataUpdate = Body(...)):
         try:
-            assistant = await db.assistants.find_one({"_id": ObjectId(text_data.assistant_id)})
             update_data = {k: v for k, v in text_data.dict().items() if v is not None}
             update_data["updated_at"] = datetime.now()
             
-            result = await db.knowledge_texts.update_one(
-                {"_id": ObjectId(text_id)},
-                {"$set": update_data}
+            update = pending_sync_update(reembed="content" in update_data)
+            update["$set"].update(update_data)
+            
+            updated_doc = await db.knowledge_texts.find_one_and_update(
+                {"_id": ObjectId(text_id), "deleted_at": None},
+                update,
+                return_document=ReturnDocument.AFTER
             )
             
-            if result.matched_count == 0:
+            if updated_doc is None:
                 raise HTTPException(status_code=404, detail="Text not found")
             
-            updated_doc = await db.knowledge_texts.find_one({"_id": ObjectId(text_id)})
-            
-            if "content" in update_data:
-                point_id = int(text_id[-6:], 16)  
-                embeddings = await get_embeddings(update_data["content"], api_key=assistant.get("openai_id"))
-                
-                payload = {
-                    "mongodb_id": text_id,
-                    "title": updated_doc["title"],
-                    "assistant_id": updated_doc.get("assistant_id"),
-                }
-                
-                if "metadata" in updated_doc:
-                    payload.update(updated_doc["metadata"])
-                
-                try:
-                    qdrant_client.upsert(
-                        collection_name=COLLECTION_NAME,
-                        points=[
-                            PointStruct(
-                                id=point_id,
-                                vector=embeddings,
-                                payload=payload
-                            )
-                        ]
-                    )
-                except Exception as e:
-                    logger.error(f"Qdrant update failed: {e}")
-                    raise HTTPException(status_code=500, detail=f"Failed to update text in vector store: {str(e)}")
+            title_index.add(text_id, updated_doc["title"], updated_doc.get("assistant_id"))
+            sync_worker.notify()
             
             updated_doc["id"] = str(updated_doc["_id"])
             updated_doc["_id"] = str(updated_doc["_id"])
@@ -176,20 +203,19 @@ def create_vector_store_router(db):
     @router.delete("/{text_id}")
     async def delete_text(text_id: str):
         try:
-            result = await db.knowledge_texts.delete_one({"_id": ObjectId(text_id)})
+            update = pending_sync_update(reembed=False)
+            update["$set"]["deleted_at"] = datetime.now()
             
-            if result.deleted_count == 0:
+            result = await db.knowledge_texts.update_one(
+                {"_id": ObjectId(text_id), "deleted_at": None},
+                update
+            )
+            
+            if result.matched_count == 0:
                 raise HTTPException(status_code=404, detail="Text not found")
             
-            point_id = int(text_id[-6:], 16) 
-            try:
-                qdrant_client.delete(
-                    collection_name=COLLECTION_NAME,
-                    points_selector=[point_id]
-                )
-            except Exception as e:
-                logger.error(f"Qdrant delete failed: {e}")
-                raise HTTPException(status_code=500, detail=f"Failed to delete text from vector store: {str(e)}")
+            title_index.remove(text_id)
+            sync_worker.notify()
             
             return {"message": "Text deleted successfully"}
             
@@ -202,21 +228,25 @@ def create_vector_store_router(db):
     async def search_texts(search_query: SearchQuery = Body(...)):
         try:
             
-            query_embeddings = await get_embeddings(search_query.query)
-            
-            filter_obj = None
-            if search_query.filter_by:
-                conditions = []
-                for key, value in search_query.filter_by.items():
-                    if key == "assistant_id" and value:
-                        conditions.append(FieldCondition(key="assistant_id", match=MatchValue(value=value)))
-                    elif key in ["title", "metadata"]:
-                        conditions.append(FieldCondition(key=key, match=MatchValue(value=value)))
-                
-                if conditions:
-                    filter_obj = Filter(must=conditions)
-            
-            search_results = qdrant_client.search(
+            filter_by = search_query.filter_by or {}
+            assistant = None
+            if filter_by.get("assistant_id"):
+                assistant = await db.assistants.find_one({"_id": ObjectId(filter_by["assistant_id"])})
+            
+            fields = (assistant or {}).get("metadata_fields") or {}
+            await asyncio.to_thread(ensure_payload_indexes, qdrant_client, COLLECTION_NAME, fields)
+            try:
+                filter_obj = build_search_filter(filter_by, fields)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            query_embeddings = await get_embeddings(
+                search_query.query,
+                api_key=(assistant or {}).get("openai_id") or os.getenv("OPENAI_API_KEY")
+            )
+            
+            search_results = await asyncio.to_thread(
+                qdrant_client.search,
                 collection_name=COLLECTION_NAME,
                 query_vector=query_embeddings,
                 limit=search_query.limit,
@@ -228,7 +258,7 @@ def create_vector_store_router(db):
             result_docs = []
             for doc_id in mongodb_ids:
                 try:
-                    doc = await db.knowledge_texts.find_one({"_id": ObjectId(doc_id)})
+                    doc = await db.knowledge_texts.find_one({"_id": ObjectId(doc_id), "deleted_at": None})
                     if doc:
                         doc["id"] = str(doc["_id"])
                         doc["_id"] = str(doc["_id"])
@@ -241,6 +271,12 @@ def create_vector_store_router(db):
                 "total": len(result_docs)
             }
             
+        except HTTPException as e:
+            raise e
+        except RateLimitError as e:
+            raise HTTPException(status_code=429, detail=f"Embedding rate limit exceeded: {str(e)}")
+        except (APIConnectionError, APIStatusError) as e:
+            raise HTTPException(status_code=503, detail=f"Embedding service unavailable: {str(e)}")
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Search failed: {str(e)}")
     
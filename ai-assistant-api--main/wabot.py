@@ -1,6 +1,5 @@
 import os
 import asyncio
-import traceback
 import logging
 from fastapi import FastAPI, Request, HTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
@@ -8,6 +7,12 @@ from bson import ObjectId
 import json
 from schemas.integrations import GreenAPIIntegrationModel
 from services.whatsapp_service import GreenAPIWhatsAppService
+from services.assistant_cache import get_assistant_cache
+from services.session_store import SESSION_BACKEND
+from services.function_runner import function_runner
+from services.outbound_dispatcher import outbound_dispatcher
+from utils.background import background_tasks
+from utils.metrics import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -16,6 +21,7 @@ app = FastAPI(title="WhatsApp Bot Service", version="1.0.0")
 
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://mongodb:27017")
 DB_NAME = os.getenv("DB_NAME", "ai_assistant_db")
+WABOT_WORKERS = int(os.getenv("WABOT_WORKERS", "1"))
 
 mongodb_client = None
 db = None
@@ -29,11 +35,19 @@ async def startup_db_client():
     db = mongodb_client[DB_NAME]
     logger.info("Connected to MongoDB")
     
+    if WABOT_WORKERS > 1 and SESSION_BACKEND != "mongo":
+        logger.warning("Running several workers with in-memory sessions; set SESSION_BACKEND=mongo to share them")
+    
     await initialize_greenapi_services()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     global mongodb_client
+    await background_tasks.drain()
+    await function_runner.close()
+    await outbound_dispatcher.close()
+    if db is not None:
+        await get_assistant_cache(db).stop()
     if mongodb_client:
         mongodb_client.close()
         logger.info("Disconnected from MongoDB")
@@ -87,15 +101,20 @@ async def webhook(request: Request):
             return {"status": "success", "message": f"Webhook of type {webhook_type} received"}
         
     except Exception as e:
-        error_trace = traceback.format_exc()
-        print(e)
-        logger.error(f"Error processing webhook: {str(e)}\n{error_trace}")
+        logger.exception(f"Error processing webhook: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/webhook")
 async def verify_webhook(request: Request):
     return {"status": "success", "message": "Webhook endpoint is active"}
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("wabot:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
+    if WABOT_WORKERS > 1:
+        uvicorn.run("wabot:app", host="0.0.0.0", port=8001, workers=WABOT_WORKERS)
+    else:
+        uvicorn.run("wabot:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
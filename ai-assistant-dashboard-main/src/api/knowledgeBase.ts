@@ -4,7 +4,8 @@ import {
   TextDataResponse, 
   TextDataUpdate, 
   SearchQuery, 
-  SearchResponse 
+  SearchResponse,
+  SuggestResponse
 } from '../types/knowledgeBase';
 
 export const addTextToKnowledgeBase = async (textData: TextData): Promise<TextDataResponse> => {
@@ -57,4 +58,17 @@ export const searchTextsInKnowledgeBase = async (
 ): Promise<SearchResponse> => {
   const response = await api.post('/knowledge-base/search', searchQuery);
   return response.data;
+};
+
+export const suggestTitlesInKnowledgeBase = async (
+  q: string,
+  assistantId?: string,
+  limit = 8
+): Promise<SuggestResponse> => {
+  const params: any = { q, limit };
+  if (assistantId) {
+    params.assistant_id = assistantId;
+  }
+  const response = await api.get('/knowledge-base/suggest', { params });
+  return response.data;
 };
\ No newline at end of file
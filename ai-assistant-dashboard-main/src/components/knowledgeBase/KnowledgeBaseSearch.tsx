@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import {
   Box,
   TextField,
@@ -20,18 +20,20 @@ import {
 import { SelectChangeEvent } from '@mui/material/Select';
 import SearchIcon from '@mui/icons-material/Search';
 import ContentCopyIcon from '@mui/icons-material/ContentCopy';
-import { SearchQuery, TextDataResponse } from '../../types/knowledgeBase';
+import { SearchQuery, TextDataResponse, TitleSuggestion } from '../../types/knowledgeBase';
 import { AIAssistant } from '../../types/assistant';
 import Loader from '../common/Loader';
 
 interface KnowledgeBaseSearchProps {
   assistants: AIAssistant[];
   onSearch: (query: SearchQuery) => Promise<TextDataResponse[]>;
+  onSuggest?: (query: string, assistantId?: string) => Promise<TitleSuggestion[]>;
 }
 
 const KnowledgeBaseSearch: React.FC<KnowledgeBaseSearchProps> = ({
   assistants,
   onSearch,
+  onSuggest,
 }) => {
   const [searchQuery, setSearchQuery] = useState<string>('');
   const [assistantId, setAssistantId] = useState<string>('');
@@ -39,6 +41,31 @@ const KnowledgeBaseSearch: React.FC<KnowledgeBaseSearchProps> = ({
   const [results, setResults] = useState<TextDataResponse[]>([]);
   const [isLoading, setIsLoading] = useState(false);
   const [hasSearched, setHasSearched] = useState(false);
+  const [suggestions, setSuggestions] = useState<TitleSuggestion[]>([]);
+
+  useEffect(() => {
+    if (!onSuggest || !searchQuery.trim()) {
+      setSuggestions([]);
+      return;
+    }
+
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const result = await onSuggest(searchQuery, assistantId || undefined);
+        if (!cancelled) {
+          setSuggestions(result);
+        }
+      } catch (err) {
+        console.error('Suggest error:', err);
+      }
+    }, 150);
+
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchQuery, assistantId, onSuggest]);
 
   const handleSearchQueryChange = (e: React.ChangeEvent<HTMLInputElement>) => {
     setSearchQuery(e.target.value);
@@ -61,6 +88,7 @@ const KnowledgeBaseSearch: React.FC<KnowledgeBaseSearchProps> = ({
     
     setIsLoading(true);
     setResults([]);
+    setSuggestions([]);
 
     try {
       const query: SearchQuery = {
@@ -109,6 +137,19 @@ const KnowledgeBaseSearch: React.FC<KnowledgeBaseSearchProps> = ({
                 placeholder="Enter your search terms"
                 required
               />
+              {suggestions.length > 0 && (
+                <Box sx={{ mt: 1, display: 'flex', flexWrap: 'wrap', gap: 1 }}>
+                  {suggestions.map((suggestion) => (
+                    <Chip
+                      key={suggestion.id}
+                      label={suggestion.title}
+                      size="small"
+                      variant="outlined"
+                      onClick={() => setSearchQuery(suggestion.title)}
+                    />
+                  ))}
+                </Box>
+              )}
             </Grid>
             
             <Grid item xs={12} sm={3}>
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useCallback, useState } from 'react';
 import {
   Box,
   Typography,
@@ -16,7 +16,8 @@ import KnowledgeBaseSearch from '../components/knowledgeBase/KnowledgeBaseSearch
 import { useKnowledgeBase } from '../hooks/useKnowledgeBase';
 import { useAssistants } from '../hooks/useAssistants';
 import Loader from '../components/common/Loader';
-import { TextData, TextDataResponse, SearchQuery, TextDataUpdate } from '../types/knowledgeBase';
+import { knowledgeBaseApi } from '../api';
+import { TextData, TextDataResponse, SearchQuery, TextDataUpdate, TitleSuggestion } from '../types/knowledgeBase';
 
 interface TabPanelProps {
   children?: React.ReactNode;
@@ -104,6 +105,14 @@ const KnowledgeBase: React.FC = () => {
     }
   };
 
+  const handleSuggest = useCallback(
+    async (query: string, assistantId?: string): Promise<TitleSuggestion[]> => {
+      const result = await knowledgeBaseApi.suggestTitlesInKnowledgeBase(query, assistantId);
+      return result.suggestions;
+    },
+    []
+  );
+
   const handleCloseSnackbar = () => {
     setSnackbar({ ...snackbar, open: false });
   };
@@ -159,6 +168,7 @@ const KnowledgeBase: React.FC = () => {
           <KnowledgeBaseSearch
             assistants={getAssistantsQuery.data || []}
             onSearch={handleSearch}
+            onSuggest={handleSuggest}
           />
         </TabPanel>
 
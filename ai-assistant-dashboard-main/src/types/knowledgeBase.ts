@@ -27,4 +27,15 @@ export interface TextData {
   export interface SearchResponse {
     results: TextDataResponse[];
     total: number;
+  }
+
+  export interface TitleSuggestion {
+    id: string;
+    title: string;
+    score: number;
+  }
+
+  export interface SuggestResponse {
+    suggestions: TitleSuggestion[];
+    total: number;
   }
\ No newline at end of file